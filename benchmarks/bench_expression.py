@@ -0,0 +1,102 @@
+'''
+QQ 表情编解码的微基准：对比旧的逐段拼接实现与 ExpressionCodec
+
+用法(在仓库根目录)：python -m benchmarks.bench_expression [--faces 40] [--number 2000]
+'''
+import argparse
+import random
+import re
+import timeit
+from alicebot.adapter.cqhttp.message import CQHTTPMessage, CQHTTPMessageSegment
+from plugins.Ashley.expression import ExpressionCodec
+
+EXPRESS_DATA = {
+    2: '😘 示爱', 4: '😏 得意', 5: '😭 流泪', 8: '💤 睡', 9: '😭 大哭', 10: '😅 尴尬',
+    12: '😜 调皮', 14: '😊 微笑', 16: '😎 酷', 21: '🥰 可爱', 23: '😒 傲慢', 26: '😱 惊恐',
+    27: '😓 流汗', 28: '😄 憨笑', 32: '🤔 疑问', 33: '🤫 嘘', 49: '🤗 拥抱', 53: '🎂 蛋糕',
+    60: '☕ 咖啡', 63: '🌹 玫瑰', 66: '❤️ 爱心', 74: '🌞 太阳', 75: '🌙 月亮', 76: '👍 赞',
+}
+SENTENCES = ['喵~今天也要开心哦', '主人你在干什么呀', '艾希想吃小鱼干了', '这个问题好难喵', '嘿嘿，被夸了']
+
+
+def legacy_encode(text: str, express_id: dict):
+    '''旧实现：正则分割后逐段 += 拼接消息'''
+    messages = CQHTTPMessageSegment.text('')
+    split_text_segment = re.split(r'(::.*?::)', text)
+    for idx, msg in enumerate(split_text_segment):
+        if msg.startswith('::') and msg.endswith('::'):
+            face_name = msg[2:-2]
+            if face_name in express_id:
+                messages += CQHTTPMessageSegment.face(express_id[face_name])
+        else:
+            if idx == 0:
+                msg = msg.lstrip()
+            if idx == len(split_text_segment) - 1:
+                msg = msg.rstrip()
+            messages += CQHTTPMessageSegment.text(msg)
+    return messages
+
+
+def legacy_decode(message, express_data: dict) -> str:
+    plain = []
+    for msg in message:
+        if msg.type == 'text':
+            plain.append(msg.data['text'])
+        if msg.type == 'face':
+            if int(msg.data['id']) in express_data:
+                plain.append(f"::{express_data[int(msg.data['id'])].strip()}::")
+    return ''.join(plain)
+
+
+def legacy_catalogue(allow_express: dict) -> str:
+    return ' '.join([f'::{e}::' for e in allow_express.values()])
+
+
+def make_reply(rng: random.Random, faces: int) -> str:
+    names = list(EXPRESS_DATA.values())
+    parts = []
+    for _ in range(faces):
+        parts.append(rng.choice(SENTENCES))
+        parts.append(f'::{rng.choice(names)}::')
+    return ''.join(parts)
+
+
+def bench(name: str, func, number: int, repeat: int = 5) -> float:
+    best = min(timeit.repeat(func, number=number, repeat=repeat)) / number
+    print(f'{name:<28} {best * 1e6:10.2f} us/op')
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--faces', type=int, default=40, help='每条回复中的表情数')
+    parser.add_argument('--number', type=int, default=2000, help='每轮执行次数')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    reply = make_reply(rng, args.faces)
+    express_id = {v: k for k, v in EXPRESS_DATA.items()}
+    codec = ExpressionCodec(EXPRESS_DATA, EXPRESS_DATA)
+    message = CQHTTPMessage(codec.encode_segments(reply))
+
+    # 两种实现的结果应当一致(旧实现会多出空文本段)
+    legacy = [seg for seg in legacy_encode(reply, express_id) if seg.type != 'text' or seg.data['text']]
+    assert legacy == list(codec.encode(reply)), 'encode mismatch'
+    assert legacy_decode(message, EXPRESS_DATA) == codec.decode(message), 'decode mismatch'
+
+    print(f'reply: {len(reply)} chars, {args.faces} faces, {len(message)} segments')
+    results = {
+        'encode': (bench('legacy encode', lambda: legacy_encode(reply, express_id), args.number),
+                   bench('codec encode', lambda: codec.encode(reply), args.number)),
+        'decode': (bench('legacy decode', lambda: legacy_decode(message, EXPRESS_DATA), args.number),
+                   bench('codec decode', lambda: codec.decode(message), args.number)),
+        'catalogue': (bench('legacy catalogue', lambda: legacy_catalogue(EXPRESS_DATA), args.number),
+                      bench('codec catalogue', lambda: codec.catalogue, args.number)),
+    }
+    for name, (old, new) in results.items():
+        print(f'{name:<10} speedup x{old / new:.1f}')
+
+
+if __name__ == '__main__':
+    main()
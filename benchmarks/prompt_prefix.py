@@ -0,0 +1,161 @@
+'''
+主模型提示词的前缀复用基准：对比旧布局与当前布局每次请求需要预填充的 token 数
+
+模拟多个群交替对话，模型服务有若干个 KV 缓存槽位，每次请求复用公共前缀最长的槽位，
+只有公共前缀之后的部分需要预填充；会覆盖其他对话的缓存时改用最久未使用的槽位(与 Ollama 的行为一致)。
+旧布局：日期渲染在人设中，群聊摘要写在本轮用户消息里并保存进历史。
+当前布局：人设和表情列表渲染一次，日期和星期随本轮用户消息给出，对话历史只在末尾追加。
+
+用法(在仓库根目录)：python -m benchmarks.prompt_prefix [--groups 4] [--turns 20] [--slots 1 4]
+'''
+import argparse
+import json
+import os
+import random
+import time
+import yaml
+from langchain_core.messages import AIMessage, HumanMessage, SystemMessage
+from langchain_core.prompts import ChatPromptTemplate, MessagesPlaceholder
+from plugins.Ashley.ai import SEND_TIME_FORMAT, AshleyAIGraph
+from plugins.Ashley.context import estimate_tokens
+
+SENTENCES = ['今天的作业好多啊', '有人去食堂吗', '这个题怎么做', '晚上一起打游戏', '猫娘在吗', '明天要下雨了',
+             '老师说下周考试', '我刚看完那部电影', '有没有人带伞', '这周末去海边吧']
+REPLIES = ['（摇摇尾巴）喵~好呀', '（歪头）艾希也不知道呢喵~', '（蹭蹭）要加油哦喵~', '（竖起耳朵）真的吗喵~']
+DIGESTS = ['大家在讨论考试安排', '几个人约了周末出去玩', '有人在问作业的答案', '群里在聊天气']
+
+
+class BenchConfig(dict):
+    '''只提供 AshleyAIGraph 用到的配置接口'''
+    @property
+    def Ashley(self):
+        return self['Ashley']
+
+    def get(self, key, default=None):
+        return super().get(key, default)
+
+
+def load_example() -> tuple[str, dict]:
+    path = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'config.yaml.example')
+    with open(path, 'r') as example:
+        config = yaml.safe_load(example)
+    return config['Ashley']['Prompt'], config.get('ExpressData', {})
+
+
+def build_graph(prompt: str, express_data: dict) -> AshleyAIGraph:
+    config = BenchConfig(ChatExpress=True, Ashley={'Helper': {}, 'Memory': {'path': ':memory:'}})
+    return AshleyAIGraph(config=config, prompt=prompt, express_data=express_data,
+                         base_url='http://127.0.0.1:9', context_win=32768)
+
+
+class LegacyLayout:
+    '''改动前的提示词布局'''
+    def __init__(self, graph: AshleyAIGraph, prompt: str):
+        self.catalogue = graph.expression.catalogue
+        self.template = ChatPromptTemplate.from_messages(
+            [('system', prompt),
+             MessagesPlaceholder(variable_name="history_summary", optional=True),
+             MessagesPlaceholder(variable_name="messages")]
+        )
+
+    def user_turn(self, turn: dict) -> HumanMessage:
+        content = {'name': turn['name'], 'send_time': turn['send_time']}
+        if turn['digest']:
+            content['chat_digest'] = turn['digest']
+        content['msg'] = turn['msg']
+        return HumanMessage(json.dumps(content, ensure_ascii=False))
+
+    def render(self, history: list, user: HumanMessage, turn: dict) -> list:
+        return self.template.invoke({'date': turn['date'], 'expression': self.catalogue,
+                                     'messages': [*history, user]}).to_messages()
+
+
+class CurrentLayout:
+    '''AshleyAIGraph.render_prompt 的布局'''
+    def __init__(self, graph: AshleyAIGraph):
+        self.graph = graph
+
+    def user_turn(self, turn: dict) -> HumanMessage:
+        content = {'name': turn['name'], 'send_time': turn['send_time']}
+        if turn['digest']:
+            content['chat_digest'] = turn['digest']
+        content['msg'] = turn['msg']
+        return HumanMessage(json.dumps(content, ensure_ascii=False))
+
+    def render(self, history: list, user: HumanMessage, turn: dict) -> list:
+        return self.graph.render_prompt({}, '', [*history, user])
+
+
+def serialize(messages: list) -> str:
+    '''近似聊天模板，只用于比较前缀'''
+    roles = {HumanMessage: 'user', AIMessage: 'assistant', SystemMessage: 'system'}
+    return ''.join(f'<|{roles[type(message)]}|>{message.content}<|end|>' for message in messages)
+
+
+def make_turns(groups: int, turns: int, digest_ratio: float, seed: int) -> list[dict]:
+    '''各群交替的对话，后半段跨过一次日期变化'''
+    rng = random.Random(seed)
+    order = [group for group in range(groups) for _ in range(turns)]
+    rng.shuffle(order)
+    day = time.mktime((2025, 3, 1, 12, 0, 0, 0, 0, -1))
+    result = []
+    for idx, group in enumerate(order):
+        now = day + (86400 if idx >= len(order) // 2 else 0) + idx * 30
+        result.append({'group': group, 'date': time.strftime('%Y-%m-%d %A', time.localtime(now)),
+                       'time': time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(now)),
+                       'send_time': time.strftime(SEND_TIME_FORMAT, time.localtime(now)),
+                       'name': f'同学{rng.randrange(8)}', 'msg': rng.choice(SENTENCES),
+                       'digest': rng.choice(DIGESTS) if rng.random() < digest_ratio else '',
+                       'reply': rng.choice(REPLIES)})
+    return result
+
+
+def simulate(layout, turns: list[dict], slots: int) -> dict:
+    cache = [''] * slots  # 每个槽位中已经计算过 KV 的序列
+    used = [-1] * slots
+    histories: dict[int, list] = {}
+    prompt_tokens = 0
+    prefill_tokens = 0
+    for step, turn in enumerate(turns):
+        history = histories.setdefault(turn['group'], [])
+        user = layout.user_turn(turn)
+        text = serialize(layout.render(history, user, turn))
+        common = [len(os.path.commonprefix([text, cached])) for cached in cache]
+        best = max(range(slots), key=lambda idx: (common[idx], -used[idx]))
+        slot = best
+        if common[best] < len(cache[best]):
+            # 会覆盖最匹配槽位中其他对话的缓存时，把公共前缀复制到最久未使用的槽位
+            slot = min(range(slots), key=lambda idx: used[idx])
+        prompt_tokens += estimate_tokens(text)
+        prefill_tokens += estimate_tokens(text[common[best]:])
+        reply = AIMessage(turn['reply'])
+        cache[slot] = text + serialize([reply])
+        used[slot] = step
+        history.extend([user, reply])
+    return {'requests': len(turns), 'prompt_tokens': prompt_tokens, 'prefill_tokens': prefill_tokens,
+            'prefill_per_request': round(prefill_tokens / len(turns), 1),
+            'reuse': round(1 - prefill_tokens / prompt_tokens, 4) if prompt_tokens else 0}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--groups', type=int, default=4)
+    parser.add_argument('--turns', type=int, default=20, help='每个群的回复轮数')
+    parser.add_argument('--slots', type=int, nargs='+', default=[1, 4], help='模型服务的 KV 缓存槽位数(OLLAMA_NUM_PARALLEL)')
+    parser.add_argument('--digest-ratio', type=float, default=0.5, help='回复前带有群聊摘要的比例')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    prompt, express_data = load_example()
+    graph = build_graph(prompt, express_data)
+    turns = make_turns(args.groups, args.turns, args.digest_ratio, args.seed)
+    layouts = {'legacy': LegacyLayout(graph, prompt), 'current': CurrentLayout(graph)}
+    result = {'parameters': vars(args), 'prefix_tokens': graph.prompt_prefix()[1]}
+    for slots in args.slots:
+        result[f'slots_{slots}'] = {name: simulate(layout, turns, slots) for name, layout in layouts.items()}
+    graph.memory.close()
+    print(json.dumps(result, ensure_ascii=False, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,448 @@
+'''
+群聊回放基准：把录制或合成的群聊消息按时间回放给真实的 AshleyAppPlugin.rule()/handle()，
+OneBot 适配器和 Ollama 服务均为本地替身，不需要 QQ 账号和 GPU。
+
+输出 JSON：吞吐量、各阶段 p50/p95/p99 延迟、每条消息的模型调用次数和峰值 RSS，可在不同提交之间比较。
+
+用法(在仓库根目录)：
+    python -m benchmarks.replay --groups 8 --rate 20 --duration 30 --output result.json
+    python -m benchmarks.replay --trace trace.jsonl
+    python -m benchmarks.replay --dump-trace trace.jsonl   # 只生成合成的消息记录
+
+trace 为 JSONL，每行一条消息：
+    {"t": 0.12, "group_id": 1001, "user_id": 20001, "text": "...", "at": false, "images": 0, "poke": false}
+'''
+import argparse
+import asyncio
+import hashlib
+import json
+import logging
+import os
+import random
+import re
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+from types import SimpleNamespace
+
+import structlog
+import yaml
+from aiohttp import web
+from PIL import Image
+
+SELF_ID = 10000
+CORPUS = [
+    '今天中午吃什么', '有没有人打游戏', '这个bug修了一下午', '明天要下雨了', '刚看完那部电影，还挺好看的',
+    '艾希你在吗', '谁知道这个怎么弄', '我先去睡了，晚安', '周末一起出去玩吧', '这道题好难啊',
+    '猫猫好可爱', '论文还没写完', '有人用过这个库吗', '笑死我了', '下班了下班了',
+]
+# 群聊中反复出现的短消息
+REPEATS = ['哈哈哈', '哈哈哈哈哈', '+1', '+1', '草', '？', '😂😂😂', '👍', '复读', '6666']
+
+
+def make_trace(groups: int, rate: float, duration: float, mention_ratio: float, image_ratio: float,
+               poke_ratio: float, repeat_ratio: float, seed: int) -> list[dict]:
+    '''合成群聊消息：总速率 rate 条/秒的泊松到达，平均分布在 groups 个群'''
+    rng = random.Random(seed)
+    trace = []
+    t = 0.0
+    while True:
+        t += rng.expovariate(rate)
+        if t >= duration:
+            break
+        group_id = 1000 + rng.randrange(groups)
+        record = {'t': round(t, 4), 'group_id': group_id, 'user_id': 20000 + rng.randrange(50),
+                  'text': rng.choice(REPEATS) if rng.random() < repeat_ratio else rng.choice(CORPUS),
+                  'at': rng.random() < mention_ratio,
+                  'images': 1 + int(rng.random() < 0.2) if rng.random() < image_ratio else 0,
+                  'poke': rng.random() < poke_ratio}
+        trace.append(record)
+    return trace
+
+
+def load_trace(path: str) -> list[dict]:
+    with open(path, 'r') as trace:
+        return sorted((json.loads(line) for line in trace if line.strip()), key=lambda record: record['t'])
+
+
+class FakeOllama:
+    '''
+    本地替身 Ollama 服务，按模型名区分主模型、辅助模型和视觉模型
+
+    主模型按 token_latency 流式输出 reply_tokens 个 token；辅助模型以 arouse_ratio 的概率判断需要回复，
+    结果由消息内容决定，相同消息得到相同结果。
+    '''
+    def __init__(self, prefill_latency: float, token_latency: float, reply_tokens: int,
+                 helper_latency: float, vision_latency: float, arouse_ratio: float):
+        self.prefill_latency = prefill_latency
+        self.token_latency = token_latency
+        self.reply_tokens = reply_tokens
+        self.helper_latency = helper_latency
+        self.vision_latency = vision_latency
+        self.arouse_ratio = arouse_ratio
+        self.calls: dict[str, int] = {}
+        self.loaded: dict[str, float] = {}
+        self.runner = None
+        self.url = None
+
+    def count(self, name: str):
+        self.calls[name] = self.calls.get(name, 0) + 1
+
+    def arouse(self, text: str) -> bool:
+        digest = hashlib.md5(text.encode()).digest()
+        return digest[0] / 255 < self.arouse_ratio
+
+    def answer(self, body: dict) -> tuple[list[str], float, float]:
+        '''返回 (输出的 token, 首个 token 前的延迟, 每个 token 的延迟)'''
+        model = body.get('model')
+        prompt = '\n'.join(str(message.get('content', '')) for message in body.get('messages', []))
+        if model == 'helper':
+            if body.get('format') == 'json':
+                self.count('helper_arouse_batch')
+                ids = re.findall(r'^\[(\d+)\] (.*)$', prompt, re.MULTILINE)
+                results = [{'id': int(idx), 'arouse': self.arouse(text)} for idx, text in ids]
+                return [json.dumps({'results': results})], self.helper_latency, 0
+            if '判断是否需要回复' in prompt:
+                self.count('helper_arouse')
+                return ['true' if self.arouse(prompt.rsplit(':', 1)[-1].strip()) else 'false'], self.helper_latency, 0
+            self.count('helper_digest')
+            return ['群友们在闲聊。'], self.helper_latency, 0
+        if model == 'vision':
+            self.count('vision')
+            return ['一张图片'], self.vision_latency, 0
+        self.count('main')
+        tokens = ['喵~', '我', '在', '哦', '！'] * (self.reply_tokens // 5 + 1)
+        return tokens[:self.reply_tokens], self.prefill_latency, self.token_latency
+
+    def chunk(self, model: str, content: str, done: bool, prompt_tokens: int = 0, eval_tokens: int = 0,
+              prefill: float = 0, generation: float = 0) -> bytes:
+        data = {'model': model, 'created_at': '2025-01-01T00:00:00Z',
+                'message': {'role': 'assistant', 'content': content}, 'done': done}
+        if done:
+            # 耗时与 Ollama 一致，单位为纳秒
+            data.update({'done_reason': 'stop', 'prompt_eval_count': prompt_tokens, 'eval_count': eval_tokens,
+                         'total_duration': int((prefill + generation) * 1e9), 'load_duration': 0,
+                         'prompt_eval_duration': int(prefill * 1e9), 'eval_duration': int(generation * 1e9)})
+        return (json.dumps(data, ensure_ascii=False) + '\n').encode()
+
+    async def handle_chat(self, request: web.Request):
+        body = await request.json()
+        model = body.get('model')
+        self.loaded[model] = time.time()
+        tokens, first_latency, token_latency = self.answer(body)
+        prompt_tokens = sum(len(str(message.get('content', ''))) for message in body.get('messages', []))
+        await asyncio.sleep(first_latency)
+
+        if body.get('stream') is False:
+            await asyncio.sleep(token_latency * len(tokens))
+            return web.Response(body=self.chunk(model, ''.join(tokens), True, prompt_tokens, len(tokens),
+                                                first_latency, token_latency * len(tokens)),
+                                content_type='application/json')
+
+        response = web.StreamResponse()
+        response.content_type = 'application/x-ndjson'
+        await response.prepare(request)
+        for token in tokens:
+            await response.write(self.chunk(model, token, False))
+            if token_latency:
+                await asyncio.sleep(token_latency)
+        await response.write(self.chunk(model, '', True, prompt_tokens, len(tokens),
+                                        first_latency, token_latency * len(tokens)))
+        await response.write_eof()
+        return response
+
+    async def handle_generate(self, request: web.Request):
+        body = await request.json()
+        self.count('generate')
+        self.loaded[body.get('model')] = time.time()
+        return web.json_response({'model': body.get('model'), 'created_at': '2025-01-01T00:00:00Z',
+                                  'response': '', 'done': True, 'load_duration': 0})
+
+    async def handle_version(self, request: web.Request):
+        return web.json_response({'version': '0.5.7'})
+
+    async def handle_tags(self, request: web.Request):
+        return web.json_response({'models': [{'name': name, 'model': name} for name in ('main', 'helper', 'vision')]})
+
+    async def handle_ps(self, request: web.Request):
+        return web.json_response({'models': [{'name': name, 'model': name, 'size_vram': 0,
+                                              'expires_at': '2099-01-01T00:00:00Z'} for name in self.loaded]})
+
+    async def start(self, port: int = 0) -> str:
+        app = web.Application(client_max_size=64 * 1024 * 1024)
+        app.router.add_post('/api/chat', self.handle_chat)
+        app.router.add_post('/api/generate', self.handle_generate)
+        app.router.add_get('/api/version', self.handle_version)
+        app.router.add_get('/api/tags', self.handle_tags)
+        app.router.add_get('/api/ps', self.handle_ps)
+        self.runner = web.AppRunner(app, access_log=None)
+        await self.runner.setup()
+        site = web.TCPSite(self.runner, '127.0.0.1', port)
+        await site.start()
+        port = site._server.sockets[0].getsockname()[1]
+        self.url = f'http://127.0.0.1:{port}'
+        return self.url
+
+    async def stop(self):
+        if self.runner is not None:
+            await self.runner.cleanup()
+
+
+class StubAdapter:
+    '''替身 OneBot 适配器，记录发送的消息，图片从本地文件读取'''
+    name = 'cqhttp'
+
+    def __init__(self, bot, images: dict[str, str]):
+        self.bot = bot
+        self.images = images
+        self.sent = 0
+        self.api_calls: dict[str, int] = {}
+
+    async def call_api(self, api: str, **params):
+        self.api_calls[api] = self.api_calls.get(api, 0) + 1
+        if api.startswith('send_'):
+            return {'message_id': sum(self.api_calls.values())}
+        return {}
+
+    async def send_group_msg(self, group_id: int, message):
+        self.sent += 1
+        return await self.call_api('send_group_msg', group_id=group_id, message=message)
+
+    async def send(self, message, message_type: str, id_: int):
+        self.sent += 1
+        return await self.call_api('send_msg', message_type=message_type, id=id_, message=message)
+
+    async def get_image(self, file: str):
+        await self.call_api('get_image', file=file)
+        return {'file': self.images[file]}
+
+    async def clean_cache(self):
+        return await self.call_api('clean_cache')
+
+
+def make_images(directory: str, count: int, seed: int) -> dict[str, str]:
+    rng = random.Random(seed)
+    images = {}
+    for idx in range(count):
+        path = os.path.join(directory, f'image_{idx}.png')
+        color = tuple(rng.randrange(256) for _ in range(3))
+        Image.new('RGB', (1280, 960), color).save(path)
+        images[f'{idx:032x}.image'] = path
+    return images
+
+
+def make_event(adapter: StubAdapter, record: dict, message_id: int, images: list[str], rng: random.Random):
+    from alicebot.adapter.cqhttp.event import GroupMessageEvent, PokeNotifyEvent
+
+    now = int(time.time())
+    if record.get('poke'):
+        return PokeNotifyEvent(adapter=adapter, time=now, self_id=SELF_ID, post_type='notice',
+                               notice_type='notify', sub_type='poke', user_id=record['user_id'],
+                               target_id=SELF_ID, group_id=record['group_id'], raw_info=[{'txt': '戳了戳'}])
+
+    message = []
+    if record.get('at'):
+        message.append({'type': 'at', 'data': {'qq': str(SELF_ID)}})
+    message.append({'type': 'text', 'data': {'text': record['text']}})
+    for _ in range(record.get('images', 0)):
+        message.append({'type': 'image', 'data': {'file': rng.choice(images), 'summary': '', 'url': ''}})
+    return GroupMessageEvent(adapter=adapter, time=now, self_id=SELF_ID, post_type='message',
+                             message_type='group', sub_type='normal', message_id=message_id,
+                             user_id=record['user_id'], message=message, raw_message=record['text'], font=0,
+                             sender={'user_id': record['user_id'], 'nickname': f'user{record["user_id"]}',
+                                     'card': f'user{record["user_id"]}'},
+                             group_id=record['group_id'])
+
+
+def write_config(directory: str, url: str, groups: list[int], args) -> str:
+    config = {
+        'wheel': [],
+        'group_whitelist': groups,
+        'Express': {14: '😊 微笑', 76: '👍 赞'},
+        'Ashley': {
+            'group_active_beta': 0.3,
+            'group_active_threshold': args.active_threshold,
+            'group_active_engage': args.active_engage,
+            'hot_reload': False,
+            'Parameters': {'model': 'main', 'base_url': url, 'context_win': 4096},
+            'Prompt': '你是艾希，一只可爱的猫娘。今天是 {date}。可以使用的表情：{expression}',
+            'Helper': {
+                'model': 'helper', 'base_url': url,
+                'vision_model': 'vision', 'vision_base_url': url,
+                'prompt': '判断是否需要回复: {input}',
+                'digest_prompt': '旧摘要 {last_digest} 新消息 {msg_sender} {msg_content} {msg_time}',
+                'vision_prompt': '描述这张图片',
+                'image': {'path_map': {}},
+            },
+            'Clients': {'health_interval': 0},
+        },
+    }
+    if args.config_override:
+        with open(args.config_override, 'r') as override:
+            merge_config(config, yaml.safe_load(override) or {})
+    path = os.path.join(directory, 'config.yaml')
+    with open(path, 'w') as conf:
+        yaml.safe_dump(config, conf, allow_unicode=True)
+    return path
+
+
+def merge_config(base: dict, override: dict):
+    for key, value in override.items():
+        if isinstance(value, dict) and isinstance(base.get(key), dict):
+            merge_config(base[key], value)
+        else:
+            base[key] = value
+
+
+def git_revision() -> str:
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        return None
+
+
+async def replay(trace: list[dict], args) -> dict:
+    from plugins.Ashley.config import AshleyConfig
+    from plugins.Ashley.core import Ashley, AshleyAppPlugin
+    from plugins.Ashley.metrics import Histogram, metrics
+
+    fake = FakeOllama(args.prefill_latency, args.token_latency, args.reply_tokens,
+                      args.helper_latency, args.vision_latency, args.arouse_ratio)
+    url = await fake.start()
+    workdir = tempfile.mkdtemp(prefix='ashley-replay-')
+    cwd = os.getcwd()
+    os.chdir(workdir)
+    try:
+        image_files = make_images(workdir, args.image_pool, args.seed)
+        groups = sorted({record['group_id'] for record in trace})
+        write_config(workdir, url, groups, args)
+
+        bot = SimpleNamespace()
+        adapter = StubAdapter(bot, image_files)
+        startup = time.perf_counter()
+        bot.ashley = Ashley(config=AshleyConfig())
+        bot.ashley.start()
+        startup = time.perf_counter() - startup
+
+        rng = random.Random(args.seed)
+        events = {'rule': Histogram(), 'handle': Histogram(), 'event': Histogram()}
+        triggered = 0
+        errors = 0
+
+        async def dispatch(event):
+            nonlocal triggered, errors
+            plugin = AshleyAppPlugin.__new__(AshleyAppPlugin)
+            plugin.event = event
+            started = time.perf_counter()
+            try:
+                matched = await plugin.rule()
+                events['rule'].observe(time.perf_counter() - started)
+                if matched:
+                    triggered += 1
+                    handle_started = time.perf_counter()
+                    await plugin.handle()
+                    events['handle'].observe(time.perf_counter() - handle_started)
+            except Exception as e:
+                errors += 1
+                print(f'event failed: {e!r}', file=sys.stderr)
+            events['event'].observe(time.perf_counter() - started)
+
+        tasks = []
+        started = time.perf_counter()
+        for message_id, record in enumerate(trace, start=1):
+            delay = record['t'] / args.speed - (time.perf_counter() - started)
+            if delay > 0:
+                await asyncio.sleep(delay)
+            tasks.append(asyncio.create_task(dispatch(make_event(adapter, record, message_id,
+                                                                 list(image_files), rng))))
+        await asyncio.wait(tasks, timeout=args.drain)
+        elapsed = time.perf_counter() - started
+        unfinished = sum(1 for task in tasks if not task.done())
+        for task in tasks:
+            task.cancel()
+
+        startup_phases = {phase: round(seconds, 4) for phase, seconds in bot.ashley.startup.items()}
+        await bot.ashley.close()
+    finally:
+        os.chdir(cwd)
+        await fake.stop()
+
+    messages = len(trace)
+    model_calls = sum(fake.calls.values())
+    snapshot = metrics.snapshot()
+    return {
+        'revision': git_revision(),
+        'parameters': {key: value for key, value in vars(args).items() if key not in ('output', 'dump_trace')},
+        'messages': messages,
+        'groups': len(groups),
+        'triggered': triggered,
+        'replies_sent': adapter.sent,
+        'errors': errors,
+        'unfinished': unfinished,
+        'elapsed': round(elapsed, 3),
+        'startup': round(startup, 3),
+        'startup_phases': startup_phases,
+        'throughput': round(messages / elapsed, 3) if elapsed else 0,
+        'stages': {**{name: hist.summary() for name, hist in events.items()}, **snapshot['histograms']},
+        'model_calls': {'total': model_calls, 'per_message': round(model_calls / messages, 4) if messages else 0,
+                        **fake.calls},
+        'counters': snapshot['counters'],
+        'adapter_calls': adapter.api_calls,
+        'peak_rss_mb': round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--trace', help='回放的 JSONL 消息记录，不指定时合成')
+    parser.add_argument('--dump-trace', help='把合成的消息记录写入文件后退出')
+    parser.add_argument('--groups', type=int, default=4)
+    parser.add_argument('--rate', type=float, default=10, help='所有群合计每秒消息数')
+    parser.add_argument('--duration', type=float, default=20, help='合成消息的时长(秒)')
+    parser.add_argument('--mention-ratio', type=float, default=0.1, help='@机器人的消息比例')
+    parser.add_argument('--image-ratio', type=float, default=0.1, help='带图片的消息比例')
+    parser.add_argument('--poke-ratio', type=float, default=0.02, help='戳一戳的比例')
+    parser.add_argument('--repeat-ratio', type=float, default=0.3, help='复读、+1 等重复短消息的比例')
+    parser.add_argument('--image-pool', type=int, default=16, help='不同图片的数量')
+    parser.add_argument('--speed', type=float, default=1.0, help='回放速度倍数')
+    parser.add_argument('--drain', type=float, default=60, help='回放结束后等待未完成事件的时间(秒)')
+    parser.add_argument('--prefill-latency', type=float, default=0.2, help='主模型首个 token 的延迟(秒)')
+    parser.add_argument('--token-latency', type=float, default=0.02, help='主模型每个 token 的延迟(秒)')
+    parser.add_argument('--reply-tokens', type=int, default=40)
+    parser.add_argument('--helper-latency', type=float, default=0.15)
+    parser.add_argument('--vision-latency', type=float, default=0.8)
+    parser.add_argument('--arouse-ratio', type=float, default=0.1, help='辅助模型判断需要回复的比例')
+    parser.add_argument('--active-threshold', type=float, default=5)
+    parser.add_argument('--active-engage', type=float, default=0.0, help='活跃时随机回复的概率')
+    parser.add_argument('--config-override', help='合并到基准配置中的 YAML 文件')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', help='结果 JSON 文件，默认输出到标准输出')
+    parser.add_argument('--log-level', default='WARNING')
+    args = parser.parse_args()
+
+    if args.trace:
+        trace = load_trace(args.trace)
+    else:
+        trace = make_trace(args.groups, args.rate, args.duration, args.mention_ratio, args.image_ratio,
+                           args.poke_ratio, args.repeat_ratio, args.seed)
+    if args.dump_trace:
+        with open(args.dump_trace, 'w') as output:
+            for record in trace:
+                output.write(json.dumps(record, ensure_ascii=False) + '\n')
+        return
+
+    random.seed(args.seed)
+    structlog.configure(wrapper_class=structlog.make_filtering_bound_logger(getattr(logging, args.log_level.upper())))
+    result = json.dumps(asyncio.run(replay(trace, args)), ensure_ascii=False, indent=2)
+    if args.output:
+        with open(args.output, 'w') as output:
+            output.write(result)
+    else:
+        print(result)
+
+
+if __name__ == '__main__':
+    main()
@@ -7,6 +7,11 @@ bot = Bot(hot_reload=False)
 @bot.bot_run_hook
 async def initAshley(bot: Bot):
     bot.ashley = Ashley(config=AshleyConfig())
+    bot.ashley.start()
+
+@bot.bot_exit_hook
+async def closeAshley(bot: Bot):
+    await bot.ashley.close()
 
 bot.load_plugins(AshleyAppPlugin, AshleyManagePlugin)
 
@@ -1,4 +1,6 @@
-import re
+import asyncio
+import hashlib
+import orjson
 from alicebot.adapter.cqhttp.message import CQHTTPMessageSegment
 from attr import dataclass
 import structlog
@@ -8,11 +10,24 @@ from typing import Annotated
 from alicebot import MessageEvent
 from langchain_core.prompts import ChatPromptTemplate
 from langchain_ollama import ChatOllama, OllamaLLM
-from langchain_core.messages import HumanMessage, AIMessage
+from langchain_core.messages import HumanMessage, AIMessage, AIMessageChunk, RemoveMessage, SystemMessage
+from langchain_core.runnables import RunnableConfig
+from langgraph.constants import TAG_NOSTREAM
 from langgraph.graph import StateGraph, START, END, MessagesState
 from langgraph.checkpoint.memory import MemorySaver
 from langchain_core.prompts import ChatPromptTemplate, MessagesPlaceholder
-from plugins.Ashley.utils import convertToBase64, formatTime, isPokeNotify
+from plugins.Ashley.batching import MicroBatcher
+from plugins.Ashley.cache import ImageDigestCache, VerdictCache
+from plugins.Ashley.clients import OllamaClientRegistry
+from plugins.Ashley.context import ContextAssembler
+from plugins.Ashley.expression import ExpressionCodec
+from plugins.Ashley.lifecycle import ModelLifecycle, record_load
+from plugins.Ashley.memory import SQLiteSaver, trim_messages_by_retention
+from plugins.Ashley.metrics import metrics
+from plugins.Ashley.scheduler import AROUSE, DIGEST, REPLY, VISION, RequestScheduler
+from plugins.Ashley.imaging import ImageProcessor
+from plugins.Ashley.streaming import SentenceChunker, ThinkStripper
+from plugins.Ashley.utils import formatTime, isPokeNotify
 
 logger = structlog.stdlib.get_logger()
 
@@ -27,9 +42,13 @@ def DSR1CoTParser(output: str):
         return output
 
 
+# 人设中的 {date} 替换为这段说明，真实日期和星期随每条用户消息给出，保证提示词开头每天都不变
+DATE_HINT = '最新一条消息的 send_time'
+SEND_TIME_FORMAT = '%Y-%m-%d %A %H:%M:%S'
+
+
 class AshleyState(MessagesState):
-    date: str
-    expression: str
+    summary: str # 已移出上下文的早期对话摘要
 
 class AshleyAIGraph:
     def __init__(self, model='deepseek-r1:1.5b',
@@ -39,20 +58,40 @@ class AshleyAIGraph:
                         express_data={},
                         config={},
                         helper=None,
+                        limiter=None,
+                        clients=None,
+                        lifecycle=None,
+                        on_sent=None,
                         **kwargs):
         self.ai_helper = helper
-        self.model = ChatOllama(base_url=base_url, model=model, num_ctx=context_win, temperature=0.6)
-        self.context_win = context_win
-        self.prompt = prompt
-        self.express_data: dict = express_data
-        self.allow_express = config.get('ChatExpress', default=True) # 允许LLM使用的表情
-        # 将express_data的key和value互换
-        self.express_id = {v: k for k, v in self.express_data.items()}
+        self.on_sent = on_sent # (group_id, message_id)，用于识别回复机器人的消息
+        self.limiter = limiter or RequestScheduler()
+        self.clients = clients or OllamaClientRegistry()
+        self.lifecycle = lifecycle or ModelLifecycle(self.clients)
+        self.build_model(model=model, base_url=base_url, context_win=context_win)
+        # QQ表情编解码，ChatExpress 为允许LLM使用的表情
+        self.set_expression(express_data, config.get('ChatExpress', default=True))
         self.chat_statics = dict()
-
-        self.prompt_template = self.build_propmpt_template(prompt)
+        self.image_deadline = float(config.Ashley['Helper'].get('image_deadline', 20.0)) # 单条消息中图片处理的截止时间(秒)
+        self.background_tasks = set()
+
+        # 流式回复：生成完整的句子或段落后立即发送
+        stream_config = dict(config.Ashley.get('Streaming', {}))
+        self.streaming = bool(stream_config.pop('enable', False))
+        self.stream_rules = stream_config # mode, min_chars, max_chars, delimiters
+
+        # 每个群的对话线程保存在本地 SQLite 中，并按轮数和长度裁剪
+        memory_config = config.Ashley.get('Memory', {})
+        self.max_turns = int(memory_config.get('max_turns', 50))
+        self.max_bytes = int(memory_config.get('max_bytes', 64 * 1024))
+        self.assembler = ContextAssembler(context_win,
+                                          fraction=float(memory_config.get('context_fraction', 0.75)),
+                                          low_fraction=float(memory_config.get('context_low_fraction', 0.5)))
+
+        self.set_prompt(prompt)
         self.workflow = self.build_ai_workflow()
-        self.memory = MemorySaver()
+        self.memory = SQLiteSaver(path=memory_config.get('path', 'memory.db'),
+                                  keep=int(memory_config.get('keep_checkpoints', 4)))
         self.ai = self.workflow.compile(checkpointer=self.memory)
 
     def render_image(self):
@@ -61,39 +100,100 @@ class AshleyAIGraph:
         img = base64.b64encode(img).decode('utf-8')
         return f'data:image/png;base64,{img}'
 
+    def build_model(self, model: str, base_url: str, context_win: int=4096):
+        '''创建主模型客户端，配置热重载时只替换客户端，图和记忆保持不变'''
+        self.base_url = self.clients.endpoint(base_url)
+        self.context_win = context_win
+        options = {'num_ctx': context_win}
+        self.model = self.clients.chat_model(self.base_url, model=model, temperature=0.6,
+                                             keep_alive=self.lifecycle.keep_alive('main'), **options)
+        self.lifecycle.register('main', self.base_url, model, options)
+        if hasattr(self, 'assembler'):
+            self.assembler.resize(context_win)
+
+    def set_prompt(self, prompt: str):
+        self.prompt = prompt
+        self.prompt_template = self.build_propmpt_template(prompt)
+        self.prefix = None
+
+    def set_expression(self, express_data: dict, allow_express=True):
+        self.expression = ExpressionCodec(express_data, allow_express)
+        self.prefix = None
+
+    def prompt_prefix(self) -> tuple[SystemMessage, int]:
+        '''
+        人设和表情列表只渲染一次，每次请求的开头逐字节相同，Ollama 可以复用已经预填充的 KV 缓存
+        返回 (系统消息, token 数)，修改提示词或表情后重新渲染
+        '''
+        if self.prefix is None:
+            system = self.prompt_template.format_messages(date=DATE_HINT, expression=self.expression.catalogue)[0]
+            self.prefix = (system, self.assembler.counter.count_text(system.content))
+        return self.prefix
+
     def build_propmpt_template(self, prompt):
-        return ChatPromptTemplate.from_messages(
-            [('system', prompt), MessagesPlaceholder(variable_name="messages")]
-        )
+        return ChatPromptTemplate.from_messages([('system', prompt)])
     
     def build_ai_workflow(self):
         workflow = StateGraph(state_schema=AshleyState)
         
-        workflow.add_node('chat_info', self.chat_info)
         workflow.add_node('model', self.call_model)
         workflow.add_node('auto_continue', self.auto_continue)
+        workflow.add_node('trim_history', self.trim_history)
         
-        workflow.add_edge(START, 'chat_info')
-        workflow.add_edge('chat_info', 'model')
-        workflow.add_edge('model', END)
+        workflow.add_edge(START, 'model')
+        workflow.add_edge('model', 'trim_history')
+        workflow.add_edge('trim_history', END)
 
         return workflow
 
-    async def chat_info(self, state: AshleyState):
-        expression = ' '.join([f'::{e}::' for e in self.allow_express.values()])
-        return {'date': time.strftime('%Y-%m-%d %A'),
-                'expression': expression
-            }
-
-    async def call_model(self, state: AshleyState) -> AIMessage:
-        prompt = self.prompt_template.invoke(state)
-        response = await self.model.ainvoke(prompt)
+    def render_prompt(self, state: AshleyState, summary: str, messages: list) -> list:
+        '''
+        固定的人设在最前，其后依次是早期对话摘要和对话历史，它们只在裁剪上下文时变化；
+        日期、发送者和群聊摘要等每次都变的内容写在本轮用户消息中，对话只在末尾追加
+        '''
+        system, _ = self.prompt_prefix()
+        history_summary = [SystemMessage(f'更早的对话摘要：{summary}')] if summary else []
+        return [system, *history_summary, *messages]
+
+    def fixed_tokens(self, state: AshleyState, summary: str) -> int:
+        '''系统提示词和摘要占用的 token 数'''
+        _, tokens = self.prompt_prefix()
+        fixed = self.render_prompt(state, summary, [])[1:]
+        return tokens + sum(self.assembler.counter.count_text(message.content) for message in fixed)
+
+    async def call_model(self, state: AshleyState, config: RunnableConfig) -> AIMessage:
+        started = time.perf_counter()
+        summary = state.get('summary', '')
+        messages = state['messages']
+        while True:
+            messages, dropped = self.assembler.assemble(self.fixed_tokens(state, summary), messages)
+            if not dropped:
+                break
+            # 超出上下文预算的早期对话合并进摘要，并从线程中移除；摘要变长后可能还需要再合并一次，
+            # 每次至少移出一轮且总是保留最新一轮，所以一定会结束
+            logger.info(f'Fold {len(dropped)} messages into history summary')
+            summary = await self.ai_helper.summarize_history(summary, dropped)
+            started = time.perf_counter()
+
+        prompt = self.render_prompt(state, summary, messages)
+        metrics.since('stage_seconds', started, stage='prompt')
+        async with self.limiter.slot(self.base_url, REPLY):
+            response = await self.model.ainvoke(prompt)
+        record_model_usage(response, self.model.model, config['configurable'].get('thread_id', '-'))
 
         if '<think>' in response.content:
             think, response.content = DSR1CoTParser(response.content)
 
-        return {'messages': response}
+        removed = [RemoveMessage(id=message.id) for message in state['messages'][:-len(messages)]]
+        return {'messages': [*removed, response], 'summary': summary}
     
+    async def trim_history(self, state: AshleyState):
+        '''按保留策略删除过旧的对话，保证线程大小不随运行时间增长'''
+        removed = trim_messages_by_retention(state['messages'], self.max_turns, self.max_bytes)
+        if removed:
+            logger.info(f'Trim {len(removed)} messages from history')
+        return {'messages': removed}
+
     async def auto_continue(self, state: AshleyState) -> bool:
         done = state.messages[-1].response_metadata['done']
         if done:
@@ -101,27 +201,72 @@ class AshleyAIGraph:
         elif state.messages[-1].response_metadata['done_reason'] != 'stop':
             return True
         
-    async def get_plain_text_for_model(self, event: MessageEvent):
+    async def describe_image(self, event: MessageEvent, file: str):
+        # 同一张图片(表情包)的描述直接从缓存读取，不再下载和调用视觉模型
+        # 未命中时在 generate_image_digest 中按内容哈希再查一次，由那次查找计入命中率
+        img_content = await self.ai_helper.image_cache.get(file_id=file, record_miss=False)
+        if img_content is None:
+            started = time.perf_counter()
+            abs_path = (await event.adapter.get_image(file=file))['file']
+            metrics.since('stage_seconds', started, stage='image_fetch')
+            logger.info(abs_path)
+            img_content = await self.ai_helper.generate_image_digest(abs_path, file_id=file)
+        return img_content
+
+    def background_done(self, task: asyncio.Task):
+        '''超过截止时间的图片在后台完成后读取异常并记录，避免 "exception was never retrieved"'''
+        self.background_tasks.discard(task)
+        if not task.cancelled() and task.exception() is not None:
+            logger.error('Background image description failed', exc_info=task.exception())
+
+    async def describe_images(self, event: MessageEvent, images: list) -> list:
+        '''
+        并发处理消息中的所有图片，超过截止时间仍未完成的图片返回 None
+        未完成的任务继续在后台运行，结果写入缓存供下次使用
         '''
-        格式化消息中的文本和表情(替换为emoji)
+        tasks = [asyncio.create_task(self.describe_image(event, msg.data['file'])) for msg in images]
+        done, pending = await asyncio.wait(tasks, timeout=self.image_deadline)
+        for task in pending:
+            self.background_tasks.add(task)
+            task.add_done_callback(self.background_done)
+        if pending:
+            logger.warning(f'{len(pending)} images missed the deadline')
+
+        results = []
+        for msg, task in zip(images, tasks):
+            if task in done and task.exception() is None:
+                results.append(task.result())
+            else:
+                if task in done:
+                    logger.error(f'Failed to describe image {msg.data["file"]}', exc_info=task.exception())
+                results.append(None)
+        return results
+
+    async def get_plain_text_for_model(self, event: MessageEvent, describe_images: bool=True):
+        '''
+        格式化消息中的文本和表情(替换为emoji)，describe_images 为 False 时图片只使用 OneBot 提供的摘要
         '''
         plain_msg_content = []
+        images = [] # (位置, 图片消息段)
         for msg in event.message:
-            if msg.type == 'text':
-                plain_msg_content.append(msg.data['text'])
-            if msg.type == 'face':
-                if int(msg.data['id']) in self.express_data:
-                    plain_msg_content.append(f'::{self.express_data[int(msg.data['id'])].strip()}::')
-                else:
-                    logger.warning(f'Unknown face id: {msg.data["id"]}')
             if msg.type == 'image':
+                images.append((len(plain_msg_content), msg))
+                plain_msg_content.append('')
+            else:
+                plain_msg_content.append(self.expression.decode_segment(msg))
+
+        if images:
+            if describe_images:
+                descriptions = await self.describe_images(event, [msg for _, msg in images])
+            else:
+                descriptions = [None] * len(images)
+            for (idx, msg), img_content in zip(images, descriptions):
                 summary = msg.data['summary']
-                file = msg.data['file']
-                # logger.info(summary + file)
-                abs_path = (await event.adapter.get_image(file=file))['file']
-                logger.info(abs_path)
-                img_content = await self.ai_helper.generate_image_digest(abs_path)
-                plain_msg_content.append(f'[图片{summary}:alt={img_content}]')
+                if img_content is None:
+                    # 超时或失败时只使用 OneBot 提供的摘要
+                    plain_msg_content[idx] = f'[图片{summary}]'
+                else:
+                    plain_msg_content[idx] = f'[图片{summary}:alt={img_content}]'
 
         return ''.join(plain_msg_content).strip()
     
@@ -129,55 +274,93 @@ class AshleyAIGraph:
         '''
         用于onebot回应的消息链
         '''
-        # 将消息按照::文本:: 进行分割
-        messages = CQHTTPMessageSegment.text('')
-        split_text_segment = re.split(r'(::.*?::)', text)
-        for idx, msg in enumerate(split_text_segment):
-            if msg.startswith('::') and msg.endswith('::'):
-                face_name = msg[2:-2]
-                # 表情
-                if face_name in self.express_id:
-                    messages += CQHTTPMessageSegment.face(self.express_id[face_name])
-                else:
-                    logger.warning(f'Model use a unknown face name: {face_name}')
-            else:
-                # 文本
-                if idx == 0:
-                    msg = msg.lstrip()
-                if idx == len(split_text_segment) - 1:
-                    msg = msg.rstrip()
-                messages += CQHTTPMessageSegment.text(msg)
-
-        return messages
+        return self.expression.encode(text)
     
     async def reply_poke(self, msg, event: MessageEvent=None):
         msg = CQHTTPMessageSegment.at(event.sender.user_id) + msg
-        await event.adapter.send(msg, 'group', event.group_id)
-
-    async def chat(self, event: MessageEvent=None, chat_session=None):
-        # await self.get_plain_text_for_model(event)
+        return await event.adapter.send(msg, 'group', event.group_id)
+
+    async def build_content(self, event: MessageEvent=None, chat_session=None, describe_images: bool=True) -> str:
+        '''整理发送者、时间、摘要和消息内容(含图片描述)作为本轮输入'''
+        digest = chat_session.consume_digest()
+        content = {'name': event.sender.card,
+                   'send_time': time.strftime(SEND_TIME_FORMAT, time.localtime(event.time))}
+        if digest != '':
+            content['chat_digest'] = digest
+        content['msg'] = await self.get_plain_text_for_model(event, describe_images)
+        return orjson.dumps(content).decode()
+
+    async def generate(self, content: str, chat_session=None) -> AIMessage:
+        '''调用 langgraph 生成回复'''
         config = {"configurable": {"thread_id": chat_session.group_thread_id}}
-        content = '{"name": "'+ \
-                    event.sender.card + \
-                    '", "send_time": "' + formatTime(event.time) + \
-                    ('", "chat_digest": "' + chat_session.messages_digest + '"') if chat_session.messages_digest != '' else '' + \
-                    '", "msg": "' + \
-                    await self.get_plain_text_for_model(event) + '"}'
-
         input_message = [HumanMessage(content)]
 
         output = await self.ai.ainvoke({'messages': input_message}, config=config)
         result = output['messages'][-1]
 
-        chat_session.messages_digest = ''
         self.chat_statics[chat_session.group_thread_id] = result.usage_metadata['total_tokens']
+        return result
 
+    async def generate_stream(self, content: str, chat_session=None, event: MessageEvent=None,
+                              started: float=None) -> AIMessage:
+        '''流式调用 langgraph，去掉推理内容后按句子或段落分条发送，完整回复仍由 checkpoint 保存'''
+        started = started or time.perf_counter()
+        config = {"configurable": {"thread_id": chat_session.group_thread_id}}
+        input_message = [HumanMessage(content)]
+        stripper = ThinkStripper()
+        chunker = SentenceChunker(**self.stream_rules)
+        sent = 0
+
+        async def send(pieces):
+            nonlocal sent
+            for piece in pieces:
+                send_started = time.perf_counter()
+                await self.send_text(event, piece, first=sent == 0)
+                metrics.since('stage_seconds', send_started, stage='send')
+                if sent == 0:
+                    metrics.since('reply_first_message', started)
+                sent += 1
+
+        async for chunk, metadata in self.ai.astream({'messages': input_message}, config=config,
+                                                     stream_mode='messages'):
+            if metadata.get('langgraph_node') != 'model' or not isinstance(chunk, AIMessageChunk):
+                continue
+            await send(chunker.feed(stripper.feed(chunk.content)))
+        await send(chunker.feed(stripper.flush()) + chunker.flush())
+
+        result = (await self.ai.aget_state(config)).values['messages'][-1]
+        if result.usage_metadata:
+            self.chat_statics[chat_session.group_thread_id] = result.usage_metadata['total_tokens']
+        metrics.observe('reply_messages', sent)
+        return result
+
+    async def send_text(self, event: MessageEvent, text: str, first: bool=True):
         # 替换其中的QQ表情
-        reply_message = self.gen_message_from_plain_text(result.content)
+        reply_message = self.gen_message_from_plain_text(text)
+        if not reply_message:
+            return
         if isPokeNotify(event):
-            await self.reply_poke(reply_message, event)
+            if first:
+                response = await self.reply_poke(reply_message, event)
+            else:
+                response = await event.adapter.send(reply_message, 'group', event.group_id)
         else:
-            await event.reply(reply_message)
+            response = await event.reply(reply_message)
+        if self.on_sent is not None and isinstance(response, dict):
+            self.on_sent(event.group_id, response.get('message_id'))
+
+    async def send_reply(self, event: MessageEvent, result: AIMessage):
+        started = time.perf_counter()
+        await self.send_text(event, result.content)
+        metrics.since('stage_seconds', started, stage='send')
+
+    async def chat(self, event: MessageEvent=None, chat_session=None):
+        content = await self.build_content(event, chat_session)
+        if self.streaming:
+            await self.generate_stream(content, chat_session, event)
+            return
+        result = await self.generate(content, chat_session)
+        await self.send_reply(event, result)
 
     async def get_token_usage(self, event: MessageEvent=None, chat_session='main'):
         cur = self.chat_statics.get(chat_session, 0)
@@ -185,54 +368,247 @@ class AshleyAIGraph:
         return f'max: {self.context_win} cur: {cur} {percent}%'
 
 
-class AshleyAIHelper:
+AROUSE_BATCH_PROMPT = '''{criteria}
+###
+现在需要对下面的多条群聊消息逐条做出上述判断，每条消息以 [编号] 开头：
+{messages}
+###
+只输出 JSON，格式为 {{"results": [{{"id": 编号, "arouse": true 或 false}}]}}，每条消息都必须给出结果。'''
+
+
+HISTORY_SUMMARY_PROMPT = '''下面是一段群聊的旧摘要，以及之后因超出上下文而被移出的对话记录。
+请把它们合并成一份简洁的中文摘要，保留人物、事件、约定和尚未解决的问题，不超过300字。
+旧摘要：{last_summary}
+对话记录：
+{history}
+只输出摘要内容。'''
+
+
+def record_model_usage(response: AIMessage, model: str, group: str = '-'):
     '''
-    使用小模型来辅助大模型的AI
+    记录一次模型调用的输入输出 token 数，以及 Ollama 返回的预填充和生成耗时
     '''
-    def __init__(self, config=None):
-        model = config.Ashley['Helper']['model']
-        base_url = config.Ashley['Helper']['base_url']
-        
-        # 8K 上下文、温度0.6、cpu模式、常驻内存
-        self.model = ChatOllama(base_url=base_url, model=model, num_gpu=0,
-                                num_ctx=8192, temperature=0.6, keep_alive=-1)
-        
-        vision_model = config.Ashley['Helper']['vision_model']
-        vision_url = config.Ashley['Helper']['vision_base_url']
-        
-        self.vision_model = ChatOllama(base_url=vision_url, model=vision_model)
-
-        self.arouse_template = ChatPromptTemplate.from_template(config.Ashley['Helper']['prompt'])
+    if not metrics.enabled:
+        return
+    usage = response.usage_metadata or {}
+    metrics.inc('tokens_in', usage.get('input_tokens', 0), group=group, model=model)
+    # Ollama 的 prompt_eval_count 不含复用 KV 缓存的部分，即实际预填充的 token 数
+    metrics.observe('prefill_tokens', usage.get('input_tokens', 0), model=model)
+    metrics.inc('tokens_out', usage.get('output_tokens', 0), group=group, model=model)
+    metrics.inc('model_calls', group=group, model=model)
+
+    info = response.response_metadata or {}
+    record_load(model, info)
+    if info.get('prompt_eval_duration'):
+        metrics.observe('stage_seconds', info['prompt_eval_duration'] / 1e9, stage='prefill', model=model)
+    if info.get('eval_duration'):
+        metrics.observe('stage_seconds', info['eval_duration'] / 1e9, stage='generation', model=model)
+        if info.get('eval_count'):
+            metrics.observe('tokens_per_second', info['eval_count'] / (info['eval_duration'] / 1e9), model=model)
+
+
+def parse_arouse_verdicts(output: str, count: int):
+    '''
+    解析批量判断的结构化输出，缺失的编号视为不回复，无法解析时返回 None
+    '''
+    try:
+        data = orjson.loads(output)
+    except orjson.JSONDecodeError:
+        return None
+
+    results = data.get('results') if isinstance(data, dict) else data
+    if not isinstance(results, list):
+        return None
+
+    verdicts = [False] * count
+    for item in results:
+        if not isinstance(item, dict):
+            continue
+        try:
+            idx = int(item.get('id')) - 1
+        except (TypeError, ValueError):
+            continue
+        if 0 <= idx < count:
+            arouse = item.get('arouse')
+            verdicts[idx] = arouse is True or str(arouse).lower() == 'true'
+    return verdicts
 
-        self.digest_template = ChatPromptTemplate.from_template(config.Ashley['Helper']['digest_prompt'])
 
-        self.vision_template = config.Ashley['Helper']['vision_prompt']
+class AshleyAIHelper:
+    '''
+    使用小模型来辅助大模型的AI
+    '''
+    def __init__(self, config=None, limiter=None, clients=None, lifecycle=None):
+        self.limiter = limiter or RequestScheduler()
+        self.clients = clients or OllamaClientRegistry()
+        self.lifecycle = lifecycle or ModelLifecycle(self.clients)
+        self.build_model(config.Ashley['Helper'])
+        self.build_vision_model(config.Ashley['Helper'])
+        self.build_templates(config.Ashley['Helper'])
+
+        self.arouse_batcher = MicroBatcher(self.check_arouse_batch,
+                                           window=float(config.Ashley['Helper'].get('arouse_batch_window', 0.2)),
+                                           max_size=int(config.Ashley['Helper'].get('arouse_batch_size', 8)),
+                                           name='arouse')
+
+        verdict_config = config.Ashley['Helper'].get('arouse_cache', {})
+        self.verdict_cache = VerdictCache(max_entries=int(verdict_config.get('max_entries', 2048)),
+                                          ttl=float(verdict_config.get('ttl', 600)),
+                                          scope=verdict_config.get('scope', 'global'),
+                                          max_chars=int(verdict_config.get('max_chars', 200)))
+
+        cache_config = config.Ashley['Helper'].get('image_cache', {})
+        self.image_cache = ImageDigestCache(path=cache_config.get('path', 'image_cache.db'),
+                                            max_memory=int(cache_config.get('max_memory', 512)),
+                                            max_disk=int(cache_config.get('max_disk', 20000)),
+                                            ttl=float(cache_config.get('ttl', 7 * 24 * 3600)))
+
+        image_config = config.Ashley['Helper'].get('image', {})
+        self.image_processor = ImageProcessor(**image_config)
         # self.llm = self.model.with_structured_output(AshleyArouse)
+
+    def build_model(self, helper_config: dict):
+        self.base_url = self.clients.endpoint(helper_config['base_url'])
+        # 8K 上下文、温度0.6、cpu模式，默认常驻内存
+        options = {'num_gpu': 0, 'num_ctx': 8192}
+        self.model = self.clients.chat_model(self.base_url, model=helper_config['model'], temperature=0.6,
+                                             keep_alive=self.lifecycle.keep_alive('helper'), **options)
+        self.lifecycle.register('helper', self.base_url, helper_config['model'], options)
+
+    def build_vision_model(self, helper_config: dict):
+        # 视觉模型在第一次描述图片时才创建，不处理图片时不占用连接
+        self.vision_url = self.clients.endpoint(helper_config['vision_base_url'])
+        self.vision_name = helper_config['vision_model']
+        self.vision_client = None
+        # 客户端延迟创建，但模型本身仍然预加载
+        self.lifecycle.register('vision', self.vision_url, self.vision_name)
+
+    @property
+    def vision_model(self):
+        if self.vision_client is None:
+            self.vision_client = self.clients.chat_model(self.vision_url, model=self.vision_name,
+                                                         keep_alive=self.lifecycle.keep_alive('vision'))
+        return self.vision_client
+
+    def build_templates(self, helper_config: dict):
+        self.arouse_template = ChatPromptTemplate.from_template(helper_config['prompt'])
+
+        # 批量判断：把单条判断的提示词作为判断标准，一次给出多条消息的结果
+        criteria = helper_config['prompt'].replace('{input}', '（见下方消息列表）')
+        self.arouse_batch_template = ChatPromptTemplate.from_template(
+            helper_config.get('batch_prompt', AROUSE_BATCH_PROMPT)
+        ).partial(criteria=criteria)
+
+        self.digest_template = ChatPromptTemplate.from_template(helper_config['digest_prompt'])
+
+        self.summary_template = ChatPromptTemplate.from_template(
+            helper_config.get('summary_prompt', HISTORY_SUMMARY_PROMPT))
+
+        self.vision_template = helper_config['vision_prompt']
         
-    async def is_arouse(self, text: str):
+    async def is_arouse(self, text: str, group_id=None) -> bool:
+        '''判断消息是否需要回复，重复的消息直接使用缓存的结果，短时间内的多次判断会合并为一次批量请求'''
+        async def compute():
+            if self.arouse_batcher.window <= 0:
+                return await self.check_arouse(text)
+            return await self.arouse_batcher.submit(text)
+        started = time.perf_counter()
+        verdict = await self.verdict_cache.resolve(text, compute, group_id)
+        metrics.since('stage_seconds', started, stage='arouse')
+        return verdict
+
+    async def check_arouse(self, text: str) -> bool:
         prompt = await self.arouse_template.ainvoke({'input': text})
-        response = (await self.model.ainvoke(prompt)).content
+        async with self.limiter.slot(self.base_url, AROUSE):
+            response = await self.model.ainvoke(prompt)
+        record_model_usage(response, self.model.model)
+        response = response.content
         if '<think>' in response:
             think, response = DSR1CoTParser(response)
         logger.info(f'AI Arouse Check for "{response}"')
         return ('True' in response or 'true' in response)
+
+    async def check_arouse_batch(self, texts: list[str]) -> list[bool]:
+        if len(texts) == 1:
+            return [await self.check_arouse(texts[0])]
+
+        messages = '\n'.join(f'[{idx}] {text}' for idx, text in enumerate(texts, start=1))
+        prompt = await self.arouse_batch_template.ainvoke({'messages': messages})
+        async with self.limiter.slot(self.base_url, AROUSE):
+            response = await self.model.bind(format='json').ainvoke(prompt)
+        record_model_usage(response, self.model.model)
+        response = response.content
+        if '<think>' in response:
+            think, response = DSR1CoTParser(response)
+        logger.info(f'AI Arouse Batch Check for {len(texts)} messages "{response}"')
+
+        verdicts = parse_arouse_verdicts(response, len(texts))
+        if verdicts is None:
+            # 结构化输出解析失败时退回逐条判断
+            logger.warning('Arouse batch output is malformed, fallback to single check')
+            return list(await asyncio.gather(*(self.check_arouse(text) for text in texts)))
+        return verdicts
     
-    async def generate_digest(self, old_digest: str, event: MessageEvent):
+    async def generate_digest(self, old_digest: str, events: list[MessageEvent]):
+        '''将自上次摘要以来的消息合并进摘要'''
+        started = time.perf_counter()
         if old_digest.strip() == '':
             old_digest = '无'
+        if len(events) == 1:
+            msg_sender = events[0].sender.card
+            msg_content = events[0].message
+            msg_time = formatTime(events[0].time)
+        else:
+            msg_sender = '、'.join(dict.fromkeys(event.sender.card for event in events))
+            msg_content = '\n'.join(f'{event.sender.card}: {event.message}' for event in events)
+            msg_time = f'{formatTime(events[0].time)} ~ {formatTime(events[-1].time)}'
         prompt = await self.digest_template.ainvoke({
                                 'last_digest': old_digest,
-                                'msg_sender': event.sender.card,
-                                'msg_content': event.message,
-                                'msg_time': formatTime(event.time)
+                                'msg_sender': msg_sender,
+                                'msg_content': msg_content,
+                                'msg_time': msg_time
                                 })
-        response = (await self.model.ainvoke(prompt)).content
+        async with self.limiter.slot(self.base_url, DIGEST):
+            response = await self.model.ainvoke(prompt)
+        record_model_usage(response, self.model.model, f'group_{events[0].group_id}')
+        response = response.content
         if '<think>' in response:
             think, response = DSR1CoTParser(response)
         logger.info(f'AI Digest for "{response}"')
+        metrics.since('stage_seconds', started, stage='digest')
         return response
 
-    async def generate_image_digest(self, img_path: str):
+    async def close(self):
+        await self.image_processor.aclose()
+        self.image_cache.close()
+
+    async def summarize_history(self, old_summary: str, messages: list) -> str:
+        '''将移出上下文的对话合并进历史摘要'''
+        history = '\n'.join(f'{message.type}: {message.content}' for message in messages)
+        prompt = await self.summary_template.ainvoke({
+                                'last_summary': old_summary or '无',
+                                'history': history
+                                })
+        async with self.limiter.slot(self.base_url, REPLY):
+            # 在主模型节点内调用，不计入流式回复
+            response = await self.model.ainvoke(prompt, config={'tags': [TAG_NOSTREAM]})
+        record_model_usage(response, self.model.model)
+        response = response.content
+        if '<think>' in response:
+            think, response = DSR1CoTParser(response)
+        logger.info(f'AI History Summary for "{response}"')
+        return response.strip()
+
+    async def generate_image_digest(self, img_path: str, file_id: str = None):
+        started = time.perf_counter()
+        image = await self.image_processor.load(img_path, mode='local')
+        metrics.since('stage_seconds', started, stage='image_load')
+        sha = hashlib.sha256(image).hexdigest()
+        cached = await self.image_cache.get(sha=sha)
+        if cached is not None:
+            # 内容相同但文件 id 不同的图片，记录新的 id
+            await self.image_cache.put(cached, file_id=file_id)
+            return cached
 
         def prompt_func(data):
             text = data["text"]
@@ -249,10 +625,15 @@ class AshleyAIHelper:
 
             return [HumanMessage(content=content_parts)]
 
-        img_base64 = await convertToBase64(img_path, mode='local')
+        img_base64 = await self.image_processor.to_base64(image)
         chain = prompt_func | self.vision_model
-        result = chain.invoke({"text": self.vision_template, "image": img_base64})
+        async with self.limiter.slot(self.vision_url, VISION):
+            started = time.perf_counter()
+            result = await chain.ainvoke({"text": self.vision_template, "image": img_base64})
+            metrics.since('stage_seconds', started, stage='vision')
+        record_model_usage(result, self.vision_model.model)
         logger.info(f'AI Vision for "{result}"')
+        await self.image_cache.put(result.content, file_id=file_id, sha=sha)
         return result.content
 
 
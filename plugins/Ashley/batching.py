@@ -0,0 +1,68 @@
+import asyncio
+import time
+import structlog
+from plugins.Ashley.metrics import metrics
+
+logger = structlog.stdlib.get_logger()
+
+
+class MicroBatcher:
+    '''
+    将短时间窗口内的请求合并为一次批处理调用，再把结果分发给各个等待者
+
+    handler 接收一组输入，返回等长的结果列表。
+    窗口到期或达到 max_size 时立即提交当前批次。
+    '''
+    def __init__(self, handler, window: float = 0.2, max_size: int = 8, name: str = 'batch'):
+        self.handler = handler
+        self.window = window
+        self.max_size = max(1, max_size)
+        self.name = name
+        self.pending = []  # (item, future, 提交时间)
+        self.timer = None
+        self.running = set()  # 持有进行中的批处理任务，防止被回收
+
+    async def submit(self, item):
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self.pending.append((item, future, time.perf_counter()))
+
+        if len(self.pending) >= self.max_size:
+            self.flush()
+        elif self.timer is None:
+            self.timer = loop.call_later(self.window, self.flush)
+
+        return await future
+
+    def flush(self):
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+        if not self.pending:
+            return
+
+        batch, self.pending = self.pending, []
+        task = asyncio.create_task(self.run_batch(batch))
+        self.running.add(task)
+        task.add_done_callback(self.running.discard)
+
+    async def run_batch(self, batch):
+        metrics.observe(f'{self.name}_batch_size', len(batch))
+        started = time.perf_counter()
+        try:
+            results = await self.handler([item for item, _, _ in batch])
+            if len(results) != len(batch):
+                raise ValueError(f'{self.name} handler returned {len(results)} results for {len(batch)} items')
+        except Exception as e:
+            logger.exception(f'{self.name} batch of {len(batch)} failed')
+            for _, future, _ in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
+
+        finished = time.perf_counter()
+        for (_, future, submitted), result in zip(batch, results):
+            metrics.observe(f'{self.name}_latency', finished - submitted)
+            if not future.done():
+                future.set_result(result)
+        logger.info(f'{self.name} batch size={len(batch)} cost={round(finished - started, 3)}s')
@@ -0,0 +1,273 @@
+import asyncio
+import re
+import sqlite3
+import threading
+import time
+import unicodedata
+from collections import OrderedDict
+from plugins.Ashley.metrics import metrics
+
+# emoji 变体选择符、肤色修饰、零宽连接符等，去掉后同一个 emoji 的不同写法相同
+EMOJI_MODIFIERS = re.compile('[\ufe0e\ufe0f\u200d\u20e3\U0001f3fb-\U0001f3ff]')
+WHITESPACE = re.compile(r'\s+')
+# 连续重复三次以上的短片段(哈哈哈哈、+1+1+1、😂😂😂)折叠为两次
+REPEATS = re.compile(r'(.{1,4}?)\1{2,}')
+
+
+def normalize_text(text: str) -> str:
+    '''规范化群聊文本用于缓存：统一全半角和大小写，去掉空白和 emoji 修饰，折叠重复片段'''
+    text = unicodedata.normalize('NFKC', text).casefold()
+    text = EMOJI_MODIFIERS.sub('', text)
+    text = WHITESPACE.sub('', text)
+    return REPEATS.sub(r'\1\1', text)
+
+
+class LRUCache:
+    '''
+    带过期时间的内存 LRU 缓存，ttl 为 0 时不过期
+    '''
+    def __init__(self, max_entries: int = 512, ttl: float = 0):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.entries: OrderedDict = OrderedDict()  # key -> (value, 过期时间)
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, key, default=None):
+        item = self.entries.get(key)
+        if item is None:
+            return default
+        value, expires = item
+        if expires and expires < time.monotonic():
+            del self.entries[key]
+            self.evictions += 1
+            return default
+        self.entries.move_to_end(key)
+        return value
+
+    def put(self, key, value, ttl: float = None):
+        '''ttl 覆盖默认的过期时间，用于回填剩余有效期更短的条目'''
+        ttl = self.ttl if ttl is None else ttl
+        expires = time.monotonic() + ttl if ttl else 0
+        self.entries[key] = (value, expires)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+            self.evictions += 1
+
+    def clear(self):
+        self.entries.clear()
+
+
+class ComputeCancelled(Exception):
+    '''计算结果的请求被取消，等待同一结果的其他请求需要自己重新计算'''
+
+
+class VerdictCache:
+    '''
+    是否需要回复的判断结果缓存，以规范化后的文本为键
+
+    scope 为 group 时每个群单独缓存，为 global 时所有群共享。
+    相同文本的判断正在进行时，后来的请求等待同一个结果，不会重复调用模型。
+    '''
+    def __init__(self, max_entries: int = 2048, ttl: float = 600, scope: str = 'global', max_chars: int = 200):
+        self.memory = LRUCache(max_entries, ttl)
+        self.scope = scope
+        self.max_chars = max_chars
+        self.pending: dict = {}
+        self.stats = {'hit': 0, 'pending_hit': 0, 'miss': 0, 'skip': 0}
+
+    def record(self, name: str):
+        self.stats[name] += 1
+        metrics.inc(f'verdict_cache_{name}')
+
+    def key(self, text: str, group_id=None):
+        '''返回缓存键，文本过长不值得缓存时返回 None'''
+        normalized = normalize_text(text)
+        if len(normalized) > self.max_chars:
+            return None
+        return (group_id, normalized) if self.scope == 'group' else normalized
+
+    async def resolve(self, text: str, compute, group_id=None):
+        '''查找缓存，未命中时调用 compute() 并缓存结果'''
+        key = self.key(text, group_id)
+        if key is None or self.memory.max_entries <= 0:
+            self.record('skip')
+            return await compute()
+
+        verdict = self.memory.get(key)
+        if verdict is not None:
+            self.record('hit')
+            return verdict
+        future = self.pending.get(key)
+        if future is not None:
+            self.record('pending_hit')
+            try:
+                return await asyncio.shield(future)
+            except ComputeCancelled:
+                # 负责计算的请求被取消，不影响这里的等待者，重新查找并由其中一个接手计算
+                return await self.resolve(text, compute, group_id)
+
+        self.record('miss')
+        future = self.pending[key] = asyncio.get_running_loop().create_future()
+        try:
+            verdict = await compute()
+        except asyncio.CancelledError:
+            future.set_exception(ComputeCancelled())
+            future.exception()
+            raise
+        except Exception as e:
+            future.set_exception(e)
+            # 没有其他等待者时避免 "exception was never retrieved"
+            future.exception()
+            raise
+        else:
+            self.memory.put(key, verdict)
+            future.set_result(verdict)
+            return verdict
+        finally:
+            del self.pending[key]
+
+    def clear(self):
+        self.memory.clear()
+
+    def report(self) -> str:
+        lookups = self.stats['hit'] + self.stats['pending_hit'] + self.stats['miss']
+        hits = self.stats['hit'] + self.stats['pending_hit']
+        hit_rate = round(hits / lookups * 100, 2) if lookups else 0
+        return (f'hit rate: {hit_rate}% ({lookups} lookups, {self.stats["skip"]} not cached)\n'
+                f'hit: {self.stats["hit"]} in flight hit: {self.stats["pending_hit"]} miss: {self.stats["miss"]}\n'
+                f'entries: {len(self.memory)}/{self.memory.max_entries} ({self.scope}), evicted {self.memory.evictions}')
+
+
+class ImageDigestCache:
+    '''
+    图片描述缓存，同时以 OneBot 文件 id 和图片内容哈希为键
+
+    内存 LRU 在前，SQLite 持久化在后，重启后仍然有效。
+    磁盘数据按 TTL 过期，并在条目数超过 max_disk 时删除最久未访问的条目。
+    '''
+    def __init__(self, path: str = 'image_cache.db', max_memory: int = 512,
+                 max_disk: int = 20000, ttl: float = 7 * 24 * 3600):
+        self.memory = LRUCache(max_memory, ttl)
+        self.max_disk = max_disk
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        with self.lock, self.conn:
+            self.conn.execute('''CREATE TABLE IF NOT EXISTS images (
+                key TEXT PRIMARY KEY,
+                description TEXT NOT NULL,
+                created REAL NOT NULL,
+                accessed REAL NOT NULL)''')
+            self.conn.execute('CREATE INDEX IF NOT EXISTS images_accessed ON images (accessed)')
+        self.stats = {'memory_hit': 0, 'disk_hit': 0, 'miss': 0, 'store': 0, 'disk_evict': 0}
+        self.stores_since_cleanup = 0
+
+    @staticmethod
+    def keys(file_id: str = None, sha: str = None) -> list[str]:
+        keys = []
+        if file_id:
+            keys.append(f'file:{file_id}')
+        if sha:
+            keys.append(f'sha:{sha}')
+        return keys
+
+    def record(self, name: str):
+        self.stats[name] += 1
+        metrics.inc(f'image_cache_{name}')
+
+    def disk_get(self, key: str):
+        now = time.time()
+        with self.lock, self.conn:
+            row = self.conn.execute('SELECT description, created FROM images WHERE key = ?', (key,)).fetchone()
+            if row is None:
+                return None
+            if self.ttl and row[1] < now - self.ttl:
+                self.conn.execute('DELETE FROM images WHERE key = ?', (key,))
+                return None
+            self.conn.execute('UPDATE images SET accessed = ? WHERE key = ?', (now, key))
+            return row
+
+    def disk_put(self, keys: list[str], description: str, cleanup: bool):
+        now = time.time()
+        with self.lock, self.conn:
+            self.conn.executemany('INSERT OR REPLACE INTO images VALUES (?, ?, ?, ?)',
+                                  [(key, description, now, now) for key in keys])
+            if not cleanup:
+                return 0
+            evicted = 0
+            if self.ttl:
+                evicted += self.conn.execute('DELETE FROM images WHERE created < ?', (now - self.ttl,)).rowcount
+            count = self.conn.execute('SELECT COUNT(*) FROM images').fetchone()[0]
+            if count > self.max_disk:
+                evicted += self.conn.execute(
+                    'DELETE FROM images WHERE key IN (SELECT key FROM images ORDER BY accessed LIMIT ?)',
+                    (count - self.max_disk,)).rowcount
+            return evicted
+
+    async def get(self, file_id: str = None, sha: str = None, record_miss: bool = True):
+        '''
+        按文件 id 或内容哈希查找描述，命中磁盘时回填内存
+        只有文件 id 时未命中还要下载图片按哈希再查一次，record_miss 为 False 时不计为未命中，每张图片只统计一次
+        '''
+        keys = self.keys(file_id, sha)
+        for key in keys:
+            description = self.memory.get(key)
+            if description is not None:
+                self.record('memory_hit')
+                return description
+        for key in keys:
+            row = await asyncio.to_thread(self.disk_get, key)
+            if row is not None:
+                description, created = row
+                self.record('disk_hit')
+                # 内存中的条目和磁盘上的同时过期
+                ttl = max(self.ttl - (time.time() - created), 1e-3) if self.ttl else None
+                for alias in keys:
+                    self.memory.put(alias, description, ttl)
+                return description
+        if record_miss:
+            self.record('miss')
+        return None
+
+    async def put(self, description: str, file_id: str = None, sha: str = None):
+        keys = self.keys(file_id, sha)
+        if not keys:
+            return
+        for key in keys:
+            self.memory.put(key, description)
+        self.record('store')
+
+        self.stores_since_cleanup += 1
+        cleanup = self.stores_since_cleanup >= 100
+        if cleanup:
+            self.stores_since_cleanup = 0
+        evicted = await asyncio.to_thread(self.disk_put, keys, description, cleanup)
+        self.stats['disk_evict'] += evicted
+
+    def disk_size(self) -> int:
+        with self.lock:
+            return self.conn.execute('SELECT COUNT(*) FROM images').fetchone()[0]
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
+
+    async def clear(self):
+        self.memory.clear()
+
+        def clear_disk():
+            with self.lock, self.conn:
+                self.conn.execute('DELETE FROM images')
+        await asyncio.to_thread(clear_disk)
+
+    def report(self) -> str:
+        lookups = self.stats['memory_hit'] + self.stats['disk_hit'] + self.stats['miss']
+        hit_rate = round((lookups - self.stats['miss']) / lookups * 100, 2) if lookups else 0
+        return (f'hit rate: {hit_rate}% ({lookups} lookups)\n'
+                f'memory hit: {self.stats["memory_hit"]} disk hit: {self.stats["disk_hit"]} miss: {self.stats["miss"]}\n'
+                f'memory: {len(self.memory)} entries, evicted {self.memory.evictions}\n'
+                f'disk: {self.disk_size()} entries, evicted {self.stats["disk_evict"]}')
@@ -0,0 +1,355 @@
+import asyncio
+import time
+import httpx
+import structlog
+from plugins.Ashley.metrics import Histogram, metrics
+
+logger = structlog.stdlib.get_logger()
+
+
+class TimedStream(httpx.AsyncByteStream):
+    '''包装响应体，在流式响应读完关闭时记录总耗时'''
+    def __init__(self, stream: httpx.AsyncByteStream, on_close):
+        self.stream = stream
+        self.on_close = on_close
+
+    async def __aiter__(self):
+        async for chunk in self.stream:
+            yield chunk
+
+    async def aclose(self):
+        try:
+            await self.stream.aclose()
+        finally:
+            self.on_close()
+
+
+class EndpointStats:
+    '''单个接口(如 /api/chat)的请求计数和延迟'''
+    __slots__ = ('requests', 'errors', 'headers', 'total')
+
+    def __init__(self):
+        self.requests = 0
+        self.errors = 0
+        self.headers = Histogram()  # 收到响应头的耗时
+        self.total = Histogram()    # 读完响应体的耗时
+
+    def summary(self) -> dict:
+        return {'requests': self.requests, 'errors': self.errors,
+                'headers': self.headers.summary(), 'total': self.total.summary()}
+
+
+class InstrumentedTransport(httpx.AsyncHTTPTransport):
+    '''
+    同一主机的所有模型客户端共享的连接池，按接口统计请求数、错误数和延迟
+    '''
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self.endpoints: dict[str, EndpointStats] = {}
+        self.in_flight = 0
+
+    def endpoint(self, path: str) -> EndpointStats:
+        stats = self.endpoints.get(path)
+        if stats is None:
+            stats = self.endpoints[path] = EndpointStats()
+        return stats
+
+    async def handle_async_request(self, request: httpx.Request) -> httpx.Response:
+        stats = self.endpoint(request.url.path)
+        stats.requests += 1
+        self.in_flight += 1
+        started = time.perf_counter()
+        try:
+            response = await super().handle_async_request(request)
+        except Exception:
+            stats.errors += 1
+            self.in_flight -= 1
+            raise
+        stats.headers.observe(time.perf_counter() - started)
+        if response.status_code >= 400:
+            stats.errors += 1
+
+        def on_close():
+            self.in_flight -= 1
+            elapsed = time.perf_counter() - started
+            stats.total.observe(elapsed)
+            metrics.observe('ollama_request', elapsed)
+
+        response.stream = TimedStream(response.stream, on_close)
+        return response
+
+
+class OllamaHost:
+    '''一个 Ollama 服务地址的共享连接池、超时设置和健康状态'''
+    def __init__(self, base_url: str, max_connections: int = 8, max_keepalive: int = 4,
+                 keepalive_expiry: float = 300, connect_timeout: float = 5, timeout: float = 600):
+        self.base_url = base_url
+        self.timeout = httpx.Timeout(timeout, connect=connect_timeout)
+        self.transport = InstrumentedTransport(limits=httpx.Limits(max_connections=max_connections,
+                                                                   max_keepalive_connections=max_keepalive,
+                                                                   keepalive_expiry=keepalive_expiry))
+        self.client = httpx.AsyncClient(base_url=base_url, transport=self.transport, timeout=self.timeout)
+        self.healthy = None  # None 表示还没有探测过
+        self.version = None
+        self.last_probe = 0.0
+
+    def client_kwargs(self) -> dict:
+        '''传给 ChatOllama 的 client_kwargs，同步客户端不会被使用'''
+        return {'transport': self.transport, 'timeout': self.timeout}
+
+    async def probe(self, timeout: float = 5) -> bool:
+        '''请求 /api/version 检查服务是否可用'''
+        self.last_probe = time.monotonic()
+        try:
+            response = await self.client.get('/api/version', timeout=timeout)
+            response.raise_for_status()
+            self.version = response.json().get('version')
+            healthy = True
+        except (httpx.HTTPError, ValueError) as e:
+            logger.debug(f'Ollama health probe failed for {self.base_url}: {e}')
+            healthy = False
+        if healthy != self.healthy:
+            log = logger.info if healthy else logger.warning
+            log(f'Ollama {self.base_url} is {"up" if healthy else "down"}')
+        self.healthy = healthy
+        return healthy
+
+    def report(self) -> str:
+        state = {None: 'unknown', True: 'up', False: 'down'}[self.healthy]
+        lines = [f'{self.base_url} [{state}] version: {self.version} in flight: {self.transport.in_flight}']
+        for path, stats in self.transport.endpoints.items():
+            total = stats.total.summary()
+            lines.append(f'  {path}: {stats.requests} requests, {stats.errors} errors, '
+                         f'p50 {total.get("p50", 0)}s p95 {total.get("p95", 0)}s')
+        return '\n'.join(lines)
+
+    async def aclose(self):
+        await self.client.aclose()
+
+
+def parse_backends(value) -> list[tuple[str, float]]:
+    '''base_url 可以是一个地址、地址列表或 {url, weight} 列表，返回 [(地址, 权重)]'''
+    if isinstance(value, str):
+        return [(value, 1.0)]
+    backends = []
+    for item in value:
+        if isinstance(item, str):
+            backends.append((item, 1.0))
+        else:
+            backends.append((item['url'], float(item.get('weight', 1))))
+    return backends
+
+
+class Backend:
+    '''后端池中的一个 Ollama 服务，正在处理的请求数使用主机连接池的计数，其他角色发往同一主机的请求也计算在内'''
+    __slots__ = ('host', 'weight', 'routed', 'failures', 'errors', 'ejections', 'ejected_until')
+
+    def __init__(self, host: OllamaHost, weight: float = 1.0):
+        self.host = host
+        self.weight = weight
+        self.routed = 0
+        self.failures = 0 # 连续失败次数，成功后清零
+        self.errors = 0
+        self.ejections = 0 # 连续被移出的次数，用于延长移出时间
+        self.ejected_until = 0.0
+
+    def available(self, now: float) -> bool:
+        return self.host.healthy is not False and now >= self.ejected_until
+
+    def load(self) -> tuple:
+        '''按权重折算的负载，空闲时按已分配的请求数轮流'''
+        return ((self.host.transport.in_flight + 1) / self.weight, self.routed / self.weight)
+
+
+class RoutingTransport(httpx.AsyncBaseTransport):
+    '''
+    把请求分配给按权重折算后正在处理请求最少的后端
+
+    连接失败、超时或返回 502/503/504 计为失败，连续失败 eject_after 次的后端移出 eject_seconds 秒，
+    再次被移出时时间加倍(不超过 max_eject_seconds)，到期后重新接收请求，成功一次即恢复。
+    健康探测失败的后端同样不分配请求。连接没有建立或服务暂时不可用时最多换 retries 个后端重试，
+    已经开始处理的请求不重试。所有后端都不可用时选择最早到期的后端。
+    '''
+    RETRY_STATUS = {502, 503, 504}
+
+    def __init__(self, backends: list[Backend], eject_after: int = 2, eject_seconds: float = 10,
+                 max_eject_seconds: float = 300, retries: int = 1):
+        self.backends = backends
+        self.eject_after = eject_after
+        self.eject_seconds = eject_seconds
+        self.max_eject_seconds = max_eject_seconds
+        self.retries = retries
+
+    def choose(self, tried: list[Backend]) -> Backend:
+        now = time.monotonic()
+        candidates = [backend for backend in self.backends if backend not in tried] or self.backends
+        available = [backend for backend in candidates if backend.available(now)]
+        if not available:
+            return min(candidates, key=lambda backend: backend.ejected_until)
+        return min(available, key=Backend.load)
+
+    def succeed(self, backend: Backend):
+        backend.failures = 0
+        backend.ejections = 0
+        backend.ejected_until = 0.0
+
+    def fail(self, backend: Backend, reason: str):
+        backend.failures += 1
+        backend.errors += 1
+        metrics.inc('backend_failures', backend=backend.host.base_url)
+        # 并发的请求在移出前已经发出，它们的失败不再延长移出时间
+        if backend.failures < self.eject_after or time.monotonic() < backend.ejected_until:
+            return
+        seconds = min(self.max_eject_seconds, self.eject_seconds * 2 ** backend.ejections)
+        backend.ejections += 1
+        backend.failures = 0
+        backend.ejected_until = time.monotonic() + seconds
+        metrics.inc('backend_ejections', backend=backend.host.base_url)
+        logger.warning(f'Eject Ollama backend {backend.host.base_url} for {seconds:.0f}s: {reason}')
+
+    async def handle_async_request(self, request: httpx.Request) -> httpx.Response:
+        tried = []
+        while True:
+            backend = self.choose(tried)
+            tried.append(backend)
+            target = httpx.URL(backend.host.base_url)
+            request.url = request.url.copy_with(scheme=target.scheme, host=target.host, port=target.port)
+            request.headers['Host'] = target.netloc.decode('ascii')
+            backend.routed += 1
+            metrics.inc('backend_requests', backend=backend.host.base_url)
+            retry = len(tried) <= self.retries and len(tried) < len(self.backends)
+            try:
+                response = await backend.host.transport.handle_async_request(request)
+            except (httpx.ConnectError, httpx.ConnectTimeout) as e:
+                self.fail(backend, repr(e))
+                if retry:
+                    continue
+                raise
+            except httpx.TransportError as e:
+                self.fail(backend, repr(e))
+                raise
+            if response.status_code in self.RETRY_STATUS:
+                self.fail(backend, f'HTTP {response.status_code}')
+                if retry:
+                    await response.aclose()
+                    continue
+                return response
+            self.succeed(backend)
+            return response
+
+
+class OllamaPool:
+    '''同一角色的多个 Ollama 服务，name 是各地址用逗号连接，用作排队和预加载的键'''
+    def __init__(self, name: str, backends: list[Backend], **routing):
+        self.name = name
+        self.backends = backends
+        self.transport = RoutingTransport(backends, **routing)
+
+    @property
+    def hosts(self) -> list[OllamaHost]:
+        return [backend.host for backend in self.backends]
+
+    def set_weights(self, weights: list[float]):
+        for backend, weight in zip(self.backends, weights):
+            backend.weight = weight
+
+    def client_kwargs(self) -> dict:
+        return {'transport': self.transport, 'timeout': self.backends[0].host.timeout}
+
+    def report(self) -> str:
+        now = time.monotonic()
+        lines = [f'pool {self.name}']
+        for backend in self.backends:
+            if backend.available(now):
+                state = 'up'
+            elif now < backend.ejected_until:
+                state = f'ejected {backend.ejected_until - now:.0f}s'
+            else:
+                state = 'down'
+            lines.append(f'  {backend.host.base_url} [{state}] weight {backend.weight:g} '
+                         f'in flight {backend.host.transport.in_flight} routed {backend.routed} errors {backend.errors}')
+        return '\n'.join(lines)
+
+
+class OllamaClientRegistry:
+    '''
+    按 base_url 共享的 Ollama 客户端，主模型、辅助模型和视觉模型在同一主机上复用连接池
+
+    hosts 中可以按地址覆盖默认的连接数和超时设置，health_interval 秒探测一次服务状态，0 为不探测。
+    配置了多个地址的角色使用后端池，routing 为 RoutingTransport 的参数；
+    对话线程只保存在本地的检查点中，与处理请求的后端无关。
+    '''
+    def __init__(self, health_interval: float = 30, hosts: dict = None, routing: dict = None, **defaults):
+        self.defaults = defaults
+        self.overrides = hosts or {}
+        self.routing = routing or {}
+        self.health_interval = health_interval
+        self.hosts: dict[str, OllamaHost] = {}
+        self.pools: dict[str, OllamaPool] = {}
+        self.task = None
+
+    def host(self, base_url: str) -> OllamaHost:
+        host = self.hosts.get(base_url)
+        if host is None:
+            host = self.hosts[base_url] = OllamaHost(base_url, **{**self.defaults, **self.overrides.get(base_url, {})})
+        return host
+
+    def endpoint(self, base_url) -> str:
+        '''解析 base_url 配置，返回用于排队和预加载的键，多个地址时创建或更新后端池'''
+        backends = parse_backends(base_url)
+        if len(backends) == 1:
+            self.host(backends[0][0])
+            return backends[0][0]
+        name = ','.join(url for url, _ in backends)
+        pool = self.pools.get(name)
+        if pool is None:
+            pool = self.pools[name] = OllamaPool(name, [Backend(self.host(url), weight) for url, weight in backends],
+                                                 **self.routing)
+        else:
+            pool.set_weights([weight for _, weight in backends])
+        return name
+
+    def backends(self, endpoint: str) -> list[OllamaHost]:
+        pool = self.pools.get(endpoint)
+        return pool.hosts if pool is not None else [self.host(endpoint)]
+
+    def backend_count(self, endpoint: str) -> int:
+        pool = self.pools.get(endpoint)
+        return len(pool.backends) if pool is not None else 1
+
+    def chat_model(self, base_url: str, **kwargs):
+        '''创建使用共享连接池的 ChatOllama，后端池的请求由 RoutingTransport 改写到选中的后端'''
+        from langchain_ollama import ChatOllama # 第一次创建模型时才导入
+        pool = self.pools.get(base_url)
+        if pool is not None:
+            return ChatOllama(base_url=pool.hosts[0].base_url, client_kwargs=pool.client_kwargs(), **kwargs)
+        return ChatOllama(base_url=base_url, client_kwargs=self.host(base_url).client_kwargs(), **kwargs)
+
+    async def probe_all(self) -> dict[str, bool]:
+        hosts = list(self.hosts.values())
+        results = await asyncio.gather(*(host.probe() for host in hosts))
+        return {host.base_url: result for host, result in zip(hosts, results)}
+
+    async def run_probes(self):
+        while True:
+            await self.probe_all()
+            await asyncio.sleep(self.health_interval)
+
+    def start(self):
+        if self.task is None and self.health_interval > 0:
+            self.task = asyncio.get_running_loop().create_task(self.run_probes())
+
+    def report(self) -> str:
+        lines = [host.report() for host in self.hosts.values()] + [pool.report() for pool in self.pools.values()]
+        return '\n'.join(lines) or 'no clients'
+
+    async def close(self):
+        if self.task is not None:
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+            self.task = None
+        for host in self.hosts.values():
+            await host.aclose()
@@ -1,40 +1,129 @@
+import asyncio
+import os
+import orjson
+import structlog
 import yaml
-import json
+
+logger = structlog.stdlib.get_logger()
+
 
 class AshleyConfig(dict):
-    def __init__(self, path='config.yaml'):
+    '''
+    配置和运行时状态，持久化到 db.json
+
+    修改后只标记为脏，在 flush_delay 秒后合并为一次写入，在线程中完成，
+    先写临时文件再重命名，写入过程中崩溃不会损坏原文件。
+    没有运行中的事件循环时立即同步写入。
+    '''
+    def __init__(self, path='config.yaml', db_path='db.json', flush_delay: float = 1.0):
         super().__init__()
+        # 内部属性不写入配置
+        object.__setattr__(self, 'path', path)
+        object.__setattr__(self, 'db_path', db_path)
+        object.__setattr__(self, 'flush_delay', flush_delay)
+        object.__setattr__(self, 'dirty', False)
+        object.__setattr__(self, 'flush_handle', None)
+        object.__setattr__(self, 'flush_task', None)
+        object.__setattr__(self, 'stats', {'flushes': 0, 'bytes': 0, 'errors': 0})
+        self.load()
 
+    def load(self):
         # 优先加载上一次的配置
         try:
-            with open('db.json', 'r') as db:
-                self.update(json.load(db))
+            with open(self.db_path, 'rb') as db:
+                self.update(orjson.loads(db.read()))
         except FileNotFoundError:
-            json.dump({}, open('db.json', 'w'))
-        except json.JSONDecodeError:
             pass
+        except orjson.JSONDecodeError:
+            logger.warning(f'Ignore broken {self.db_path}')
 
         # 加载用户配置覆盖过时的配置
-        with open('config.yaml', 'r') as conf:
+        with open(self.path, 'r') as conf:
             self.update(yaml.safe_load(conf))
 
         # 保存配置
-        json.dump(self, open('db.json', 'w'))
+        self.mark_dirty()
 
     def reload(self):
-        self.__init__()
+        self.load()
 
     def __getattr__(self, item):
         return self[item]
-    
+
     def __setattr__(self, key, value):
         self[key] = value
-        json.dump(self, open('db.json', 'w'))
+        self.mark_dirty()
 
     def get(self, key, default=None):
         '''获取配置若不存在则返回默认值，并且保存配置'''
         value = super().get(key, default)
-        if value is default:
+        if value is default and key not in self:
             self[key] = default
-            json.dump(self, open('db.json', 'w'))
-        return value
\ No newline at end of file
+            self.mark_dirty()
+        return value
+
+    def mark_dirty(self):
+        '''标记配置已修改，稍后合并写入'''
+        object.__setattr__(self, 'dirty', True)
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            self.flush()
+            return
+        if self.flush_handle is None:
+            object.__setattr__(self, 'flush_handle', loop.call_later(self.flush_delay, self.schedule_flush))
+
+    def schedule_flush(self):
+        object.__setattr__(self, 'flush_handle', None)
+        if self.flush_task is not None and not self.flush_task.done():
+            # 上一次写入还没完成，稍后再写
+            self.mark_dirty()
+            return
+        object.__setattr__(self, 'flush_task', asyncio.get_running_loop().create_task(self.aflush()))
+
+    def serialize(self) -> bytes:
+        # yaml 中的整数键(如表情 id)按 json 的规则转为字符串
+        return orjson.dumps(self, option=orjson.OPT_NON_STR_KEYS)
+
+    def write(self, data: bytes):
+        tmp_path = f'{self.db_path}.tmp'
+        with open(tmp_path, 'wb') as db:
+            db.write(data)
+            db.flush()
+            os.fsync(db.fileno())
+        os.replace(tmp_path, self.db_path)
+        self.stats['flushes'] += 1
+        self.stats['bytes'] += len(data)
+
+    def flush(self):
+        '''同步写入，用于没有事件循环和退出时'''
+        if not self.dirty:
+            return
+        object.__setattr__(self, 'dirty', False)
+        self.write(self.serialize())
+
+    async def aflush(self):
+        '''在事件循环中序列化，在线程中写入'''
+        if not self.dirty:
+            return
+        object.__setattr__(self, 'dirty', False)
+        data = self.serialize()
+        try:
+            await asyncio.to_thread(self.write, data)
+        except OSError as e:
+            self.stats['errors'] += 1
+            logger.error(f'Failed to save {self.db_path}: {e}')
+            self.mark_dirty()
+
+    async def close(self):
+        '''取消等待中的写入并立即保存'''
+        if self.flush_handle is not None:
+            self.flush_handle.cancel()
+            object.__setattr__(self, 'flush_handle', None)
+        if self.flush_task is not None:
+            await self.flush_task
+        await self.aflush()
+
+    def report(self) -> str:
+        return (f'flushes: {self.stats["flushes"]} bytes: {self.stats["bytes"]} '
+                f'errors: {self.stats["errors"]} dirty: {self.dirty}')
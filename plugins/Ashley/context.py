@@ -0,0 +1,85 @@
+from collections import OrderedDict
+from langchain_core.messages import BaseMessage, HumanMessage
+
+
+def estimate_tokens(text: str) -> int:
+    '''
+    粗略估算 token 数：中日韩字符约一个字一个 token，其余约四个字符一个 token
+    '''
+    wide = sum(1 for ch in text if ord(ch) >= 0x2E80)
+    return wide + (len(text) - wide + 3) // 4
+
+
+class TokenCounter:
+    '''
+    按消息 id 缓存的 token 计数，历史消息只在第一次出现时计算
+    '''
+    # 每条消息的角色、分隔符等额外开销
+    MESSAGE_OVERHEAD = 4
+
+    def __init__(self, max_entries: int = 4096):
+        self.cache: OrderedDict[str, int] = OrderedDict()
+        self.max_entries = max_entries
+
+    def count_text(self, text: str) -> int:
+        return estimate_tokens(text) + self.MESSAGE_OVERHEAD
+
+    def count(self, message: BaseMessage) -> int:
+        key = message.id
+        if key is not None and key in self.cache:
+            self.cache.move_to_end(key)
+            return self.cache[key]
+
+        content = message.content if isinstance(message.content, str) else str(message.content)
+        tokens = self.count_text(content)
+        if key is not None:
+            self.cache[key] = tokens
+            if len(self.cache) > self.max_entries:
+                self.cache.popitem(last=False)
+        return tokens
+
+
+class ContextAssembler:
+    '''
+    在 token 预算内组装上下文：系统提示词和最新的若干轮对话总是保留，
+    超出预算时把更早的对话移出，交给摘要保存。
+
+    超出 budget 后会一次裁剪到 low_water 以下，避免每轮都触发摘要。
+    '''
+    def __init__(self, context_win: int, fraction: float = 0.75, low_fraction: float = 0.5,
+                 counter: TokenCounter = None):
+        self.fraction = fraction
+        self.low_fraction = low_fraction
+        self.resize(context_win)
+        self.counter = counter or TokenCounter()
+
+    def resize(self, context_win: int):
+        self.context_win = context_win
+        self.budget = int(context_win * self.fraction)
+        self.low_water = int(context_win * min(self.low_fraction, self.fraction))
+
+    def history_tokens(self, messages: list[BaseMessage]) -> int:
+        return sum(self.counter.count(message) for message in messages)
+
+    def assemble(self, fixed_tokens: int, messages: list[BaseMessage]) -> tuple[list, list]:
+        '''
+        fixed_tokens 为系统提示词、摘要等固定部分的 token 数
+        返回 (保留的消息, 需要移出的旧消息)，移出总是在某条用户消息之前截断
+        '''
+        if fixed_tokens + self.history_tokens(messages) <= self.budget:
+            return messages, []
+
+        target = self.low_water - fixed_tokens
+        used = 0
+        keep_from = len(messages)
+        for idx in range(len(messages) - 1, -1, -1):
+            used += self.counter.count(messages[idx])
+            if not isinstance(messages[idx], HumanMessage):
+                continue
+            # 至少保留最新的一轮
+            if keep_from < len(messages) and used > target:
+                break
+            keep_from = idx
+        if keep_from == len(messages):
+            return messages, []
+        return messages[keep_from:], messages[:keep_from]
@@ -1,43 +1,38 @@
+from plugins.Ashley.startup import IMPORT_STARTED
+import time
+import asyncio
+import importlib
 from dataclasses import dataclass
-from email import message
-import random
-from attr import has
 import structlog
 from alicebot import Event, MessageEvent, Plugin
 from alicebot.adapter.cqhttp.message import CQHTTPMessageSegment, CQHTTPMessage
-from langchain_core.messages import HumanMessage, AIMessage
-from plugins.Ashley.ai import AshleyAIGraph, AshleyAIHelper
+from plugins.Ashley.clients import OllamaClientRegistry
 from plugins.Ashley.config import AshleyConfig
-from plugins.Ashley.utils import execute_method, fromOneBot, gather_method_with, hasImage, isAtAll, isAtMe, isGroup, isMessageEvent, isNoticeEvent, isPM, isPokeMe, isPokeNotify
+from plugins.Ashley.digest import DigestService
+from plugins.Ashley.gate import GateEngine
+from plugins.Ashley.lifecycle import ModelLifecycle
+from plugins.Ashley.metrics import MetricsExporter, metrics
+from plugins.Ashley.pipeline import DROP_OLDEST, MERGE, GroupPipeline
+from plugins.Ashley.reload import ConfigReloader
+from plugins.Ashley.scheduler import RequestScheduler
+from plugins.Ashley.session import GroupChatSession, SessionStore
+from plugins.Ashley.shedding import LoadShedder
+from plugins.Ashley.utils import execute_method, fromOneBot, gather_method_with, hasImage, isAtMe, isGroup, isMessageEvent, isNoticeEvent, isPM, isPokeMe, isPokeNotify
 import re
-import psutil
 
+# langchain、langgraph 等依赖在模型第一次使用或后台预热时才导入
+# httpx 仍在启动时导入：连接池在创建 Ashley 时建立，启动后立即开始健康检查和模型预加载
+AI_MODULE = 'plugins.Ashley.ai'
+IMPORT_SECONDS = time.perf_counter() - IMPORT_STARTED
 
-logger = structlog.stdlib.get_logger()
-
-@dataclass
-class GroupChatSession:
-    group_id: str
-    group_thread_id: str # 对话主题ID，可用于合并群聊
-    last_active_event: Event # 上次新的事件
-    last_trigger_msg: MessageEvent # 上册触发对话的消息事件
-    last_active_msg: MessageEvent # 上次有新消息的消息事件
-    messages_digest: str # 上次回复至当前的对话摘要
-    avg_msg_interval: float  # 由每次新对话间隔加权计算的平均消息间隔(秒)
-
-    def update_avg_msg_interval(self, current_event_time: int, alpha: float):
-        if self.last_active_msg is None:
-            return
-        interval = current_event_time - self.last_active_msg.time
-        if self.avg_msg_interval == float('inf'):
-            self.avg_msg_interval = interval
-        else:
-            self.avg_msg_interval = (1 - alpha) * self.avg_msg_interval + alpha * interval
 
+logger = structlog.stdlib.get_logger()
 
 # Ashley Core
 class Ashley:
     def __init__(self, config: AshleyConfig=None, **kwargs):
+        started = time.perf_counter()
+        self.startup = {'import': IMPORT_SECONDS} # 启动各阶段耗时(秒)
         self.permissions = gather_method_with(self, 'permissions_')
         self.manage_cmd = gather_method_with(self, 'manage_')
         self.config = config
@@ -45,35 +40,181 @@ class Ashley:
         self.wheel = set(self.config.get('wheel', default=[]))
         self.group_whitelist = set(self.config.get('group_whitelist', default=[]))
 
-        self.group_chat_session = dict() # group_id to uuid
+        # 指标统计，关闭后记录的开销可以忽略
+        metrics_config = config.Ashley.get('Metrics', {})
+        metrics.enabled = bool(metrics_config.get('enable', True))
+        self.metrics_exporter = MetricsExporter(metrics, path=metrics_config.get('path', 'metrics.prom'),
+                                                interval=float(metrics_config.get('interval', 15)))
+
+        # 主模型、辅助模型和视觉模型按地址共享连接池，配置了多个地址的角色按负载分配到各后端
+        self.clients = OllamaClientRegistry(**config.Ashley.get('Clients', {}))
+
+        pipeline_config = config.Ashley.get('Pipeline', {})
+        # 同一模型服务的请求按优先级排队：回复 > 图片描述 > 回复判断 > 摘要
+        self.limiter = RequestScheduler(default=int(pipeline_config.get('endpoint_concurrency', 2)),
+                                        limits=pipeline_config.get('endpoints', {}),
+                                        aging=float(pipeline_config.get('priority_aging', 5.0)),
+                                        backends=self.clients.backend_count)
+
+        # 模型排队过久时降低随机回复概率并跳过可选的摘要和图片描述，回复数量由令牌桶限制
+        self.shedder = LoadShedder(self.limiter, config.Ashley.get('Shedding', {}))
+
+        # 模型创建时登记，启动后在后台预加载，按策略设置 keep_alive 并在被卸载后重新加载
+        self.lifecycle = ModelLifecycle(self.clients, config.Ashley.get('Lifecycle', {}))
 
-        self.ai_helper = AshleyAIHelper(config=config)
-        self.ai = AshleyAIGraph(
+        # 模型客户端和 langgraph 工作流在第一次使用时创建，warm_up 开启时连接后在后台预先创建
+        self.models = None # (AshleyAIHelper, AshleyAIGraph)
+        self.warm_up = bool(config.Ashley.get('warm_up', True))
+        self.warm_task = None
+
+        self.group_active_time_beta = float(config.Ashley['group_active_beta'])
+        self.group_active_threshold = float(config.Ashley['group_active_threshold'])
+        self.group_active_engage = float(config.Ashley['group_active_engage'])
+        # 规则判断是否回复，只有规则无法决定的消息才调用辅助模型
+        self.gate = GateEngine(config.Ashley.get('Gate', {}),
+                               active_threshold=self.group_active_threshold,
+                               active_engage=self.group_active_engage)
+
+        digest_config = config.Ashley['Helper']
+        self.digest = DigestService(self.generate_digest,
+                                    debounce=float(digest_config.get('digest_debounce', 3.0)),
+                                    max_delay=float(digest_config.get('digest_max_delay', 30.0)),
+                                    max_pending=int(digest_config.get('digest_queue_size', 64)))
+
+        # 群聊会话只保存判断回复所需的字段，空闲或超出上限时移入 SQLite
+        sessions_config = config.Ashley.get('Sessions', {})
+        self.group_chat_session = SessionStore(path=sessions_config.get('path', 'sessions.db'),
+                                               max_sessions=int(sessions_config.get('max_sessions', 1024)),
+                                               max_bytes=int(sessions_config.get('max_bytes', 4 * 1024 * 1024)),
+                                               idle_ttl=float(sessions_config.get('idle_ttl', 3600)),
+                                               snapshot_interval=float(sessions_config.get('snapshot_interval', 60)),
+                                               can_evict=self.digest.release)
+
+        self.pipeline = self.build_pipeline(pipeline_config.get('stages', {}))
+
+        # 按 config.yaml 的变化重载改变的部分，hot_reload 开启时监视文件，否则只由 !reload 触发
+        self.reloader = ConfigReloader(self)
+        self.hot_reload = bool(config.Ashley.get('hot_reload', True))
+        self.record_startup('construct', started)
+
+    def start(self):
+        '''在事件循环中启动后台任务'''
+        self.clients.start()
+        self.lifecycle.start()
+        self.group_chat_session.start()
+        if metrics.enabled:
+            self.metrics_exporter.start()
+        if self.hot_reload:
+            self.reloader.start()
+        if self.warm_up and self.models is None:
+            self.warm_task = asyncio.get_running_loop().create_task(self.warm_up_models())
+
+    def record_startup(self, phase: str, started: float):
+        elapsed = time.perf_counter() - started
+        self.startup[phase] = elapsed
+        metrics.observe('startup_seconds', elapsed, phase=phase)
+
+    def build_models(self):
+        '''导入模型相关模块并创建辅助模型、主模型和 langgraph 工作流'''
+        started = time.perf_counter()
+        ai = importlib.import_module(AI_MODULE)
+        self.record_startup('ai_import', started)
+
+        started = time.perf_counter()
+        helper = ai.AshleyAIHelper(config=self.config, limiter=self.limiter, clients=self.clients,
+                                   lifecycle=self.lifecycle)
+        graph = ai.AshleyAIGraph(
             config=self.config,
-            helper=self.ai_helper,
+            helper=helper,
+            limiter=self.limiter,
+            clients=self.clients,
+            lifecycle=self.lifecycle,
             model=self.config.Ashley['Parameters']['model'],
             prompt=self.config.Ashley['Prompt'],
             base_url=self.config.Ashley['Parameters']['base_url'],
-            express_data=self.config.Express 
+            context_win=int(self.config.Ashley['Parameters'].get('context_win', 4096)),
+            express_data=self.express_data(),
+            on_sent=self.gate.remember_sent
         )
-        self.group_active_time_beta = float(config.Ashley['group_active_beta'])
-        self.group_active_threshold = float(config.Ashley['group_active_threshold'])
-        self.group_active_engage = float(config.Ashley['group_active_engage'])
+        self.models = (helper, graph)
+        self.record_startup('ai_build', started)
+        logger.info('Models ready: ' + ', '.join(f'{phase} {seconds * 1000:.1f}ms'
+                                                  for phase, seconds in self.startup.items()))
+
+    async def load_models(self):
+        '''返回 (辅助模型, 主模型)，预热还没有完成时等待预热，没有预热时在后台导入依赖后创建'''
+        if self.models is None:
+            if self.warm_task is None or self.warm_task.done():
+                self.warm_task = asyncio.get_running_loop().create_task(self.warm_up_models())
+            # 等待的请求被取消时不影响预热
+            await asyncio.shield(self.warm_task)
+            if self.models is None:
+                raise RuntimeError('Models are not available, see the warm up error above')
+        return self.models
+
+    async def warm_up_models(self):
+        '''在线程中导入依赖，避免阻塞事件循环，然后创建模型'''
+        started = time.perf_counter()
+        try:
+            await asyncio.to_thread(importlib.import_module, AI_MODULE)
+            if self.models is None:
+                self.build_models()
+        except Exception:
+            logger.exception('Model warm up failed, will retry on first use')
+            return
+        self.record_startup('warm_up', started)
 
-    def get_group_chat_session(self, group_id: str) -> GroupChatSession:
-        if group_id in self.group_chat_session:
-            return self.group_chat_session[group_id]
-        else:
-            self.group_chat_session[group_id] = GroupChatSession(
-                group_id=group_id,
-                group_thread_id='main',
-                last_trigger_msg=None,
-                last_active_msg=None,
-                last_active_event=None,
-                messages_digest='',
-                avg_msg_interval=float('inf')
-            )
-            return self.group_chat_session[group_id]
+    async def get_ai_helper(self):
+        return (await self.load_models())[0]
+
+    async def get_ai(self):
+        return (await self.load_models())[1]
+
+    async def generate_digest(self, old_digest: str, events: list):
+        return await (await self.get_ai_helper()).generate_digest(old_digest, events)
+
+    def express_data(self) -> dict:
+        return self.config['Express'] if 'Express' in self.config else self.config.get('ExpressData', {})
+
+    def build_pipeline(self, stages_config: dict) -> GroupPipeline:
+        '''
+        ingest 更新会话 -> gate 判断是否回复 -> enrich 处理图片并整理输入 -> generate 调用主模型 -> send 发送回复
+        '''
+        pipeline = GroupPipeline()
+        stages = [
+            # 阶段名, 处理函数, 默认队列长度, 默认策略, 合并函数, 丢弃时的结果
+            ('ingest', self.update_group_chat_session, 256, DROP_OLDEST, None, None),
+            ('gate', self.gate_group_message, 32, DROP_OLDEST, None, False),
+            ('enrich', self.enrich_group_message, 4, DROP_OLDEST, None, None),
+            ('generate', self.generate_group_reply, 2, MERGE, self.merge_group_reply, None),
+            ('send', self.send_group_reply, 16, DROP_OLDEST, None, None),
+        ]
+        for name, handler, queue_size, policy, merge, dropped in stages:
+            stage_config = stages_config.get(name, {})
+            pipeline.add_stage(name, handler,
+                               queue_size=int(stage_config.get('queue_size', queue_size)),
+                               policy=stage_config.get('policy', policy),
+                               merge=merge, dropped=dropped)
+        return pipeline
+
+    async def close(self):
+        '''退出时释放连接和文件'''
+        await self.reloader.stop()
+        if self.warm_task is not None and not self.warm_task.done():
+            self.warm_task.cancel()
+        if self.models is not None:
+            await self.models[0].close()
+        await self.lifecycle.close()
+        await self.clients.close()
+        if self.models is not None:
+            self.models[1].memory.close()
+        await self.group_chat_session.close()
+        await self.config.close()
+        # 最后导出，包含关闭过程中的指标，写入失败也不影响会话和配置的保存
+        await self.metrics_exporter.close()
+
+    async def get_group_chat_session(self, group_id: str) -> GroupChatSession:
+        return await self.group_chat_session.get(group_id)
 
     async def has_pemission(self, action, **kwargs) -> bool:
         return await execute_method(self.permissions[action], kwargs)
@@ -110,6 +251,7 @@ class Ashley:
 
     async def manage_ps(self, **kwargs):
         """显示宿主机负载 参数： all 显示详细信息"""
+        import psutil
         args = kwargs['args']
         load = [round(load, 2) for load in psutil.getloadavg()]
         temp = {key: item[0].current for key, item in psutil.sensors_temperatures().items()}
@@ -165,11 +307,15 @@ Misc: BAT: {round(psutil.sensors_battery().percent, 2)}% Temp: {temp}'''
         await event.reply(f"已启用的群聊：{self.group_whitelist}")
 
     async def manage_info(self, event: MessageEvent=None, args: list[str]=None, **kwargs):
-        """显示当前配置 参数: all model prompt"""
+        """显示当前配置 参数: all model prompt token db"""
+        ai = await self.get_ai()
         info = {
             'model': self.config.Ashley['Parameters']['model'],
             'prompt': self.config.Ashley['Prompt'],
-            'token': await self.ai.get_token_usage(event=event),
+            'token': await ai.get_token_usage(event=event,
+                                              chat_session=(await self.get_group_chat_session(event.group_id)).group_thread_id
+                                              if isGroup(event) else 'main'),
+            'db': self.config.report(),
         }
 
         # unique the args
@@ -185,7 +331,7 @@ Misc: BAT: {round(psutil.sensors_battery().percent, 2)}% Temp: {temp}'''
 
     async def manage_inspect(self, event: MessageEvent=None, **kwargs):
         """显示 langgraph image"""
-        url = self.ai.render_image()
+        url = (await self.get_ai()).render_image()
         msg = CQHTTPMessageSegment.image(url)
         await event.reply(msg)
 
@@ -194,60 +340,174 @@ Misc: BAT: {round(psutil.sensors_battery().percent, 2)}% Temp: {temp}'''
         await event.adapter.clean_cache()
         await event.reply("已清理缓存")
 
+    async def manage_reload(self, event: MessageEvent=None, **kwargs):
+        """重新加载 config.yaml 中改变的配置"""
+        started = time.perf_counter()
+        changes = await self.reloader.reload()
+        if not changes:
+            await event.reply("配置没有变化")
+            return
+        paths = '\n'.join('.'.join(map(str, path)) for path in changes)
+        await event.reply(f"已重新加载 ({(time.perf_counter() - started) * 1000:.1f}ms):\n{paths}")
+
+    async def manage_clients(self, event: MessageEvent=None, args: list[str]=None, **kwargs):
+        """显示模型服务的连接和请求统计 参数: probe 立即探测服务状态"""
+        if args and 'probe' in args:
+            await self.clients.probe_all()
+        await event.reply(f'{self.clients.report()}\n{self.limiter.report()}')
+
+    async def manage_arouse_cache(self, event: MessageEvent=None, args: list[str]=None, **kwargs):
+        """显示回复判断缓存命中情况 参数: clear 清空缓存"""
+        helper = await self.get_ai_helper()
+        if args and 'clear' in args:
+            helper.verdict_cache.clear()
+            await event.reply("已清空回复判断缓存")
+            return
+        await event.reply(helper.verdict_cache.report())
+
+    async def manage_stats(self, event: MessageEvent=None, args: list[str]=None, **kwargs):
+        """显示各阶段耗时和 token 统计 参数: 名称过滤 或 reset 清空统计"""
+        if args and 'reset' in args:
+            metrics.reset()
+            await event.reply("已清空统计")
+            return
+        if not metrics.enabled:
+            await event.reply("统计未启用")
+            return
+        snapshot = metrics.snapshot()
+        lines = []
+        for name, summary in snapshot['histograms'].items():
+            if args and not any(arg in name for arg in args):
+                continue
+            if summary['count']:
+                lines.append(f'{name}: n={summary["count"]} p50={summary["p50"]} p95={summary["p95"]} p99={summary["p99"]}')
+        for name, value in snapshot['counters'].items():
+            if args and not any(arg in name for arg in args):
+                continue
+            if not args and not name.startswith(('tokens_', 'model_calls')):
+                continue # 默认只显示 token 计数
+            lines.append(f'{name}: {value:g}')
+        await event.reply('\n'.join(lines) or '暂无统计')
+
+    async def manage_memory(self, event: MessageEvent=None, **kwargs):
+        """显示进程内存和群聊会话占用"""
+        import psutil
+        rss = psutil.Process().memory_info().rss / 1024 / 1024
+        await event.reply(f'RSS: {rss:.1f}MiB\n'
+                          f'{await self.group_chat_session.report()}\n'
+                          f'digest workers: {len(self.digest.workers)}')
+
+    async def manage_gate(self, event: MessageEvent=None, **kwargs):
+        """显示回复判断的原因统计和本群的消息速率"""
+        session = await self.get_group_chat_session(event.group_id) if isGroup(event) else None
+        await event.reply(self.gate.report(session))
+
+    async def manage_shed(self, event: MessageEvent=None, **kwargs):
+        """显示降载状态和回复令牌桶"""
+        await event.reply(self.shedder.report())
+
+    async def manage_models(self, event: MessageEvent=None, args: list[str]=None, **kwargs):
+        """显示模型加载状态和冷启动、已加载时的请求延迟 参数: warm 重新预加载所有模型"""
+        if args and args[0] == 'warm':
+            for spec in self.lifecycle.specs.values():
+                self.lifecycle.schedule(spec)
+        await event.reply(self.lifecycle.report())
+
+    async def manage_startup(self, event: MessageEvent=None, **kwargs):
+        """显示启动各阶段耗时"""
+        lines = [f'{phase}: {seconds * 1000:.1f}ms' for phase, seconds in self.startup.items()]
+        if self.models is None:
+            lines.append('models: not built' + (' (warming up)' if self.warm_task and not self.warm_task.done() else ''))
+        await event.reply('\n'.join(lines))
+
+    async def manage_img_cache(self, event: MessageEvent=None, args: list[str]=None, **kwargs):
+        """显示图片描述缓存命中情况 参数: clear 清空缓存"""
+        helper = await self.get_ai_helper()
+        if args and 'clear' in args:
+            await helper.image_cache.clear()
+            await event.reply("已清空图片描述缓存")
+            return
+        await event.reply(helper.image_cache.report())
+
     async def update_group_chat_session(self, event: Event):
-        group_session = self.get_group_chat_session(event.group_id)
+        started = time.perf_counter()
+        group_session = await self.get_group_chat_session(event.group_id)
         group_session.update_avg_msg_interval(event.time, self.group_active_time_beta)
-        group_session.last_active_event = event
+        self.gate.observe(group_session, event.time)
+        group_session.last_event_time = event.time
+        metrics.since('stage_seconds', started, stage='activity')
 
-    async def check_sticker(self, event: MessageEvent, group_session: GroupChatSession) -> bool:
-        '''
-            当前消息和上个消息为同一个人且为图片
-        '''
-        if group_session.last_active_msg is None:
-            return False
-        if group_session.last_active_msg.user_id == event.user_id:
-            if hasImage(event):
-                return True
-            
-        return False
+    async def ingest_event(self, event: Event):
+        await self.pipeline.submit('ingest', event.group_id, event)
 
     async def group_should_answer(self, **kwargs) -> bool:
         """判断群聊消息是否应该回复"""
         event: MessageEvent = kwargs['event']
 
-        await self.update_group_chat_session(event)
-        group_session = self.get_group_chat_session(event.group_id)
-        is_trigger = False
-        logger.info(f'group_should_answer {group_session} event {event} {event.time}')
-
-        if isAtMe(event) or isAtAll(event): # 被 @ 直接回复
-            is_trigger = True
-        elif group_session.avg_msg_interval < self.group_active_threshold \
-                and random.random() < self.group_active_engage: # 群聊在活跃时以一定概率回复
-            is_trigger = True
-        elif await self.check_sticker(event, group_session): # TODO 发送图片且是同一个人并且为连续对话
-            logger.info('sticker trigger')
-            is_trigger = True
-        elif False: # TODO 群聊在非活跃时以一定概率回复
-            is_trigger = True
-        elif await self.ai_helper.is_arouse(event.get_plain_text()):  # 使用小模型panduan
-            is_trigger = True
-
+        await self.ingest_event(event)
+        return bool(await self.pipeline.submit('gate', event.group_id, event))
+
+    async def gate_group_message(self, event: MessageEvent) -> bool:
+        group_session = await self.get_group_chat_session(event.group_id)
+        is_trigger, reason = self.gate.decide(event, group_session, engage_scale=self.shedder.engage_scale())
+        self.gate.record(event.group_id, is_trigger, reason)
+        if is_trigger is None: # 规则无法决定时使用小模型判断，没有令牌时判断结果也会被限流，不必调用
+            if self.shedder.peek(event.group_id, reason):
+                is_trigger = await (await self.get_ai_helper()).is_arouse(event.get_plain_text(), group_id=event.group_id)
+            else:
+                logger.info(f'Reply to group {event.group_id} rate limited ({reason})')
+                is_trigger = False
+        if is_trigger and not self.shedder.admit(event.group_id, reason):
+            logger.info(f'Reply to group {event.group_id} rate limited ({reason})')
+            is_trigger = False
+
+        group_session.record_active(event.time, event.user_id, hasImage(event))
         if is_trigger:
-            group_session.last_trigger_msg = event
-            group_session.last_active_msg = event
+            group_session.record_trigger(event.time, event.user_id)
             return True
         else:
-            group_session.last_active_msg = event
-            await self.update_group_chat_session_digest(event, group_session)
+            self.update_group_chat_session_digest(event, group_session)
             return False
         
-    async def update_group_chat_session_digest(self, new_event: MessageEvent, group_session: GroupChatSession):
-        return await self.ai_helper.generate_digest(group_session.messages_digest, new_event)
+    def update_group_chat_session_digest(self, new_event: MessageEvent, group_session: GroupChatSession):
+        '''将消息交给后台摘要任务，不等待摘要生成'''
+        if self.shedder.allow_digest():
+            self.digest.push(group_session, new_event)
 
     async def do_group_chat(self, event: MessageEvent=None):
         """实际对话信息，调用 langgraph"""
-        await self.ai.chat(event=event, chat_session=self.get_group_chat_session(event.group_id))
+        started = time.perf_counter()
+        content = await self.pipeline.submit('enrich', event.group_id, event)
+        if content is None:
+            return
+        reply = await self.pipeline.submit('generate', event.group_id, (event, content, started))
+        if reply is None:
+            return # 已与同群后续的消息合并，或已经流式发送
+        await self.pipeline.submit('send', event.group_id, (event, reply))
+        metrics.since('reply_first_message', started)
+
+    async def enrich_group_message(self, event: MessageEvent) -> str:
+        direct = isPokeNotify(event) or isAtMe(event) or self.gate.is_reply_to_me(event)
+        ai = await self.get_ai()
+        return await ai.build_content(event=event, chat_session=await self.get_group_chat_session(event.group_id),
+                                      describe_images=self.shedder.allow_vision(direct))
+
+    async def generate_group_reply(self, payload):
+        event, content, started = payload
+        chat_session = await self.get_group_chat_session(event.group_id)
+        ai = await self.get_ai()
+        if ai.streaming:
+            await ai.generate_stream(content, chat_session=chat_session, event=event, started=started)
+            return None
+        return await ai.generate(content, chat_session=chat_session)
+
+    def merge_group_reply(self, queued, payload):
+        '''排队中的多条触发消息合并为一轮输入，只回复最新的一条'''
+        return payload[0], queued[1] + '\n' + payload[1], queued[2]
+
+    async def send_group_reply(self, payload):
+        event, reply = payload
+        await (await self.get_ai()).send_reply(event, reply)
 
 
 @dataclass
@@ -271,13 +531,20 @@ class AshleyAppPlugin(Plugin):
 
         if isNoticeEvent(self.event):
             if isPokeNotify(self.event):
-                self.bot.ashley.update_group_chat_session(self.event)
+                await self.bot.ashley.ingest_event(self.event)
                 self.event.sender = CustomSender(user_id=self.event.user_id,
                                                  card='SystemMessage')
                 self.event.message = self.generate_message_from_poke(self.event)
                 await self.bot.ashley.do_group_chat(event=self.event)
 
     async def rule(self) -> bool:
+        started = time.perf_counter()
+        try:
+            return await self.match()
+        finally:
+            metrics.since('stage_seconds', started, stage='rule')
+
+    async def match(self) -> bool:
         if not fromOneBot(self.event):
             return False
         
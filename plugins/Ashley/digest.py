@@ -0,0 +1,111 @@
+import asyncio
+import time
+import structlog
+from plugins.Ashley.metrics import metrics
+
+logger = structlog.stdlib.get_logger()
+
+
+class DigestWorker:
+    '''
+    单个群聊的后台摘要任务
+
+    消息先进入有界队列，连续的消息在 debounce 秒内不断合并，
+    停顿后(或超过 max_delay 秒)把自上次摘要以来的全部消息交给一次 summarize 调用。
+    '''
+    def __init__(self, session, summarize, debounce: float = 3.0, max_delay: float = 30.0,
+                 max_pending: int = 64, idle_timeout: float = 600.0):
+        self.session = session
+        self.summarize = summarize  # async (old_digest, events) -> digest
+        self.debounce = debounce
+        self.max_delay = max_delay
+        self.idle_timeout = idle_timeout
+        self.queue = asyncio.Queue(maxsize=max_pending)
+        self.task = None
+
+    def push(self, event):
+        '''将消息放入队列，队列满时丢弃最旧的消息'''
+        if self.queue.full():
+            self.queue.get_nowait()
+            metrics.inc('digest_dropped')
+        self.queue.put_nowait(event)
+
+        if self.task is None or self.task.done():
+            self.task = asyncio.create_task(self.run())
+
+    @property
+    def busy(self) -> bool:
+        return not self.queue.empty() or (self.task is not None and not self.task.done())
+
+    async def collect(self) -> list:
+        try:
+            first = await asyncio.wait_for(self.queue.get(), self.idle_timeout)
+        except asyncio.TimeoutError:
+            return []
+
+        events = [first]
+        deadline = time.monotonic() + self.max_delay
+        while True:
+            timeout = min(self.debounce, deadline - time.monotonic())
+            if timeout <= 0:
+                break
+            try:
+                events.append(await asyncio.wait_for(self.queue.get(), timeout))
+            except asyncio.TimeoutError:
+                break
+        while not self.queue.empty():
+            events.append(self.queue.get_nowait())
+        return events
+
+    async def run(self):
+        while True:
+            events = await self.collect()
+            if not events:
+                # 长时间没有新消息，退出任务，下次 push 时重新启动
+                return
+
+            epoch = self.session.digest_epoch
+            started = time.perf_counter()
+            try:
+                digest = await self.summarize(self.session.messages_digest, events)
+            except Exception:
+                logger.exception(f'Digest for group {self.session.group_id} failed')
+                continue
+            metrics.since('digest_latency', started)
+            metrics.observe('digest_batch_size', len(events))
+
+            if not self.session.store_digest(digest, epoch):
+                # 生成摘要期间已经进行了回复，旧摘要作废
+                logger.info(f'Digest for group {self.session.group_id} discarded')
+
+
+class DigestService:
+    '''按群聊管理摘要任务'''
+    def __init__(self, summarize, debounce: float = 3.0, max_delay: float = 30.0, max_pending: int = 64):
+        self.summarize = summarize
+        self.debounce = debounce
+        self.max_delay = max_delay
+        self.max_pending = max_pending
+        self.workers: dict[str, DigestWorker] = {}
+
+    def push(self, session, event):
+        worker = self.workers.get(session.group_id)
+        if worker is None:
+            worker = self.workers[session.group_id] = DigestWorker(
+                session, self.summarize,
+                debounce=self.debounce, max_delay=self.max_delay, max_pending=self.max_pending
+            )
+        else:
+            # 会话可能被移出内存后重新读回，摘要写回最新的会话对象
+            worker.session = session
+        worker.push(event)
+
+    def release(self, group_id) -> bool:
+        '''群聊没有进行中的摘要时释放它的任务，返回会话是否可以移出内存'''
+        worker = self.workers.get(group_id)
+        if worker is None:
+            return True
+        if worker.busy:
+            return False
+        del self.workers[group_id]
+        return True
@@ -0,0 +1,82 @@
+import re
+import structlog
+from alicebot.adapter.cqhttp.message import CQHTTPMessage, CQHTTPMessageSegment
+
+logger = structlog.stdlib.get_logger()
+
+FACE_PATTERN = re.compile(r'::(.*?)::')
+
+
+class ExpressionCodec:
+    '''
+    QQ 表情与模型文本之间的双向转换，由 ExpressData 一次性构建
+
+    decode: 消息段 -> 模型看到的文本，表情写作 ::😊 微笑::
+    encode: 模型输出 -> 消息段列表，::名称:: 替换为 QQ 表情
+    除完整名称外，也接受只写 emoji 或只写文字的名称，未知的名称会被丢弃。
+    '''
+    def __init__(self, express_data: dict, allow_express=True):
+        self.names: dict[int, str] = {int(k): str(v).strip() for k, v in (express_data or {}).items()}
+        self.ids: dict[str, int] = {}
+        # 完整名称优先，其次是 emoji 和文字部分
+        for face_id, name in self.names.items():
+            self.ids.setdefault(name, face_id)
+        for face_id, name in self.names.items():
+            for alias in name.split():
+                self.ids.setdefault(alias, face_id)
+        self.catalogue = self.build_catalogue(allow_express)
+
+    def build_catalogue(self, allow_express) -> str:
+        '''
+        提示词中允许模型使用的表情列表
+        allow_express 可以是 {id: 名称}、id 或名称的列表，True 表示全部表情
+        '''
+        if allow_express is True or allow_express is None:
+            names = self.names.values()
+        elif isinstance(allow_express, dict):
+            names = [str(name).strip() for name in allow_express.values()]
+        elif isinstance(allow_express, (list, tuple)):
+            names = [self.names.get(item, str(item).strip()) if isinstance(item, int) else str(item).strip()
+                     for item in allow_express]
+        else:
+            names = []
+        return ' '.join(f'::{name}::' for name in names)
+
+    def face_text(self, face_id) -> str:
+        name = self.names.get(int(face_id))
+        if name is None:
+            logger.warning(f'Unknown face id: {face_id}')
+            return ''
+        return f'::{name}::'
+
+    def decode_segment(self, segment) -> str:
+        if segment.type == 'text':
+            return segment.data['text']
+        if segment.type == 'face':
+            return self.face_text(segment.data['id'])
+        return ''
+
+    def decode(self, message) -> str:
+        '''把消息中的文本和表情转换为模型使用的文本，其他消息段忽略'''
+        return ''.join(self.decode_segment(segment) for segment in message)
+
+    def encode_segments(self, text: str) -> list[CQHTTPMessageSegment]:
+        segments = []
+        text = text.strip()
+        position = 0
+        for match in FACE_PATTERN.finditer(text):
+            if match.start() > position:
+                segments.append(CQHTTPMessageSegment.text(text[position:match.start()]))
+            position = match.end()
+            face_id = self.ids.get(match.group(1).strip())
+            if face_id is None:
+                logger.warning(f'Model use a unknown face name: {match.group(1)}')
+                continue
+            segments.append(CQHTTPMessageSegment.face(face_id))
+        if position < len(text):
+            segments.append(CQHTTPMessageSegment.text(text[position:]))
+        return segments
+
+    def encode(self, text: str) -> CQHTTPMessage:
+        '''把模型输出转换为 OneBot 消息，未知的表情名称会连同两侧的 :: 一起丢弃'''
+        return CQHTTPMessage(self.encode_segments(text))
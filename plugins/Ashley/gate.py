@@ -0,0 +1,197 @@
+import random
+import re
+import time
+from array import array
+from collections import deque
+import structlog
+from alicebot import MessageEvent
+from plugins.Ashley.metrics import metrics
+from plugins.Ashley.utils import hasImage, isAtAll, isAtMe
+
+logger = structlog.stdlib.get_logger()
+
+QUESTION_MARKERS = ['?', '？', '吗', '呢', '么', '怎么', '为什么', '什么', '谁', '哪', '几', '如何', '是不是']
+
+# 旧的判断逻辑中，除 @、活跃时随机回复、连续图片外的消息都会调用辅助模型
+LLM_FREE_REASONS = {'mention', 'active_engage', 'sticker'}
+
+
+class GroupActivity:
+    '''
+    单个群的消息速率窗口和按小时统计的基线
+
+    最近 window 秒被分成若干个桶，环形数组记录每个桶的消息数，每条消息 O(1) 更新；
+    每个自然小时结束时，把这一小时的消息数按 EWMA 合并进当天对应小时的基线。
+    '''
+    __slots__ = ('counts', 'last_bucket', 'total', 'hour', 'hour_count', 'baseline')
+
+    def __init__(self, buckets: int):
+        self.counts = array('H', bytes(2 * buckets))
+        self.last_bucket = 0
+        self.total = 0
+        self.hour = 0 # 当前统计的小时(本地时间，自纪元起)
+        self.hour_count = 0
+        self.baseline = array('f', bytes(4 * 24)) # 每个小时的平均消息数
+
+    def advance(self, bucket: int):
+        '''清空从上次更新到当前之间过期的桶'''
+        size = len(self.counts)
+        if bucket <= self.last_bucket:
+            return
+        for idx in range(self.last_bucket + 1, min(bucket, self.last_bucket + size) + 1):
+            slot = idx % size
+            self.total -= self.counts[slot]
+            self.counts[slot] = 0
+        self.last_bucket = bucket
+
+    def fold_hours(self, hour: int, alpha: float):
+        '''把已经结束的小时合并进基线，没有消息的小时按 0 计入'''
+        if self.hour:
+            for idx in range(self.hour, min(hour, self.hour + 24)):
+                count = self.hour_count if idx == self.hour else 0
+                slot = idx % 24
+                base = self.baseline[slot]
+                self.baseline[slot] = count if base == 0 else (1 - alpha) * base + alpha * count
+        self.hour = hour
+        self.hour_count = 0
+
+    def observe(self, bucket: int, hour: int, alpha: float):
+        self.advance(bucket)
+        slot = bucket % len(self.counts)
+        if self.counts[slot] < 0xFFFF:
+            self.counts[slot] += 1
+            self.total += 1
+        if hour != self.hour:
+            self.fold_hours(hour, alpha)
+        self.hour_count += 1
+
+    def dump(self) -> dict:
+        return {'counts': self.counts.tolist(), 'last_bucket': self.last_bucket, 'hour': self.hour,
+                'hour_count': self.hour_count, 'baseline': self.baseline.tolist()}
+
+    @classmethod
+    def load(cls, data: dict) -> 'GroupActivity':
+        activity = cls(len(data['counts']))
+        activity.counts = array('H', data['counts'])
+        activity.total = sum(activity.counts)
+        activity.last_bucket = data['last_bucket']
+        activity.hour = data['hour']
+        activity.hour_count = data['hour_count']
+        activity.baseline = array('f', data['baseline'])
+        return activity
+
+
+class GateEngine:
+    '''
+    基于规则判断群聊消息是否需要回复，只有规则无法决定的消息才交给辅助模型
+
+    按顺序检查：@ 或回复机器人的消息、提到机器人的名字、同一个人连续发图片、
+    群聊活跃时随机回复、刷屏时跳过、过短的消息跳过、疑问句交给辅助模型、群聊冷清时随机回复，
+    其余消息按 llm_fallback 处理。每次判断记录原因，gate_llm_saved 统计省下的辅助模型调用。
+    '''
+    def __init__(self, config: dict = None, active_threshold: float = 60, active_engage: float = 0.1):
+        self.sent: dict[int, deque] = {} # 群号 -> 机器人最近发送的消息 id
+        self.stats: dict[str, int] = {}
+        self.configure(config or {}, active_threshold, active_engage)
+
+    def configure(self, config: dict, active_threshold: float, active_engage: float):
+        self.active_threshold = active_threshold # 平均消息间隔低于此值(秒)视为活跃
+        self.active_engage = active_engage
+        self.window = float(config.get('window', 300))
+        self.buckets = int(config.get('buckets', 30))
+        self.bucket_seconds = self.window / self.buckets
+        self.baseline_alpha = float(config.get('baseline_alpha', 0.2))
+        self.active_factor = float(config.get('active_factor', 1.0))
+        self.flood_factor = float(config.get('flood_factor', 4.0))
+        self.quiet_factor = float(config.get('quiet_factor', 0.25))
+        self.quiet_engage = float(config.get('quiet_engage', 0.0))
+        self.min_chars = int(config.get('min_chars', 2))
+        self.llm_fallback = config.get('llm_fallback', 'question') # all | question | none
+        self.names = [name.casefold() for name in config.get('names', ['艾希', 'Ashley'])]
+        self.question = re.compile('|'.join(map(re.escape, config.get('question_markers', QUESTION_MARKERS))))
+        self.utc_offset = time.localtime().tm_gmtoff
+
+    def activity(self, session) -> GroupActivity:
+        if session.activity is None or len(session.activity.counts) != self.buckets:
+            session.activity = GroupActivity(self.buckets)
+        return session.activity
+
+    def observe(self, session, event_time: int):
+        '''记录一条新消息，每条消息只更新一个桶'''
+        self.activity(session).observe(int(event_time // self.bucket_seconds),
+                                       int((event_time + self.utc_offset) // 3600), self.baseline_alpha)
+
+    def rate(self, session, now: float) -> float:
+        '''窗口内的消息速率(条/小时)'''
+        activity = self.activity(session)
+        activity.advance(int(now // self.bucket_seconds))
+        return activity.total * 3600 / self.window
+
+    def baseline(self, session, now: float) -> float:
+        '''当前小时的基线速率(条/小时)，还没有统计时为 0'''
+        return self.activity(session).baseline[int((now + self.utc_offset) // 3600) % 24]
+
+    def remember_sent(self, group_id: int, message_id):
+        if message_id is None:
+            return
+        sent = self.sent.get(group_id)
+        if sent is None:
+            sent = self.sent[group_id] = deque(maxlen=32)
+        sent.append(str(message_id))
+
+    def is_reply_to_me(self, event: MessageEvent) -> bool:
+        sent = self.sent.get(event.group_id)
+        if not sent:
+            return False
+        return any(msg.type == 'reply' and str(msg.data.get('id')) in sent for msg in event.message)
+
+    def decide(self, event: MessageEvent, session, engage_scale: float = 1.0) -> tuple:
+        '''返回 (是否回复, 原因)，是否回复为 None 时需要辅助模型判断，engage_scale 缩放随机回复的概率'''
+        if isAtMe(event) or isAtAll(event):
+            return True, 'mention'
+        if self.is_reply_to_me(event):
+            return True, 'reply_to_bot'
+
+        text = event.get_plain_text().strip()
+        folded = text.casefold()
+        if any(name in folded for name in self.names):
+            return True, 'name'
+        if session.last_active_time and session.last_active_sender == event.user_id and hasImage(event):
+            return True, 'sticker'
+
+        rate = self.rate(session, event.time)
+        baseline = self.baseline(session, event.time)
+        if self.activity(session).total < 2:
+            # 窗口内还没有足够的消息(如刚重启)，使用保存下来的平均消息间隔
+            active = session.avg_msg_interval < self.active_threshold
+        else:
+            active = rate * self.active_threshold > 3600 and rate >= self.active_factor * baseline
+        if active and random.random() < self.active_engage * engage_scale:
+            return True, 'active_engage'
+        if baseline and rate > self.flood_factor * baseline:
+            return False, 'flood'
+        if len(text) < self.min_chars:
+            return False, 'short'
+        if self.llm_fallback == 'all' or (self.llm_fallback == 'question' and self.question.search(text)):
+            return None, 'question' if self.llm_fallback == 'question' else 'fallback'
+        if not active and rate <= self.quiet_factor * baseline and random.random() < self.quiet_engage * engage_scale:
+            return True, 'quiet_engage'
+        return False, 'no_signal'
+
+    def record(self, group_id: int, verdict: bool, reason: str):
+        result = {True: 'reply', False: 'skip', None: 'llm'}[verdict]
+        key = f'{reason}:{result}'
+        self.stats[key] = self.stats.get(key, 0) + 1
+        metrics.inc('gate_decisions', reason=reason, result=result)
+        if verdict is not None and reason not in LLM_FREE_REASONS:
+            metrics.inc('gate_llm_saved')
+            self.stats['llm_saved'] = self.stats.get('llm_saved', 0) + 1
+        logger.info(f'Gate group {group_id}: {result} ({reason})')
+
+    def report(self, session=None) -> str:
+        lines = [f'{key}: {count}' for key, count in sorted(self.stats.items())] or ['no decisions']
+        if session is not None:
+            now = time.time()
+            lines.append(f'rate: {self.rate(session, now):.1f}/h baseline: {self.baseline(session, now):.1f}/h '
+                         f'avg interval: {session.avg_msg_interval:.1f}s')
+        return '\n'.join(lines)
@@ -0,0 +1,99 @@
+import asyncio
+import base64
+import os
+from concurrent.futures import ThreadPoolExecutor
+from io import BytesIO
+import httpx
+from plugins.Ashley.metrics import metrics
+
+
+def encode_for_vision(raw: bytes, max_side: int, quality: int, max_pixels: int, passthrough_bytes: int) -> str:
+    '''
+    解码图片并缩放到视觉模型需要的分辨率，返回 JPEG 的 Base64 字符串
+    动图只取第一帧；本身已经足够小的 JPEG 不再重新编码
+    '''
+    from PIL import Image # 第一次处理图片时才导入
+    with Image.open(BytesIO(raw)) as img:
+        width, height = img.size
+        if width * height > max_pixels:
+            raise ValueError(f'Image too large: {width}x{height}')
+
+        if img.format == 'JPEG' and max(width, height) <= max_side and len(raw) <= passthrough_bytes:
+            return base64.b64encode(raw).decode('utf-8')
+
+        if img.format == 'JPEG':
+            # 让解码器直接按缩小后的尺寸解码
+            img.draft('RGB', (max_side, max_side))
+        img.seek(0)
+        frame = img.convert('RGB')
+        frame.thumbnail((max_side, max_side))
+
+        buffered = BytesIO()
+        frame.save(buffered, format='JPEG', quality=quality)
+        return base64.b64encode(buffered.getvalue()).decode('utf-8')
+
+
+class ImageProcessor:
+    '''
+    非阻塞的图片预处理：异步读取或下载图片，在线程池中完成解码、缩放和编码
+    '''
+    def __init__(self, max_side: int = 768, quality: int = 85, max_bytes: int = 10 * 1024 * 1024,
+                 max_pixels: int = 40_000_000, passthrough_bytes: int = 256 * 1024,
+                 timeout: float = 10.0, workers: int = 2, path_map: dict = None):
+        self.max_side = max_side
+        self.quality = quality
+        self.max_bytes = max_bytes
+        self.max_pixels = max_pixels
+        self.passthrough_bytes = passthrough_bytes
+        self.timeout = timeout
+        self.path_map = path_map if path_map is not None else {'/root': '/home/null/Projects/napcat.nix/data'}
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='ashley-image')
+        self.client = None
+
+    def get_client(self) -> httpx.AsyncClient:
+        if self.client is None:
+            self.client = httpx.AsyncClient(verify=False, timeout=self.timeout,
+                                            limits=httpx.Limits(max_connections=8, max_keepalive_connections=4))
+        return self.client
+
+    def read_local(self, image_path: str) -> bytes:
+        for src, dst in self.path_map.items():
+            image_path = image_path.replace(src, dst)
+        if os.path.getsize(image_path) > self.max_bytes:
+            raise ValueError(f'Image file too large: {image_path}')
+        with open(image_path, 'rb') as image:
+            return image.read()
+
+    async def download(self, url: str) -> bytes:
+        buffered = bytearray()
+        async with self.get_client().stream('GET', url) as response:
+            response.raise_for_status()
+            async for chunk in response.aiter_bytes():
+                buffered += chunk
+                if len(buffered) > self.max_bytes:
+                    raise ValueError(f'Image download too large: {url}')
+        return bytes(buffered)
+
+    async def load(self, image_path: str, mode: str = 'local') -> bytes:
+        '''读取图片的原始字节，mode 为 local 或 url'''
+        if mode == 'url':
+            load = self.download(image_path)
+        else:
+            load = asyncio.get_running_loop().run_in_executor(self.executor, self.read_local, image_path)
+        return await asyncio.wait_for(load, self.timeout)
+
+    async def to_base64(self, raw: bytes) -> str:
+        '''缩放并编码为视觉模型使用的 Base64 JPEG'''
+        started = asyncio.get_running_loop().time()
+        encode = asyncio.get_running_loop().run_in_executor(
+            self.executor, encode_for_vision,
+            raw, self.max_side, self.quality, self.max_pixels, self.passthrough_bytes)
+        result = await asyncio.wait_for(encode, self.timeout)
+        metrics.observe('image_encode', asyncio.get_running_loop().time() - started)
+        return result
+
+    async def aclose(self):
+        if self.client is not None:
+            await self.client.aclose()
+            self.client = None
+        self.executor.shutdown(wait=False)
@@ -0,0 +1,214 @@
+import asyncio
+import time
+from dataclasses import dataclass, field
+import httpx
+import structlog
+from plugins.Ashley.metrics import metric_key, metrics
+
+logger = structlog.stdlib.get_logger()
+
+# 每个模型的默认常驻策略，keep_alive 为 Ollama 的格式(秒数、'10m' 或 -1 常驻)，None 使用服务端默认值
+DEFAULT_POLICIES = {
+    'main': {'keep_alive': -1, 'rewarm': True},
+    'helper': {'keep_alive': -1, 'rewarm': True},
+    'vision': {'keep_alive': '10m', 'rewarm': False},
+}
+
+# 响应中的 load_duration 超过此值(秒)视为冷启动，模型已加载时通常只有几毫秒
+COLD_LOAD_SECONDS = 0.5
+
+
+def model_name(name: str) -> str:
+    '''Ollama 返回的模型名总是带标签'''
+    return name if ':' in name else f'{name}:latest'
+
+
+def record_load(model: str, info: dict):
+    '''按响应中的 load_duration 区分冷启动和已加载的请求，分别记录总耗时'''
+    if 'load_duration' not in info:
+        return
+    load = (info['load_duration'] or 0) / 1e9
+    start = 'cold' if load >= COLD_LOAD_SECONDS else 'warm'
+    metrics.inc('model_starts', model=model, start=start)
+    metrics.observe('model_latency', (info.get('total_duration') or 0) / 1e9, model=model, start=start)
+    if start == 'cold':
+        metrics.observe('model_load_seconds', load, model=model)
+        logger.info(f'Model {model} was not loaded, request waited {load:.1f}s for loading')
+
+
+@dataclass(slots=True)
+class ModelSpec:
+    '''
+    一个需要预加载的模型，options 只包含影响加载的参数(num_ctx、num_gpu 等)
+    base_url 是 OllamaClientRegistry.endpoint 返回的键，后端池中的每个后端分别预加载和检查
+    '''
+    role: str
+    base_url: str
+    model: str
+    options: dict
+    keep_alive: object = None
+    rewarm: bool = False
+    loaded: dict[str, bool] = field(default_factory=dict) # 后端地址 -> 是否已加载，没有检查过时不存在
+    last_warm_up: dict[str, float] = field(default_factory=dict) # 后端地址 -> 上次预加载的 monotonic 时间
+    tasks: dict[str, asyncio.Task] = field(default_factory=dict)
+    warm_ups: int = 0
+    load_seconds: float = 0.0 # 上次预加载时 Ollama 报告的加载耗时
+
+    def warming(self, url: str) -> bool:
+        task = self.tasks.get(url)
+        return task is not None and not task.done()
+
+
+class ModelLifecycle:
+    '''
+    主模型、辅助模型和视觉模型的预加载和常驻管理
+
+    模型创建时用实际调用的 num_ctx 等参数登记，启动后在后台向 /api/generate 发送空请求预加载，
+    参数不同时 Ollama 会重新加载模型，所以预加载必须和实际调用一致。
+    每隔 poll_interval 秒查询 /api/ps，发现模型被卸载(如服务重启或显存不足被换出)时，
+    rewarm 开启的模型重新加载，同一模型两次重新加载至少间隔 rewarm_backoff 秒，避免显存不足时互相换出。
+    keep_alive 同时用于预加载和每次调用，否则调用时的默认值会覆盖预加载时的设置。
+    配置了多个后端的模型在每个后端上分别预加载和检查。
+    '''
+    def __init__(self, clients, config: dict = None):
+        self.clients = clients
+        self.specs: dict[str, ModelSpec] = {}
+        self.task = None
+        self.started = False
+        self.stats = {'warm_ups': 0, 'rewarms': 0, 'unloads': 0, 'failures': 0}
+        self.configure(config or {})
+
+    def configure(self, config: dict):
+        self.enabled = bool(config.get('enable', True))
+        self.poll_interval = float(config.get('poll_interval', 60))
+        self.rewarm_backoff = float(config.get('rewarm_backoff', 300))
+        self.timeout = float(config.get('timeout', 300))
+        self.policies = {role: {**policy, **(config.get(role) or {})} for role, policy in DEFAULT_POLICIES.items()}
+        for spec in self.specs.values():
+            spec.keep_alive = self.keep_alive(spec.role)
+            spec.rewarm = bool(self.policies[spec.role]['rewarm'])
+
+    def keep_alive(self, role: str):
+        '''创建模型客户端时使用的 keep_alive'''
+        return self.policies[role]['keep_alive']
+
+    def register(self, role: str, base_url: str, model: str, options: dict = None):
+        '''模型创建或参数改变时登记，已启动时立即在后台预加载'''
+        options = options or {}
+        spec = self.specs.get(role)
+        if spec is not None and (spec.base_url, spec.model, spec.options) == (base_url, model, options):
+            return
+        self.specs[role] = spec = ModelSpec(role=role, base_url=base_url, model=model, options=options,
+                                            keep_alive=self.keep_alive(role),
+                                            rewarm=bool(self.policies[role]['rewarm']))
+        if self.started:
+            self.schedule(spec)
+
+    def schedule(self, spec: ModelSpec, hosts: list = None):
+        '''在后台预加载到指定的后端，默认为所有后端'''
+        if not self.enabled:
+            return
+        for host in hosts or self.clients.backends(spec.base_url):
+            if not spec.warming(host.base_url):
+                spec.tasks[host.base_url] = asyncio.get_running_loop().create_task(self.warm_up(spec, host))
+
+    async def warm_up(self, spec: ModelSpec, host) -> bool:
+        '''发送不带提示词的生成请求，Ollama 只加载模型'''
+        body = {'model': spec.model, 'prompt': '', 'options': spec.options}
+        if spec.keep_alive is not None:
+            body['keep_alive'] = spec.keep_alive
+        spec.last_warm_up[host.base_url] = time.monotonic()
+        started = time.perf_counter()
+        try:
+            response = await host.client.post('/api/generate', json=body, timeout=self.timeout)
+            response.raise_for_status()
+            info = response.json()
+        except (httpx.HTTPError, ValueError) as e:
+            self.stats['failures'] += 1
+            metrics.inc('model_warm_up_failures', model=spec.model)
+            logger.warning(f'Failed to warm up {spec.role} model {spec.model} at {host.base_url}: {e!r}')
+            return False
+        elapsed = time.perf_counter() - started
+        spec.loaded[host.base_url] = True
+        spec.warm_ups += 1
+        spec.load_seconds = (info.get('load_duration') or 0) / 1e9
+        self.stats['warm_ups'] += 1
+        metrics.observe('model_warm_up', elapsed, model=spec.model)
+        logger.info(f'Warmed up {spec.role} model {spec.model} at {host.base_url} in {elapsed:.1f}s '
+                    f'(load {spec.load_seconds:.1f}s)')
+        return True
+
+    async def poll(self):
+        '''查询各主机已加载的模型，检测卸载并按策略重新加载'''
+        hosts = {}
+        specs_by_host: dict[str, list[ModelSpec]] = {}
+        for spec in self.specs.values():
+            for host in self.clients.backends(spec.base_url):
+                hosts[host.base_url] = host
+                specs_by_host.setdefault(host.base_url, []).append(spec)
+        for base_url, specs in specs_by_host.items():
+            host = hosts[base_url]
+            try:
+                response = await host.client.get('/api/ps', timeout=10)
+                response.raise_for_status()
+                running = {model_name(item.get('model') or item.get('name', ''))
+                           for item in response.json().get('models', [])}
+            except (httpx.HTTPError, ValueError) as e:
+                logger.debug(f'Failed to list running models at {base_url}: {e!r}')
+                continue
+            now = time.monotonic()
+            for spec in specs:
+                if model_name(spec.model) in running:
+                    spec.loaded[base_url] = True
+                    continue
+                if spec.loaded.get(base_url):
+                    self.stats['unloads'] += 1
+                    metrics.inc('model_unloads', model=spec.model)
+                    logger.info(f'{spec.role} model {spec.model} was unloaded from {base_url}')
+                spec.loaded[base_url] = False
+                if spec.rewarm and now - spec.last_warm_up.get(base_url, 0.0) >= self.rewarm_backoff \
+                        and not spec.warming(base_url):
+                    self.stats['rewarms'] += 1
+                    self.schedule(spec, [host])
+
+    async def run(self):
+        while True:
+            await asyncio.sleep(self.poll_interval)
+            await self.poll()
+
+    def start(self):
+        '''预加载已登记的模型并开始检查，之后登记的模型立即预加载'''
+        self.started = True
+        if not self.enabled:
+            return
+        for spec in self.specs.values():
+            self.schedule(spec)
+        if self.task is None and self.poll_interval > 0:
+            self.task = asyncio.get_running_loop().create_task(self.run())
+
+    def report(self) -> str:
+        lines = ['state: ' + ('enabled' if self.enabled else 'disabled') + ', '
+                 + ', '.join(f'{key} {value}' for key, value in self.stats.items())]
+        for spec in self.specs.values():
+            lines.append(f'{spec.role}: {spec.model} keep_alive {spec.keep_alive} options {spec.options} '
+                         f'warm-ups {spec.warm_ups} last load {spec.load_seconds:.1f}s')
+            for host in self.clients.backends(spec.base_url):
+                state = {None: 'unknown', True: 'loaded', False: 'unloaded'}[spec.loaded.get(host.base_url)]
+                lines.append(f'  {host.base_url} [{state}]')
+            for start in ('cold', 'warm'):
+                latency = metrics.histograms.get(metric_key('model_latency', {'model': spec.model, 'start': start}))
+                if latency is not None:
+                    latency = latency.summary()
+                    lines.append(f'  {start}: {latency["count"]} requests, '
+                                 f'p50 {latency["p50"]}s p95 {latency["p95"]}s')
+        return '\n'.join(lines)
+
+    async def close(self):
+        self.started = False
+        tasks = [task for spec in self.specs.values() for task in spec.tasks.values() if not task.done()]
+        if self.task is not None:
+            tasks.append(self.task)
+            self.task = None
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
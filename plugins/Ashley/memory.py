@@ -0,0 +1,238 @@
+import asyncio
+import random
+import sqlite3
+import threading
+from typing import Any, Iterator, Optional, Sequence
+from langchain_core.messages import HumanMessage, RemoveMessage
+from langchain_core.runnables import RunnableConfig
+from langgraph.checkpoint.base import (
+    WRITES_IDX_MAP,
+    BaseCheckpointSaver,
+    ChannelVersions,
+    Checkpoint,
+    CheckpointMetadata,
+    CheckpointTuple,
+    get_checkpoint_id,
+)
+from langgraph.checkpoint.serde.types import TASKS
+
+
+class SQLiteSaver(BaseCheckpointSaver[str]):
+    '''
+    基于 SQLite 的 LangGraph checkpointer
+
+    每个对话线程只保留最近 keep 个 checkpoint，线程只有在第一次被访问时才从磁盘读取。
+    '''
+    def __init__(self, path: str = 'memory.db', keep: int = 4, serde=None):
+        super().__init__(serde=serde)
+        self.path = path
+        self.keep = max(1, keep)
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        with self.lock, self.conn:
+            self.conn.execute('PRAGMA journal_mode=WAL')
+            self.conn.execute('''CREATE TABLE IF NOT EXISTS checkpoints (
+                thread_id TEXT NOT NULL,
+                checkpoint_ns TEXT NOT NULL DEFAULT '',
+                checkpoint_id TEXT NOT NULL,
+                parent_checkpoint_id TEXT,
+                type TEXT,
+                checkpoint BLOB,
+                metadata_type TEXT,
+                metadata BLOB,
+                PRIMARY KEY (thread_id, checkpoint_ns, checkpoint_id))''')
+            self.conn.execute('''CREATE TABLE IF NOT EXISTS writes (
+                thread_id TEXT NOT NULL,
+                checkpoint_ns TEXT NOT NULL DEFAULT '',
+                checkpoint_id TEXT NOT NULL,
+                task_id TEXT NOT NULL,
+                idx INTEGER NOT NULL,
+                channel TEXT NOT NULL,
+                type TEXT,
+                value BLOB,
+                task_path TEXT NOT NULL DEFAULT '',
+                PRIMARY KEY (thread_id, checkpoint_ns, checkpoint_id, task_id, idx))''')
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
+
+    def load_writes(self, thread_id: str, checkpoint_ns: str, checkpoint_id: str) -> list:
+        return self.conn.execute(
+            '''SELECT task_id, channel, type, value, task_path, idx FROM writes
+               WHERE thread_id = ? AND checkpoint_ns = ? AND checkpoint_id = ?
+               ORDER BY task_path, task_id, idx''',
+            (thread_id, checkpoint_ns, checkpoint_id)).fetchall()
+
+    def build_tuple(self, row) -> CheckpointTuple:
+        thread_id, checkpoint_ns, checkpoint_id, parent_id, type_, blob, metadata_type, metadata = row
+        writes = self.load_writes(thread_id, checkpoint_ns, checkpoint_id)
+        sends = []
+        if parent_id:
+            sends = [self.serde.loads_typed((w[2], w[3]))
+                     for w in self.load_writes(thread_id, checkpoint_ns, parent_id) if w[1] == TASKS]
+        return CheckpointTuple(
+            config={'configurable': {'thread_id': thread_id,
+                                     'checkpoint_ns': checkpoint_ns,
+                                     'checkpoint_id': checkpoint_id}},
+            checkpoint={**self.serde.loads_typed((type_, blob)), 'pending_sends': sends},
+            metadata=self.serde.loads_typed((metadata_type, metadata)),
+            parent_config={'configurable': {'thread_id': thread_id,
+                                            'checkpoint_ns': checkpoint_ns,
+                                            'checkpoint_id': parent_id}} if parent_id else None,
+            pending_writes=[(w[0], w[1], self.serde.loads_typed((w[2], w[3]))) for w in writes],
+        )
+
+    def get_tuple(self, config: RunnableConfig) -> Optional[CheckpointTuple]:
+        thread_id = config['configurable']['thread_id']
+        checkpoint_ns = config['configurable'].get('checkpoint_ns', '')
+        columns = '''thread_id, checkpoint_ns, checkpoint_id, parent_checkpoint_id,
+                     type, checkpoint, metadata_type, metadata'''
+        with self.lock:
+            if checkpoint_id := get_checkpoint_id(config):
+                row = self.conn.execute(
+                    f'''SELECT {columns} FROM checkpoints
+                        WHERE thread_id = ? AND checkpoint_ns = ? AND checkpoint_id = ?''',
+                    (thread_id, checkpoint_ns, checkpoint_id)).fetchone()
+            else:
+                row = self.conn.execute(
+                    f'''SELECT {columns} FROM checkpoints
+                        WHERE thread_id = ? AND checkpoint_ns = ?
+                        ORDER BY checkpoint_id DESC LIMIT 1''',
+                    (thread_id, checkpoint_ns)).fetchone()
+            return self.build_tuple(row) if row else None
+
+    def list(self, config: Optional[RunnableConfig], *, filter: Optional[dict[str, Any]] = None,
+             before: Optional[RunnableConfig] = None, limit: Optional[int] = None) -> Iterator[CheckpointTuple]:
+        query = '''SELECT thread_id, checkpoint_ns, checkpoint_id, parent_checkpoint_id,
+                          type, checkpoint, metadata_type, metadata FROM checkpoints'''
+        where, params = [], []
+        if config:
+            where.append('thread_id = ?')
+            params.append(config['configurable']['thread_id'])
+            if (checkpoint_ns := config['configurable'].get('checkpoint_ns')) is not None:
+                where.append('checkpoint_ns = ?')
+                params.append(checkpoint_ns)
+            if checkpoint_id := get_checkpoint_id(config):
+                where.append('checkpoint_id = ?')
+                params.append(checkpoint_id)
+        if before and (before_id := get_checkpoint_id(before)):
+            where.append('checkpoint_id < ?')
+            params.append(before_id)
+        if where:
+            query += ' WHERE ' + ' AND '.join(where)
+        query += ' ORDER BY checkpoint_id DESC'
+
+        with self.lock:
+            rows = self.conn.execute(query, params).fetchall()
+            results = []
+            for row in rows:
+                if limit is not None and len(results) >= limit:
+                    break
+                item = self.build_tuple(row)
+                if filter and not all(item.metadata.get(k) == v for k, v in filter.items()):
+                    continue
+                results.append(item)
+        yield from results
+
+    def put(self, config: RunnableConfig, checkpoint: Checkpoint,
+            metadata: CheckpointMetadata, new_versions: ChannelVersions) -> RunnableConfig:
+        thread_id = config['configurable']['thread_id']
+        checkpoint_ns = config['configurable'].get('checkpoint_ns', '')
+        c = checkpoint.copy()
+        c.pop('pending_sends', None)
+        type_, blob = self.serde.dumps_typed(c)
+        metadata_type, metadata_blob = self.serde.dumps_typed(metadata)
+
+        with self.lock, self.conn:
+            self.conn.execute(
+                'INSERT OR REPLACE INTO checkpoints VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                (thread_id, checkpoint_ns, checkpoint['id'], config['configurable'].get('checkpoint_id'),
+                 type_, blob, metadata_type, metadata_blob))
+            self.prune(thread_id, checkpoint_ns)
+
+        return {'configurable': {'thread_id': thread_id,
+                                 'checkpoint_ns': checkpoint_ns,
+                                 'checkpoint_id': checkpoint['id']}}
+
+    def prune(self, thread_id: str, checkpoint_ns: str):
+        '''删除线程中除最近 keep 个以外的 checkpoint 及其写入'''
+        stale = self.conn.execute(
+            '''SELECT checkpoint_id FROM checkpoints WHERE thread_id = ? AND checkpoint_ns = ?
+               ORDER BY checkpoint_id DESC LIMIT -1 OFFSET ?''',
+            (thread_id, checkpoint_ns, self.keep)).fetchall()
+        if not stale:
+            return
+        params = [(thread_id, checkpoint_ns, row[0]) for row in stale]
+        self.conn.executemany(
+            'DELETE FROM checkpoints WHERE thread_id = ? AND checkpoint_ns = ? AND checkpoint_id = ?', params)
+        self.conn.executemany(
+            'DELETE FROM writes WHERE thread_id = ? AND checkpoint_ns = ? AND checkpoint_id = ?', params)
+
+    def put_writes(self, config: RunnableConfig, writes: Sequence[tuple[str, Any]],
+                   task_id: str, task_path: str = '') -> None:
+        thread_id = config['configurable']['thread_id']
+        checkpoint_ns = config['configurable'].get('checkpoint_ns', '')
+        checkpoint_id = config['configurable']['checkpoint_id']
+        # 特殊通道(错误、中断等)总是覆盖，普通写入只保留第一次
+        verb = 'INSERT OR REPLACE' if all(w[0] in WRITES_IDX_MAP for w in writes) else 'INSERT OR IGNORE'
+        rows = []
+        for idx, (channel, value) in enumerate(writes):
+            type_, blob = self.serde.dumps_typed(value)
+            rows.append((thread_id, checkpoint_ns, checkpoint_id, task_id,
+                         WRITES_IDX_MAP.get(channel, idx), channel, type_, blob, task_path))
+        with self.lock, self.conn:
+            self.conn.executemany(f'{verb} INTO writes VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)', rows)
+
+    async def aget_tuple(self, config: RunnableConfig) -> Optional[CheckpointTuple]:
+        return await asyncio.to_thread(self.get_tuple, config)
+
+    async def alist(self, config: Optional[RunnableConfig], *, filter: Optional[dict[str, Any]] = None,
+                    before: Optional[RunnableConfig] = None, limit: Optional[int] = None):
+        items = await asyncio.to_thread(
+            lambda: list(self.list(config, filter=filter, before=before, limit=limit)))
+        for item in items:
+            yield item
+
+    async def aput(self, config: RunnableConfig, checkpoint: Checkpoint,
+                   metadata: CheckpointMetadata, new_versions: ChannelVersions) -> RunnableConfig:
+        return await asyncio.to_thread(self.put, config, checkpoint, metadata, new_versions)
+
+    async def aput_writes(self, config: RunnableConfig, writes: Sequence[tuple[str, Any]],
+                          task_id: str, task_path: str = '') -> None:
+        return await asyncio.to_thread(self.put_writes, config, writes, task_id, task_path)
+
+    def get_next_version(self, current: Optional[str], channel) -> str:
+        if current is None:
+            current_v = 0
+        elif isinstance(current, int):
+            current_v = current
+        else:
+            current_v = int(current.split('.')[0])
+        return f'{current_v + 1:032}.{random.random():016}'
+
+
+def trim_messages_by_retention(messages: list, max_turns: int = 0, max_bytes: int = 0) -> list:
+    '''
+    按保留策略计算需要删除的旧消息：最多保留 max_turns 轮(以用户消息为界)，
+    且消息内容总长度不超过 max_bytes，删除总是在某条用户消息之前截断。0 表示不限制。
+    '''
+    keep_from = len(messages)
+    turns = 0
+    size = 0
+    for idx in range(len(messages) - 1, -1, -1):
+        message = messages[idx]
+        content = message.content if isinstance(message.content, str) else str(message.content)
+        size += len(content.encode())
+        if not isinstance(message, HumanMessage):
+            continue
+        # 至少保留最新的一轮
+        if turns > 0 and max_bytes and size > max_bytes:
+            break
+        keep_from = idx
+        turns += 1
+        if max_turns and turns >= max_turns:
+            break
+    if turns == 0:
+        return []
+    return [RemoveMessage(id=message.id) for message in messages[:keep_from] if message.id]
@@ -0,0 +1,188 @@
+import asyncio
+import os
+import time
+import structlog
+
+logger = structlog.stdlib.get_logger()
+
+
+class Histogram:
+    '''
+    定长采样的直方图，记录数量、总和、极值，并保留最近的样本用于估算分位数
+    '''
+    __slots__ = ('count', 'total', 'min', 'max', 'samples', 'size', 'cursor')
+
+    def __init__(self, size: int = 1024):
+        self.count = 0
+        self.total = 0.0
+        self.min = float('inf')
+        self.max = float('-inf')
+        self.samples = []
+        self.size = size
+        self.cursor = 0
+
+    def observe(self, value: float):
+        self.count += 1
+        self.total += value
+        if value < self.min:
+            self.min = value
+        if value > self.max:
+            self.max = value
+        if len(self.samples) < self.size:
+            self.samples.append(value)
+        else:
+            self.samples[self.cursor] = value
+            self.cursor = (self.cursor + 1) % self.size
+
+    def percentile(self, q: float) -> float:
+        if not self.samples:
+            return 0.0
+        ordered = sorted(self.samples)
+        idx = min(len(ordered) - 1, int(q * len(ordered)))
+        return ordered[idx]
+
+    def summary(self) -> dict:
+        if self.count == 0:
+            return {'count': 0}
+        return {
+            'count': self.count,
+            'avg': round(self.total / self.count, 4),
+            'min': round(self.min, 4),
+            'max': round(self.max, 4),
+            'p50': round(self.percentile(0.5), 4),
+            'p95': round(self.percentile(0.95), 4),
+            'p99': round(self.percentile(0.99), 4),
+        }
+
+
+def metric_key(name: str, labels: dict) -> tuple:
+    return (name, tuple(sorted((key, str(value)) for key, value in labels.items())))
+
+
+def format_key(key: tuple) -> str:
+    name, labels = key
+    if not labels:
+        return name
+    return name + '{' + ','.join(f'{label}="{value}"' for label, value in labels) + '}'
+
+
+class Metrics:
+    '''
+    进程内的指标注册表，按名称和标签获取或创建直方图和计数器
+
+    enabled 为 False 时所有记录直接返回，热路径上几乎没有开销
+    '''
+    def __init__(self, enabled: bool = True):
+        self.enabled = enabled
+        self.histograms: dict[tuple, Histogram] = {}
+        self.counters: dict[tuple, float] = {}
+
+    def histogram(self, name: str, **labels) -> Histogram:
+        key = metric_key(name, labels)
+        hist = self.histograms.get(key)
+        if hist is None:
+            hist = self.histograms[key] = Histogram()
+        return hist
+
+    def observe(self, name: str, value: float, **labels):
+        if not self.enabled:
+            return
+        self.histogram(name, **labels).observe(value)
+
+    def inc(self, name: str, value: float = 1, **labels):
+        if not self.enabled:
+            return
+        key = metric_key(name, labels)
+        self.counters[key] = self.counters.get(key, 0) + value
+
+    def since(self, name: str, start: float, **labels):
+        '''记录从 start (perf_counter) 到现在的耗时(秒)'''
+        if not self.enabled:
+            return
+        self.histogram(name, **labels).observe(time.perf_counter() - start)
+
+    def counter(self, name: str, **labels) -> float:
+        return self.counters.get(metric_key(name, labels), 0)
+
+    def reset(self):
+        self.histograms.clear()
+        self.counters.clear()
+
+    def snapshot(self) -> dict:
+        return {
+            'counters': {format_key(key): value for key, value in self.counters.items()},
+            'histograms': {format_key(key): hist.summary() for key, hist in self.histograms.items()},
+        }
+
+    def render_prometheus(self, prefix: str = 'ashley') -> str:
+        '''Prometheus 文本格式，计数器输出为 counter，直方图输出为带分位数的 summary'''
+        lines = []
+        typed = set()
+
+        def series(name: str, labels: tuple, extra: tuple = ()) -> str:
+            labels = labels + extra
+            if not labels:
+                return f'{prefix}_{name}'
+            return f'{prefix}_{name}' + '{' + ','.join(f'{label}="{value}"' for label, value in labels) + '}'
+
+        for (name, labels), value in sorted(self.counters.items()):
+            if name not in typed:
+                typed.add(name)
+                lines.append(f'# TYPE {prefix}_{name}_total counter')
+            lines.append(f'{series(name + "_total", labels)} {value}')
+        for (name, labels), hist in sorted(self.histograms.items()):
+            if name not in typed:
+                typed.add(name)
+                lines.append(f'# TYPE {prefix}_{name} summary')
+            for q in (0.5, 0.95, 0.99):
+                lines.append(f'{series(name, labels, (("quantile", str(q)),))} {hist.percentile(q)}')
+            lines.append(f'{series(name + "_sum", labels)} {hist.total}')
+            lines.append(f'{series(name + "_count", labels)} {hist.count}')
+        return '\n'.join(lines) + '\n'
+
+
+class MetricsExporter:
+    '''每隔 interval 秒把指标以 Prometheus 文本格式写入文件，供 node_exporter textfile 收集'''
+    def __init__(self, registry: 'Metrics', path: str = 'metrics.prom', interval: float = 15):
+        self.registry = registry
+        self.path = path
+        self.interval = interval
+        self.task = None
+
+    def write(self, text: str):
+        tmp_path = f'{self.path}.tmp'
+        with open(tmp_path, 'w') as output:
+            output.write(text)
+        os.replace(tmp_path, self.path)
+
+    async def export(self):
+        await asyncio.to_thread(self.write, self.registry.render_prometheus())
+
+    async def export_safely(self):
+        '''磁盘已满或目录不可写时只记录错误，不影响导出任务和退出流程'''
+        try:
+            await self.export()
+        except OSError:
+            logger.exception(f'Failed to export metrics to {self.path}')
+
+    async def run(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            await self.export_safely()
+
+    def start(self):
+        if self.task is None and self.path and self.interval > 0:
+            self.task = asyncio.get_running_loop().create_task(self.run())
+
+    async def close(self):
+        if self.task is not None:
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+            self.task = None
+            await self.export_safely()
+
+
+metrics = Metrics()
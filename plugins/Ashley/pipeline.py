@@ -0,0 +1,111 @@
+import asyncio
+import time
+from collections import deque
+from dataclasses import dataclass
+from typing import Any, Callable
+import structlog
+from plugins.Ashley.metrics import metrics
+
+logger = structlog.stdlib.get_logger()
+
+# 队列已满时的处理策略
+DROP_OLDEST = 'drop_oldest' # 丢弃最早排队的任务
+DROP_NEW = 'drop_new'       # 丢弃新提交的任务
+MERGE = 'merge'             # 与队尾任务合并，只执行一次
+POLICIES = {DROP_OLDEST, DROP_NEW, MERGE}
+
+
+@dataclass
+class Stage:
+    name: str
+    handler: Callable  # async (payload) -> result
+    queue_size: int = 16
+    policy: str = DROP_OLDEST
+    merge: Callable = None  # (queued_payload, new_payload) -> payload
+    dropped: Any = None     # 被丢弃或合并的任务返回的结果
+
+
+class StageQueue:
+    '''单个群在单个阶段上的先进先出队列，由一个任务顺序执行'''
+    __slots__ = ('pending', 'worker')
+
+    def __init__(self):
+        self.pending = deque() # [payload, futures, 入队时间]
+        self.worker = None
+
+
+class GroupPipeline:
+    '''
+    分阶段的群聊事件流水线
+
+    每个阶段对每个群维护独立的 FIFO 队列，同一群的任务按顺序执行，不同群之间互不阻塞。
+    队列满时按阶段的策略丢弃或合并任务，因此刷屏只会降低该群自身的响应。
+    '''
+    def __init__(self):
+        self.stages: dict[str, Stage] = {}
+        self.queues: dict[tuple[str, str], StageQueue] = {}
+
+    def add_stage(self, name: str, handler, queue_size: int = 16, policy: str = DROP_OLDEST,
+                  merge=None, dropped=None):
+        if policy not in POLICIES:
+            raise ValueError(f'Unknown queue policy {policy!r} for stage {name}, expected one of {sorted(POLICIES)}')
+        if policy == MERGE and merge is None:
+            policy = DROP_OLDEST
+        self.stages[name] = Stage(name, handler, max(1, queue_size), policy, merge, dropped)
+
+    def depth(self, name: str, group_id) -> int:
+        queue = self.queues.get((name, group_id))
+        return len(queue.pending) if queue else 0
+
+    def resolve(self, futures, result):
+        for future in futures:
+            if not future.done():
+                future.set_result(result)
+
+    async def submit(self, name: str, group_id, payload):
+        stage = self.stages[name]
+        key = (name, group_id)
+        queue = self.queues.get(key)
+        if queue is None:
+            queue = self.queues[key] = StageQueue()
+
+        future = asyncio.get_running_loop().create_future()
+        if len(queue.pending) >= stage.queue_size:
+            metrics.inc(f'pipeline_{name}_{stage.policy}')
+            if stage.policy == DROP_NEW:
+                return stage.dropped
+            if stage.policy == MERGE:
+                entry = queue.pending[-1]
+                entry[0] = stage.merge(entry[0], payload)
+                self.resolve(entry[1], stage.dropped)
+                entry[1] = [future]
+                return await future
+            _, futures, _ = queue.pending.popleft()
+            self.resolve(futures, stage.dropped)
+
+        queue.pending.append([payload, [future], time.perf_counter()])
+        if queue.worker is None:
+            queue.worker = asyncio.create_task(self.drain(stage, key, queue))
+        return await future
+
+    async def drain(self, stage: Stage, key, queue: StageQueue):
+        try:
+            while queue.pending:
+                payload, futures, queued = queue.pending.popleft()
+                metrics.since(f'pipeline_{stage.name}_wait', queued)
+                started = time.perf_counter()
+                try:
+                    result = await stage.handler(payload)
+                except Exception as e:
+                    logger.exception(f'Pipeline stage {stage.name} failed for group {key[1]}')
+                    for future in futures:
+                        if not future.done():
+                            future.set_exception(e)
+                    continue
+                finally:
+                    metrics.since(f'pipeline_{stage.name}_run', started)
+                self.resolve(futures, result)
+        finally:
+            queue.worker = None
+            if not queue.pending:
+                self.queues.pop(key, None)
@@ -0,0 +1,185 @@
+import asyncio
+import os
+import time
+import structlog
+import yaml
+from watchfiles import awatch
+from plugins.Ashley.metrics import metrics
+
+logger = structlog.stdlib.get_logger()
+
+MISSING = object()
+
+# 改变后只能重启生效的配置
+RESTART_REQUIRED = [
+    ('Ashley', 'Clients'),
+    ('Ashley', 'Memory'),
+    ('Ashley', 'Pipeline'),
+    ('Ashley', 'Metrics'),
+    ('Ashley', 'Sessions'),
+    ('Ashley', 'warm_up'),
+    ('Ashley', 'hot_reload'),
+    ('Ashley', 'Helper', 'image_cache'),
+    ('Ashley', 'Helper', 'image'),
+    ('Ashley', 'Helper', 'digest_debounce'),
+    ('Ashley', 'Helper', 'digest_max_delay'),
+    ('Ashley', 'Helper', 'digest_queue_size'),
+]
+
+# 配置键 -> Ashley 上的属性
+ACTIVE_PARAMETERS = {
+    'group_active_beta': 'group_active_time_beta',
+    'group_active_threshold': 'group_active_threshold',
+    'group_active_engage': 'group_active_engage',
+}
+
+HELPER_MODEL_KEYS = {'model', 'base_url'}
+HELPER_VISION_KEYS = {'vision_model', 'vision_base_url'}
+HELPER_TEMPLATE_KEYS = {'prompt', 'batch_prompt', 'digest_prompt', 'summary_prompt', 'vision_prompt'}
+
+
+def diff_config(old, new, path: tuple = ()) -> dict[tuple, tuple]:
+    '''逐层比较两份配置，返回 {路径: (旧值, 新值)}，键不存在时为 MISSING'''
+    if isinstance(old, dict) and isinstance(new, dict):
+        changes = {}
+        for key in old.keys() | new.keys():
+            changes.update(diff_config(old.get(key, MISSING), new.get(key, MISSING), path + (key,)))
+        return changes
+    if old == new:
+        return {}
+    return {path: (old, new)}
+
+
+def update_set(live: set, old, new):
+    '''把配置列表从 old 到 new 的增删应用到运行中的集合'''
+    old = set(old or []) if old is not MISSING else set()
+    new = set(new or []) if new is not MISSING else set()
+    live.difference_update(old - new)
+    live.update(new - old)
+
+
+def read_yaml(path: str) -> dict:
+    with open(path, 'r') as conf:
+        return yaml.safe_load(conf) or {}
+
+
+class ConfigReloader:
+    '''
+    监视 config.yaml，按结构差异只更新改变的部分：
+    替换提示词模板、重建参数改变的模型客户端、原地更新管理员和群白名单，
+    对话记忆和会话状态保持不变
+    '''
+    def __init__(self, ashley, path: str = None):
+        self.ashley = ashley
+        self.config = ashley.config
+        self.path = os.path.abspath(path or self.config.path)
+        self.snapshot = read_yaml(self.path)
+        self.task = None
+        self.reloads = 0
+
+    def start(self):
+        if self.task is None:
+            self.task = asyncio.get_running_loop().create_task(self.watch())
+
+    async def stop(self):
+        if self.task is not None:
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+            self.task = None
+
+    async def watch(self):
+        # 监视所在目录，编辑器以重命名方式保存时也能收到变化
+        async for _ in awatch(os.path.dirname(self.path),
+                              watch_filter=lambda change, path: os.path.abspath(path) == self.path):
+            try:
+                await self.reload()
+            except Exception as e:
+                logger.error(f'Failed to reload {self.path}: {e}')
+
+    async def reload(self) -> dict[tuple, tuple]:
+        '''重新读取配置并应用差异，返回应用的变化'''
+        started = time.perf_counter()
+        new = await asyncio.to_thread(read_yaml, self.path)
+        changes = diff_config(self.snapshot, new)
+        if not changes:
+            return changes
+
+        self.config.update(new)
+        self.config.mark_dirty()
+        self.snapshot = new
+        self.apply(changes)
+
+        elapsed = time.perf_counter() - started
+        self.reloads += 1
+        metrics.observe('config_reload', elapsed)
+        logger.info(f'Config reloaded in {elapsed * 1000:.1f}ms: {", ".join(".".join(map(str, path)) for path in changes)}')
+        return changes
+
+    def apply(self, changes: dict[tuple, tuple]):
+        ashley = self.ashley
+        config = self.config.Ashley
+        paths = list(changes)
+
+        def changed(*prefix) -> bool:
+            return any(path[:len(prefix)] == prefix for path in paths)
+
+        def helper_changed(keys: set) -> bool:
+            return any(path[:2] == ('Ashley', 'Helper') and len(path) > 2 and path[2] in keys for path in paths)
+
+        # 只应用配置文件中增删的部分，运行时用 !enable 等命令修改的内容保持不变
+        for key in ('wheel', 'group_whitelist'):
+            if (key,) in changes:
+                live = getattr(ashley, key)
+                update_set(live, *changes[(key,)])
+                # update() 已用配置文件中的列表覆盖，写回合并后的结果
+                self.config[key] = list(live)
+
+        lifecycle_changed = changed('Ashley', 'Lifecycle')
+        if lifecycle_changed:
+            ashley.lifecycle.configure(config.get('Lifecycle', {}))
+
+        # 模型还没有创建时不需要处理，创建时会读取新的配置
+        if ashley.models is not None:
+            helper, ai = ashley.models
+            if changed('Ashley', 'Prompt'):
+                ai.set_prompt(config['Prompt'])
+            if changed('Ashley', 'Parameters') or lifecycle_changed:
+                parameters = config['Parameters']
+                ai.build_model(model=parameters['model'], base_url=parameters['base_url'],
+                               context_win=int(parameters.get('context_win', 4096)))
+            if changed('Express') or changed('ExpressData') or changed('ChatExpress'):
+                ai.set_expression(ashley.express_data(), self.config.get('ChatExpress', default=True))
+            if changed('Ashley', 'Streaming'):
+                stream_config = dict(config.get('Streaming', {}))
+                ai.streaming = bool(stream_config.pop('enable', False))
+                ai.stream_rules = stream_config
+
+            helper_config = config['Helper']
+            # keep_alive 在创建客户端时设置，常驻策略改变后重建客户端
+            if helper_changed(HELPER_MODEL_KEYS) or lifecycle_changed:
+                helper.build_model(helper_config)
+            if helper_changed(HELPER_VISION_KEYS) or lifecycle_changed:
+                helper.build_vision_model(helper_config)
+            if helper_changed(HELPER_TEMPLATE_KEYS):
+                helper.build_templates(helper_config)
+            if helper_changed({'arouse_batch_window', 'arouse_batch_size'}):
+                helper.arouse_batcher.window = float(helper_config.get('arouse_batch_window', 0.2))
+                helper.arouse_batcher.max_size = int(helper_config.get('arouse_batch_size', 8))
+            if helper_changed({'image_deadline'}):
+                ai.image_deadline = float(helper_config.get('image_deadline', 20.0))
+
+        for key, attr in ACTIVE_PARAMETERS.items():
+            if changed('Ashley', key):
+                setattr(ashley, attr, float(config[key]))
+        if changed('Ashley', 'Shedding'):
+            ashley.shedder.configure(config.get('Shedding', {}))
+        if changed('Ashley', 'Gate') or changed('Ashley', 'group_active_threshold') \
+                or changed('Ashley', 'group_active_engage'):
+            ashley.gate.configure(config.get('Gate', {}), ashley.group_active_threshold, ashley.group_active_engage)
+
+        for prefix in RESTART_REQUIRED:
+            if changed(*prefix):
+                logger.warning(f'Config {".".join(prefix)} changed, restart to apply')
@@ -0,0 +1,133 @@
+import asyncio
+import itertools
+import math
+import time
+from contextlib import asynccontextmanager
+from plugins.Ashley.metrics import metrics
+
+# 请求优先级，数值越小越优先
+REPLY = 0   # 正在等待的回复
+VISION = 1  # 回复所需的图片描述
+AROUSE = 2  # 是否需要回复的判断
+DIGEST = 3  # 后台的群聊摘要
+
+PRIORITY_NAMES = {REPLY: 'reply', VISION: 'vision', AROUSE: 'arouse', DIGEST: 'digest'}
+
+# 计入负载的优先级，低优先级的请求本来就会排队较久
+PRESSURE_PRIORITIES = (REPLY, VISION)
+
+
+class EndpointQueue:
+    '''单个模型服务的并发槽位和等待队列'''
+    __slots__ = ('capacity', 'active', 'waiters')
+
+    def __init__(self, capacity: int):
+        self.capacity = capacity
+        self.active = 0
+        self.waiters = []  # [优先级, 入队时间, 序号, future]
+
+
+class RequestScheduler:
+    '''
+    按优先级分配发往同一模型服务(base_url)的并发槽位
+
+    槽位空出时交给有效优先级最高的请求，有效优先级 = 优先级 - 等待时间 / aging，
+    低优先级的请求每等待 aging 秒提升一级，不会被一直饿死。
+    没有单独设置并发数的后端池，默认并发数按池中后端数量(backends(endpoint))成倍增加。
+    '''
+    def __init__(self, default: int = 2, limits: dict = None, aging: float = 5.0,
+                 wait_alpha: float = 0.3, wait_decay: float = 30.0, backends=None):
+        self.default = default
+        self.limits = limits or {}
+        self.backends = backends or (lambda endpoint: 1)
+        self.aging = aging
+        self.queues: dict[str, EndpointQueue] = {}
+        self.counter = itertools.count()
+        # 回复和图片描述请求排队时间的 EWMA，没有新请求时按 wait_decay 秒衰减
+        self.wait_alpha = wait_alpha
+        self.wait_decay = wait_decay
+        self.wait_ewma = 0.0
+        self.wait_updated = time.perf_counter()
+
+    def queue(self, endpoint: str) -> EndpointQueue:
+        queue = self.queues.get(endpoint)
+        if queue is None:
+            capacity = self.limits.get(endpoint, self.default * self.backends(endpoint))
+            queue = self.queues[endpoint] = EndpointQueue(int(capacity))
+        return queue
+
+    def decayed_wait(self, now: float) -> float:
+        if self.wait_decay <= 0:
+            return self.wait_ewma
+        return self.wait_ewma * math.exp(-(now - self.wait_updated) / self.wait_decay)
+
+    def record_wait(self, waited: float):
+        now = time.perf_counter()
+        self.wait_ewma = (1 - self.wait_alpha) * self.decayed_wait(now) + self.wait_alpha * waited
+        self.wait_updated = now
+
+    def pressure(self) -> float:
+        '''当前负载：排队时间的 EWMA 和仍在等待的回复请求已等待时间中较大的一个(秒)'''
+        now = time.perf_counter()
+        oldest = max((now - waiter[1] for queue in self.queues.values() for waiter in queue.waiters
+                      if waiter[0] in PRESSURE_PRIORITIES), default=0.0)
+        return max(self.decayed_wait(now), oldest)
+
+    def effective_priority(self, waiter: list, now: float) -> float:
+        if self.aging <= 0:
+            return waiter[0]
+        return waiter[0] - (now - waiter[1]) / self.aging
+
+    def release(self, queue: EndpointQueue):
+        '''把槽位交给等待中有效优先级最高的请求，没有等待时归还'''
+        now = time.perf_counter()
+        while queue.waiters:
+            best = min(queue.waiters, key=lambda waiter: (self.effective_priority(waiter, now), waiter[2]))
+            queue.waiters.remove(best)
+            # 同一轮事件循环中已被取消的请求还在队列中，跳过
+            if not best[3].done():
+                best[3].set_result(None)
+                return
+        queue.active -= 1
+
+    @asynccontextmanager
+    async def slot(self, endpoint: str, priority: int = REPLY):
+        queue = self.queue(endpoint)
+        name = PRIORITY_NAMES.get(priority, str(priority))
+        started = time.perf_counter()
+        metrics.inc(f'scheduler_{name}_requests')
+
+        if queue.active < queue.capacity and not queue.waiters:
+            queue.active += 1
+        else:
+            future = asyncio.get_running_loop().create_future()
+            waiter = [priority, started, next(self.counter), future]
+            queue.waiters.append(waiter)
+            metrics.observe(f'scheduler_{name}_depth', sum(1 for w in queue.waiters if w[0] == priority))
+            try:
+                await future
+            except asyncio.CancelledError:
+                if future.done() and not future.cancelled():
+                    # 已经分到槽位后才被取消
+                    self.release(queue)
+                elif waiter in queue.waiters:
+                    queue.waiters.remove(waiter)
+                raise
+
+        metrics.since(f'scheduler_{name}_wait', started)
+        if priority in PRESSURE_PRIORITIES:
+            self.record_wait(time.perf_counter() - started)
+        try:
+            yield
+        finally:
+            self.release(queue)
+
+    def report(self) -> str:
+        lines = []
+        for endpoint, queue in self.queues.items():
+            waiting = {}
+            for waiter in queue.waiters:
+                name = PRIORITY_NAMES.get(waiter[0], str(waiter[0]))
+                waiting[name] = waiting.get(name, 0) + 1
+            lines.append(f'{endpoint}: {queue.active}/{queue.capacity} active, waiting {waiting or 0}')
+        return '\n'.join(lines)
@@ -0,0 +1,338 @@
+import asyncio
+import sqlite3
+import sys
+import threading
+import time
+from collections import OrderedDict
+from dataclasses import dataclass, fields
+from typing import Optional
+import orjson
+import structlog
+from plugins.Ashley.gate import GroupActivity
+from plugins.Ashley.metrics import metrics
+
+logger = structlog.stdlib.get_logger()
+
+
+@dataclass(slots=True)
+class GroupChatSession:
+    '''
+    群聊会话状态，只保存判断是否回复所需的字段，不引用消息事件本身
+    '''
+    group_id: int
+    group_thread_id: str # 对话主题ID，可用于合并群聊
+    messages_digest: str = '' # 上次回复至当前的对话摘要
+    avg_msg_interval: float = float('inf') # 由每次新对话间隔加权计算的平均消息间隔(秒)
+    last_active_time: int = 0 # 上次有新消息的时间，0 表示还没有消息
+    last_active_sender: int = 0 # 上次有新消息的发送者
+    last_active_had_image: bool = False # 上次的新消息是否带有图片
+    last_trigger_time: int = 0 # 上次触发对话的时间
+    last_trigger_sender: int = 0 # 上次触发对话的发送者
+    last_event_time: int = 0 # 上次收到事件(包括戳一戳)的时间
+    digest_epoch: int = 0 # 摘要被回复消费的次数，用于丢弃过期的后台摘要
+    activity: Optional[GroupActivity] = None # 消息速率窗口和小时基线，由 GateEngine 维护
+    touched: float = 0.0 # 最近一次访问的 monotonic 时间，用于淘汰空闲会话
+
+    def consume_digest(self) -> str:
+        '''取出当前摘要用于回复，并使正在生成的摘要失效'''
+        digest = self.messages_digest
+        self.messages_digest = ''
+        self.digest_epoch += 1
+        return digest
+
+    def store_digest(self, digest: str, epoch: int) -> bool:
+        '''仅当生成期间摘要未被消费时写回'''
+        if epoch != self.digest_epoch:
+            return False
+        self.messages_digest = digest
+        return True
+
+    def update_avg_msg_interval(self, current_event_time: int, alpha: float):
+        if not self.last_active_time:
+            return
+        interval = current_event_time - self.last_active_time
+        if self.avg_msg_interval == float('inf'):
+            self.avg_msg_interval = interval
+        else:
+            self.avg_msg_interval = (1 - alpha) * self.avg_msg_interval + alpha * interval
+
+    def record_active(self, event_time: int, sender: int, had_image: bool):
+        self.last_active_time = event_time
+        self.last_active_sender = sender
+        self.last_active_had_image = had_image
+
+    def record_trigger(self, event_time: int, sender: int):
+        self.last_trigger_time = event_time
+        self.last_trigger_sender = sender
+
+    def size(self) -> int:
+        '''估算占用的内存(字节)'''
+        size = sys.getsizeof(self) + sys.getsizeof(self.group_thread_id) + sys.getsizeof(self.messages_digest)
+        if self.activity is not None:
+            size += sys.getsizeof(self.activity.counts) + sys.getsizeof(self.activity.baseline) + 64
+        return size
+
+    def dumps(self) -> bytes:
+        data = {name: getattr(self, name) for name in SESSION_FIELDS}
+        if self.activity is not None:
+            data['activity'] = self.activity.dump()
+        if data['avg_msg_interval'] == float('inf'):
+            data['avg_msg_interval'] = None # JSON 不支持 inf
+        return orjson.dumps(data)
+
+    @classmethod
+    def loads(cls, raw: bytes) -> 'GroupChatSession':
+        data = orjson.loads(raw)
+        if data.get('avg_msg_interval') is None:
+            data['avg_msg_interval'] = float('inf')
+        if data.get('activity') is not None:
+            data['activity'] = GroupActivity.load(data['activity'])
+        return cls(**data)
+
+
+# 保存到 SQLite 的字段，touched 只在本次运行中有效
+SESSION_FIELDS = [field.name for field in fields(GroupChatSession) if field.name != 'touched']
+
+
+class SessionStore:
+    '''
+    群聊会话的有界存储
+
+    会话数超过 max_sessions 或估算内存超过 max_bytes 时，最久未访问的会话写入 SQLite 后从内存移除；
+    空闲超过 idle_ttl 秒的会话同样移出。再次访问时从 SQLite 读回，摘要和活跃度不会丢失。
+    can_evict(group_id) 为假的会话(如正在生成摘要)不会被移出。
+
+    每隔 snapshot_interval 秒把内存中有变化的会话写入同一张表并移出空闲会话，重启后各群在第一次收到消息时读回，
+    平均消息间隔、摘要和对话线程不会因为重启而重置。
+    SQLite 的读写都在线程中进行，正在写入的会话保留在 pending 中，写入完成前再次访问不会读到旧数据。
+    '''
+    def __init__(self, path: str = 'sessions.db', max_sessions: int = 1024, max_bytes: int = 4 * 1024 * 1024,
+                 idle_ttl: float = 3600, snapshot_interval: float = 60, can_evict=None):
+        self.sessions: OrderedDict[int, GroupChatSession] = OrderedDict()
+        self.sizes: dict[int, int] = {} # group_id -> 上次估算的会话大小
+        self.total_size = 0
+        self.pending: dict[int, GroupChatSession] = {} # 正在写入 SQLite 的会话
+        self.loading: dict[int, asyncio.Future] = {} # 正在从 SQLite 读回的会话
+        self.max_sessions = max_sessions
+        self.max_bytes = max_bytes
+        self.idle_ttl = idle_ttl
+        self.can_evict = can_evict or (lambda group_id: True)
+        self.snapshot_interval = snapshot_interval
+        self.saved: dict[int, int] = {} # group_id -> 上次写入内容的哈希，只写入有变化的会话
+        self.task = None
+        self.spills = set()
+        self.stats = {'created': 0, 'spilled': 0, 'restored': 0, 'snapshots': 0, 'snapshot_rows': 0}
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        with self.lock, self.conn:
+            self.conn.execute('''CREATE TABLE IF NOT EXISTS sessions (
+                group_id INTEGER PRIMARY KEY,
+                data BLOB NOT NULL,
+                updated REAL NOT NULL)''')
+
+    def __len__(self):
+        return len(self.sessions)
+
+    def __contains__(self, group_id):
+        return group_id in self.sessions
+
+    def values(self):
+        return self.sessions.values()
+
+    def resize(self, group_id, session: GroupChatSession):
+        size = session.size()
+        self.total_size += size - self.sizes.get(group_id, 0)
+        self.sizes[group_id] = size
+
+    def insert(self, group_id, session: GroupChatSession):
+        session.touched = time.monotonic()
+        self.sessions[group_id] = session
+        self.resize(group_id, session)
+        self.evict()
+
+    def remove(self, group_id) -> GroupChatSession:
+        self.total_size -= self.sizes.pop(group_id, 0)
+        return self.sessions.pop(group_id)
+
+    async def get(self, group_id) -> GroupChatSession:
+        '''获取会话，不存在时从 SQLite 读回或新建'''
+        session = self.sessions.get(group_id)
+        if session is not None:
+            session.touched = time.monotonic()
+            self.sessions.move_to_end(group_id)
+            self.resize(group_id, session)
+            return session
+        session = self.pending.get(group_id)
+        if session is not None:
+            # 写入完成前再次访问，直接放回内存
+            self.insert(group_id, session)
+            return session
+        loading = self.loading.get(group_id)
+        if loading is not None:
+            return await asyncio.shield(loading)
+
+        loading = self.loading[group_id] = asyncio.get_running_loop().create_future()
+        try:
+            session = await self.restore(group_id)
+            if session is None:
+                session = GroupChatSession(group_id=group_id, group_thread_id=f'group_{group_id}')
+                self.stats['created'] += 1
+            self.insert(group_id, session)
+            loading.set_result(session)
+        except BaseException as e:
+            loading.set_exception(e)
+            loading.exception() # 没有其他等待者时不报告未读取的异常
+            raise
+        finally:
+            del self.loading[group_id]
+        return session
+
+    def read(self, group_id):
+        with self.lock:
+            return self.conn.execute('SELECT data FROM sessions WHERE group_id = ?', (group_id,)).fetchone()
+
+    async def restore(self, group_id):
+        # 只在会话被移出或重启后第一次访问时发生，单行主键查询
+        started = time.perf_counter()
+        row = await asyncio.to_thread(self.read, group_id)
+        if row is None:
+            return None
+        session = GroupChatSession.loads(row[0])
+        self.saved[group_id] = hash(row[0])
+        self.stats['restored'] += 1
+        metrics.inc('session_restored')
+        metrics.since('session_restore', started)
+        return session
+
+    def write(self, rows: list[tuple]):
+        with self.lock, self.conn:
+            self.conn.executemany('INSERT OR REPLACE INTO sessions VALUES (?, ?, ?)', rows)
+
+    def spill(self, sessions: list[GroupChatSession]):
+        '''移出的会话立即序列化并放入 pending，返回在线程中写入的协程'''
+        now = time.time()
+        rows = [(session.group_id, session.dumps(), now) for session in sessions]
+        for session in sessions:
+            self.pending[session.group_id] = session
+            self.saved.pop(session.group_id, None)
+        return self.write_spilled(sessions, rows)
+
+    async def write_spilled(self, sessions: list[GroupChatSession], rows: list[tuple]):
+        try:
+            await asyncio.to_thread(self.write, rows)
+        except sqlite3.Error:
+            logger.exception('Failed to spill group sessions')
+            # 写入失败时放回内存，下次快照时重试
+            for session in sessions:
+                if self.pending.get(session.group_id) is session and session.group_id not in self.sessions:
+                    self.sessions[session.group_id] = session
+                    self.resize(session.group_id, session)
+            return
+        finally:
+            for session in sessions:
+                if self.pending.get(session.group_id) is session:
+                    del self.pending[session.group_id]
+        self.stats['spilled'] += len(sessions)
+        metrics.inc('session_spilled', len(sessions))
+
+    def changed_rows(self) -> list[tuple]:
+        '''序列化内存中的会话，返回自上次写入后有变化的行'''
+        now = time.time()
+        rows = []
+        for group_id, session in self.sessions.items():
+            data = session.dumps()
+            digest = hash(data)
+            if self.saved.get(group_id) != digest:
+                self.saved[group_id] = digest
+                rows.append((group_id, data, now))
+        return rows
+
+    async def snapshot(self) -> int:
+        '''增量保存有变化的会话，序列化在事件循环中完成，写入在线程中进行'''
+        started = time.perf_counter()
+        rows = self.changed_rows()
+        if rows:
+            await asyncio.to_thread(self.write, rows)
+        self.stats['snapshots'] += 1
+        self.stats['snapshot_rows'] += len(rows)
+        metrics.since('session_snapshot', started)
+        metrics.inc('session_snapshot_rows', len(rows))
+        return len(rows)
+
+    async def run(self):
+        while True:
+            await asyncio.sleep(self.snapshot_interval)
+            try:
+                # 摘要等字段变化时不会更新估算的大小，定期重新计算
+                for group_id, session in self.sessions.items():
+                    self.resize(group_id, session)
+                await self.evict_now()
+                await self.snapshot()
+            except sqlite3.Error:
+                logger.exception('Session snapshot failed')
+
+    def start(self):
+        if self.task is None and self.snapshot_interval > 0:
+            self.task = asyncio.get_running_loop().create_task(self.run())
+
+    def memory_size(self) -> int:
+        return sys.getsizeof(self.sessions) + self.total_size
+
+    def victims(self) -> list[GroupChatSession]:
+        '''从内存中移出空闲和超出上限的会话'''
+        now = time.monotonic()
+        victims = []
+        for group_id, session in list(self.sessions.items()):
+            idle = self.idle_ttl and now - session.touched > self.idle_ttl
+            over = len(self.sessions) > self.max_sessions or (self.max_bytes and self.memory_size() > self.max_bytes)
+            if not idle and not over:
+                # 按访问顺序排列，后面的会话更新，不再需要检查
+                break
+            if not self.can_evict(group_id):
+                continue
+            victims.append(self.remove(group_id))
+        return victims
+
+    async def evict_now(self):
+        victims = self.victims()
+        if victims:
+            await self.spill(victims)
+            logger.debug(f'Spilled {len(victims)} idle group sessions, {len(self.sessions)} in memory')
+
+    def evict(self):
+        '''插入新会话后在后台移出，不阻塞当前消息'''
+        victims = self.victims()
+        if victims:
+            task = asyncio.get_running_loop().create_task(self.spill(victims))
+            self.spills.add(task)
+            task.add_done_callback(self.spills.discard)
+
+    async def close(self):
+        '''退出时保存所有有变化的会话'''
+        if self.task is not None:
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+            self.task = None
+        if self.spills:
+            await asyncio.gather(*self.spills, return_exceptions=True)
+        started = time.perf_counter()
+        rows = self.changed_rows()
+        if rows:
+            self.write(rows)
+        logger.info(f'Saved {len(rows)} group sessions in {(time.perf_counter() - started) * 1000:.1f}ms')
+        with self.lock:
+            self.conn.close()
+
+    def count(self) -> int:
+        with self.lock:
+            return self.conn.execute('SELECT COUNT(*) FROM sessions').fetchone()[0]
+
+    async def report(self) -> str:
+        spilled = await asyncio.to_thread(self.count)
+        return (f'sessions: {len(self.sessions)}/{self.max_sessions} in memory, {spilled} on disk\n'
+                f'memory: {self.memory_size() / 1024:.1f}KB/{self.max_bytes / 1024:.0f}KB\n'
+                f'created: {self.stats["created"]} spilled: {self.stats["spilled"]} restored: {self.stats["restored"]}\n'
+                f'snapshots: {self.stats["snapshots"]} rows written: {self.stats["snapshot_rows"]}')
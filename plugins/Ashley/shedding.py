@@ -0,0 +1,162 @@
+import time
+import structlog
+from plugins.Ashley.metrics import metrics
+
+logger = structlog.stdlib.get_logger()
+
+# 无论负载如何都回复的判断原因
+ALWAYS_REPLY_REASONS = {'mention', 'reply_to_bot'}
+
+
+class TokenBucket:
+    '''令牌桶，每分钟补充 rate 个令牌，最多积累 burst 个'''
+    __slots__ = ('rate', 'burst', 'tokens', 'updated')
+
+    def __init__(self, rate: float, burst: float):
+        self.rate = rate / 60
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+
+    def configure(self, rate: float, burst: float):
+        '''修改速率和容量，保留已有的令牌'''
+        self.refill(time.monotonic())
+        self.rate = rate / 60
+        self.burst = burst
+        self.tokens = min(self.tokens, burst)
+
+    def refill(self, now: float):
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def peek(self, now: float) -> bool:
+        self.refill(now)
+        return self.tokens >= 1
+
+    def take(self, now: float) -> bool:
+        self.refill(now)
+        if self.tokens < 1:
+            return False
+        self.tokens -= 1
+        return True
+
+
+class LoadShedder:
+    '''
+    根据模型请求的排队等待时间降低负载
+
+    排队等待超过 target_wait 秒时进入降载状态：随机回复的概率按 target_wait / 等待时间 缩小(不低于 min_scale)，
+    非 @ 消息不再描述图片，不再生成群聊摘要；等待时间回落到 target_wait * recover_ratio 以下时恢复。
+    回复数量由每个群和全局的令牌桶限制，@ 和回复机器人的消息不受限制(exempt_mentions)。
+    '''
+    def __init__(self, scheduler, config: dict = None):
+        self.scheduler = scheduler
+        self.groups: dict[int, TokenBucket] = {}
+        self.global_bucket = None
+        self.shedding = False
+        self.since = None
+        self.stats = {'rate_limited': 0, 'digest': 0, 'vision': 0, 'transitions': 0}
+        self.configure(config or {})
+
+    def configure(self, config: dict):
+        self.target_wait = float(config.get('target_wait', 5.0))
+        self.recover_ratio = float(config.get('recover_ratio', 0.5))
+        self.min_scale = float(config.get('min_scale', 0.1))
+        self.exempt_mentions = bool(config.get('exempt_mentions', True))
+        self.group_rate = float(config.get('group_rate', 6))
+        self.group_burst = float(config.get('group_burst', 3))
+        global_rate, global_burst = float(config.get('global_rate', 30)), float(config.get('global_burst', 10))
+        # 热重载时保留已有令牌，只修改速率和容量，否则每次重载都会把所有桶补满
+        if self.global_bucket is None:
+            self.global_bucket = TokenBucket(global_rate, global_burst)
+        else:
+            self.global_bucket.configure(global_rate, global_burst)
+        for bucket in self.groups.values():
+            bucket.configure(self.group_rate, self.group_burst)
+
+    def pressure(self) -> float:
+        return self.scheduler.pressure()
+
+    def update(self) -> float:
+        '''根据当前等待时间更新降载状态，返回等待时间'''
+        pressure = self.pressure()
+        if not self.shedding and pressure > self.target_wait:
+            self.shedding = True
+            self.since = time.monotonic()
+            self.stats['transitions'] += 1
+            logger.warning(f'Model queue wait {pressure:.1f}s above {self.target_wait}s, shedding load')
+        elif self.shedding and pressure < self.target_wait * self.recover_ratio:
+            self.shedding = False
+            logger.info(f'Model queue wait {pressure:.1f}s recovered after {time.monotonic() - self.since:.0f}s')
+            self.since = None
+        metrics.observe('shed_pressure', pressure)
+        return pressure
+
+    def engage_scale(self) -> float:
+        '''随机回复概率的缩放系数'''
+        pressure = self.update()
+        if not self.shedding or pressure <= 0:
+            return 1.0
+        return max(self.min_scale, min(1.0, self.target_wait / pressure))
+
+    def bucket(self, group_id: int) -> TokenBucket:
+        bucket = self.groups.get(group_id)
+        if bucket is None:
+            bucket = self.groups[group_id] = TokenBucket(self.group_rate, self.group_burst)
+        return bucket
+
+    def peek(self, group_id: int, reason: str) -> bool:
+        '''检查群和全局的令牌桶是否都有令牌，不扣除，用于在调用小模型判断前提前放弃'''
+        if self.exempt_mentions and reason in ALWAYS_REPLY_REASONS:
+            return True
+        now = time.monotonic()
+        if self.bucket(group_id).peek(now) and self.global_bucket.peek(now):
+            return True
+        self.skip('rate_limited')
+        return False
+
+    def admit(self, group_id: int, reason: str) -> bool:
+        '''回复前检查群和全局的令牌桶，两者都有令牌时才扣除'''
+        now = time.monotonic()
+        bucket = self.bucket(group_id)
+        if self.exempt_mentions and reason in ALWAYS_REPLY_REASONS:
+            bucket.take(now)
+            self.global_bucket.take(now)
+            return True
+        if bucket.peek(now) and self.global_bucket.peek(now):
+            bucket.take(now)
+            self.global_bucket.take(now)
+            return True
+        self.skip('rate_limited')
+        return False
+
+    def allow_digest(self) -> bool:
+        if self.shedding:
+            self.skip('digest')
+            return False
+        return True
+
+    def allow_vision(self, direct: bool) -> bool:
+        '''降载时只为 @ 或回复机器人的消息描述图片'''
+        if self.shedding and not direct:
+            self.skip('vision')
+            return False
+        return True
+
+    def skip(self, work: str):
+        self.stats[work] += 1
+        metrics.inc('shed_skipped', work=work)
+
+    def report(self) -> str:
+        now = time.monotonic()
+        pressure = self.update()
+        state = f'shedding for {now - self.since:.0f}s' if self.shedding else 'normal'
+        self.global_bucket.refill(now)
+        lines = [f'state: {state}, queue wait {pressure:.2f}s (target {self.target_wait}s)',
+                 f'engage scale: {self.engage_scale():.2f}',
+                 f'global tokens: {self.global_bucket.tokens:.1f}/{self.global_bucket.burst:g}',
+                 'skipped: ' + ', '.join(f'{key} {value}' for key, value in self.stats.items())]
+        for group_id, bucket in self.groups.items():
+            bucket.refill(now)
+            lines.append(f'  {group_id}: {bucket.tokens:.1f}/{bucket.burst:g} tokens')
+        return '\n'.join(lines)
@@ -0,0 +1,4 @@
+import time
+
+# core 最先导入此模块，记录开始导入依赖的时间
+IMPORT_STARTED = time.perf_counter()
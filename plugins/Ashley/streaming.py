@@ -0,0 +1,118 @@
+THINK_START = '<think>'
+THINK_END = '</think>'
+
+
+def partial_suffix(text: str, token: str) -> int:
+    '''text 末尾可能是 token 前缀的长度，这部分需要等待更多输出才能判断'''
+    for size in range(min(len(token) - 1, len(text)), 0, -1):
+        if text.endswith(token[:size]):
+            return size
+    return 0
+
+
+class ThinkStripper:
+    '''
+    在流式输出中去掉 <think>...</think> 推理内容，与 DSR1CoTParser 的规则一致：
+    没有闭合的 <think> 在结束时按正文输出
+    '''
+    def __init__(self):
+        self.buffer = ''
+        self.thinking = ''
+        self.in_think = False
+        self.after_think = False
+
+    def feed(self, text: str) -> str:
+        self.buffer += text
+        output = []
+        while True:
+            if self.in_think:
+                end = self.buffer.find(THINK_END)
+                if end == -1:
+                    keep = partial_suffix(self.buffer, THINK_END)
+                    self.thinking += self.buffer[:len(self.buffer) - keep]
+                    self.buffer = self.buffer[len(self.buffer) - keep:]
+                    break
+                self.thinking += self.buffer[:end]
+                self.buffer = self.buffer[end + len(THINK_END):]
+                self.in_think = False
+                self.after_think = True
+                continue
+
+            start = self.buffer.find(THINK_START)
+            if start == -1:
+                safe = len(self.buffer) - partial_suffix(self.buffer, THINK_START)
+                output.append(self.buffer[:safe])
+                self.buffer = self.buffer[safe:]
+                break
+            output.append(self.buffer[:start])
+            self.buffer = self.buffer[start + len(THINK_START):]
+            self.in_think = True
+
+        text = ''.join(output)
+        if self.after_think:
+            # 推理内容之后的空白不发送
+            text = text.lstrip()
+            if text:
+                self.after_think = False
+        return text
+
+    def flush(self) -> str:
+        text = self.buffer
+        if self.in_think:
+            text = self.thinking + text
+        self.buffer = ''
+        self.thinking = ''
+        self.in_think = False
+        return text
+
+
+class SentenceChunker:
+    '''
+    把流式文本切分为可以单独发送的句子或段落
+
+    mode 为 sentence 时在句末标点处切分，为 paragraph 时只在换行处切分；
+    片段至少 min_chars 个字符，超过 max_chars 仍没有切分点时强制切分。
+    不会在 ::表情:: 中间切分。
+    '''
+    SENTENCE_END = '。！？!?~～…\n'
+    PARAGRAPH_END = '\n'
+    # 紧跟在句末标点后面、应归入同一句的字符
+    CLOSERS = '」』）)”"\'》】喵~～…。！？!?'
+
+    def __init__(self, mode: str = 'sentence', min_chars: int = 8, max_chars: int = 200, delimiters: str = None):
+        self.delimiters = delimiters or (self.PARAGRAPH_END if mode == 'paragraph' else self.SENTENCE_END)
+        self.min_chars = min_chars
+        self.max_chars = max_chars
+        self.buffer = ''
+
+    def find_cut(self) -> int:
+        '''返回可以切分的位置(不含)，没有时返回 -1'''
+        idx = self.min_chars - 1
+        while idx < len(self.buffer):
+            if self.buffer[idx] in self.delimiters:
+                cut = idx + 1
+                while cut < len(self.buffer) and self.buffer[cut] in self.CLOSERS:
+                    cut += 1
+                if cut == len(self.buffer):
+                    # 后面可能还有同一句的标点，等待更多输出
+                    return -1
+                if self.buffer.count('::', 0, cut) % 2 == 0:
+                    return cut
+            idx += 1
+
+        if len(self.buffer) >= self.max_chars and self.buffer.count('::', 0, self.max_chars) % 2 == 0:
+            return self.max_chars
+        return -1
+
+    def feed(self, text: str) -> list[str]:
+        self.buffer += text
+        pieces = []
+        while (cut := self.find_cut()) != -1:
+            piece, self.buffer = self.buffer[:cut].strip(), self.buffer[cut:]
+            if piece:
+                pieces.append(piece)
+        return pieces
+
+    def flush(self) -> list[str]:
+        piece, self.buffer = self.buffer.strip(), ''
+        return [piece] if piece else []
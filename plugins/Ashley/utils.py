@@ -2,30 +2,6 @@ import asyncio
 from enum import verify
 import time
 from alicebot import MessageEvent, Event
-from PIL import Image
-import base64
-import httpx
-from io import BytesIO
-
-async def convertToBase64(image_path, mode='local'):
-    """
-    Convert PIL images to Base64 encoded strings
-
-    :param pil_image: PIL image
-    :return: Re-sized Base64 string
-    """
-
-    if mode == 'local':
-        image_path = image_path.replace('/root', '/home/null/Projects/napcat.nix/data')
-        # print(image_path)
-        pil_image = Image.open(image_path)
-    elif mode == 'url':
-        pil_image = Image.open(BytesIO(httpx.get(image_path, verify=False).content))
-
-    buffered = BytesIO()
-    pil_image.save(buffered, format="JPEG")  # You can change the format if needed
-    img_str = base64.b64encode(buffered.getvalue()).decode("utf-8")
-    return img_str
 
 def formatTime(unixtime: int) -> str:
     return time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(unixtime))
@@ -0,0 +1,59 @@
+import asyncio
+import pytest
+from plugins.Ashley.scheduler import DIGEST, REPLY, RequestScheduler
+
+
+def test_release_skips_waiter_cancelled_in_same_tick():
+    async def scenario():
+        scheduler = RequestScheduler(default=1)
+        holder = scheduler.slot('ollama')
+        await holder.__aenter__()
+
+        async def wait():
+            async with scheduler.slot('ollama'):
+                pass
+
+        waiter = asyncio.get_running_loop().create_task(wait())
+        await asyncio.sleep(0)
+        queue = scheduler.queue('ollama')
+        assert len(queue.waiters) == 1
+
+        # 等待的请求被取消，同一轮事件循环中持有者释放槽位
+        waiter.cancel()
+        await holder.__aexit__(None, None, None)
+        with pytest.raises(asyncio.CancelledError):
+            await waiter
+
+        assert queue.active == 0
+        assert queue.waiters == []
+        async with scheduler.slot('ollama'):
+            assert queue.active == 1
+
+    asyncio.run(scenario())
+
+
+def test_release_passes_slot_to_next_live_waiter():
+    async def scenario():
+        scheduler = RequestScheduler(default=1)
+        holder = scheduler.slot('ollama')
+        await holder.__aenter__()
+        order = []
+
+        async def wait(name, priority):
+            async with scheduler.slot('ollama', priority):
+                order.append(name)
+
+        cancelled = asyncio.get_running_loop().create_task(wait('reply', REPLY))
+        live = asyncio.get_running_loop().create_task(wait('digest', DIGEST))
+        await asyncio.sleep(0)
+
+        cancelled.cancel()
+        await holder.__aexit__(None, None, None)
+        await asyncio.wait_for(live, 1)
+        with pytest.raises(asyncio.CancelledError):
+            await cancelled
+
+        assert order == ['digest']
+        assert scheduler.queue('ollama').active == 0
+
+    asyncio.run(scenario())